@@ -5,6 +5,8 @@ from routes.images import images_bp
 from routes.search import search_bp
 from routes.auth import auth_bp
 from database.db import init_db
+from services.task_handler import task_handler
+from werkzeug.serving import is_running_from_reloader
 import os
 import sys
 import signal
@@ -13,16 +15,22 @@ def signal_handler(sig, frame):
     """Handler for graceful shutdown"""
     print("\nSaving FAISS index before exit...")
     from services.ai_service import ai_service
-    ai_service.save_faiss_index("faiss_index.bin")
+    ai_service.close()
+    ai_service.query_cache.save()
     print("FAISS index saved. Exiting...")
     sys.exit(0)
-def create_app():
+def create_app(start_services=True):
+    """
+    start_services=False: không tải FAISS index, không chạy worker/snapshot
+    (process cha của reloader Werkzeug chỉ theo dõi file, không phục vụ request)
+    """
     app = Flask(__name__)
     app.config.from_object(Config)
 
     # Register signal handlers
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
+    if start_services:
+        signal.signal(signal.SIGINT, signal_handler)
+        signal.signal(signal.SIGTERM, signal_handler)
 
     # Đăng ký thư mục lưu ảnh
     app.config['UPLOAD_FOLDER'] = os.path.join(os.getcwd(), 'uploads') 
@@ -31,7 +39,11 @@ def create_app():
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
     # Khởi tạo database (SQLAlchemy)
-    init_db(app)
+    init_db(app, start_services=start_services)
+
+    # Xử lý job embedding còn tồn trong DB (kể cả từ lần chạy trước)
+    if start_services:
+        task_handler.init_app(app)
 
     # Đăng ký các blueprint
     app.register_blueprint(images_bp, url_prefix='/api/images')
@@ -59,5 +71,8 @@ def create_app():
     return app
 
 if __name__ == '__main__':
-    flask_app = create_app()
-    flask_app.run(host="0.0.0.0", port=5000, debug=True)
+    debug = True
+    # Với reloader, create_app chạy ở cả process cha lẫn process con; chỉ process
+    # con (WERKZEUG_RUN_MAIN=true) phục vụ request nên chỉ nó được claim job và ghi WAL/snapshot
+    flask_app = create_app(start_services=not debug or is_running_from_reloader())
+    flask_app.run(host="0.0.0.0", port=5000, debug=debug)
@@ -0,0 +1,313 @@
+# bulk_ingest.py
+"""
+Import hàng loạt ảnh cho một user từ thư mục hoặc manifest, không qua HTTP:
+insert Image/ImageEmbedding theo chunk, inference CPU theo batch (decode +
+preprocess chạy song song với inference) và thêm vector thẳng vào FAISS index.
+Checkpoint sau mỗi chunk nên chạy lại cùng lệnh sẽ tiếp tục từ chỗ bị dừng.
+
+    python bulk_ingest.py --user alice --dir /data/archive
+    python bulk_ingest.py --user 42 --manifest files.tsv --index db
+
+Manifest: mỗi dòng "path[<TAB>title[<TAB>description]]", path tương đối tính
+theo thư mục chứa manifest.
+--index direct (mặc định) ghi FAISS snapshot/WAL nên web server phải dừng;
+--index db chỉ ghi image_embeddings, web tier chạy EMBED_WORKER_MODE=pool sẽ tự
+đồng bộ vào index.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import signal
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from flask import Flask
+from sqlalchemy import insert, func
+from werkzeug.utils import secure_filename
+from config import Config
+from database.db import db
+from models import User, Image, ImageEmbedding
+from services.ai_service import ai_service
+from services.vector_codec import encode_vector
+from utils.file_handler import FileHandler
+
+
+def iter_directory(root):
+    """Duyệt thư mục theo thứ tự cố định (để checkpoint theo vị trí có nghĩa)"""
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            if FileHandler.allowed_file(file_name):
+                yield os.path.join(dir_path, file_name), os.path.splitext(file_name)[0], None
+
+
+def iter_manifest(manifest_path):
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            parts = line.split('\t')
+            path = os.path.join(base_dir, parts[0])
+            title = parts[1] if len(parts) > 1 and parts[1] else os.path.splitext(os.path.basename(path))[0]
+            description = parts[2] if len(parts) > 2 else None
+            yield path, title, description
+
+
+def storage_path(source_path, user_id, upload_folder):
+    """
+    Đường dẫn tương đối trong UPLOAD_FOLDER. Ảnh đã nằm trong UPLOAD_FOLDER thì
+    dùng luôn; ảnh ngoài thì copy vào imports/<user_id>/ với tên cố định theo
+    đường dẫn nguồn để chạy lại không tạo bản trùng.
+    """
+    source_path = os.path.abspath(source_path)
+    upload_folder = os.path.abspath(upload_folder)
+    if os.path.commonpath([source_path, upload_folder]) == upload_folder:
+        return os.path.relpath(source_path, upload_folder).replace(os.sep, '/'), False
+    digest = hashlib.sha1(source_path.encode('utf-8')).hexdigest()[:16]
+    return f"imports/{user_id}/{digest}_{secure_filename(os.path.basename(source_path))}", True
+
+
+def prepare_batch(entries, user_id, upload_folder):
+    """
+    Chạy trong thread pool: kiểm tra + decode + preprocess một batch ảnh.
+    Trả về (ảnh hợp lệ, pixel_values, lỗi); ảnh hợp lệ là
+    (source_path, relative_path, needs_copy, title, description).
+    """
+    ok, images, failures = [], [], []
+    for source_path, title, description in entries:
+        try:
+            if os.path.getsize(source_path) > FileHandler.MAX_FILE_SIZE:
+                raise ValueError("File size exceeds limit")
+            relative_path, needs_copy = storage_path(source_path, user_id, upload_folder)
+            images.append(ai_service.open_image(source_path))
+            ok.append((source_path, relative_path, needs_copy, title, description))
+        except Exception as e:
+            failures.append((source_path, str(e)))
+    pixel_values = ai_service.preprocess_images(images) if images else None
+    return ok, pixel_values, failures
+
+
+class Checkpoint:
+    """File JSON ghi (atomic) vị trí đã xử lý xong trong danh sách nguồn"""
+
+    def __init__(self, path, source, user_id):
+        self.path = path
+        self.failures_path = path + '.failed'
+        self.state = {'source': source, 'user_id': user_id, 'position': 0,
+                      'imported': 0, 'skipped': 0, 'failed': 0, 'embedding_watermark': 0}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, encoding='utf-8') as f:
+            state = json.load(f)
+        if state.get('source') != self.state['source'] or state.get('user_id') != self.state['user_id']:
+            raise ValueError(f"Checkpoint {self.path} belongs to another import "
+                             f"({state.get('source')}, user {state.get('user_id')})")
+        self.state.update(state)
+        return True
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.path)
+
+    def log_failures(self, failures):
+        if failures:
+            with open(self.failures_path, 'a', encoding='utf-8') as f:
+                for source_path, error in failures:
+                    f.write(f"{source_path}\t{error}\n")
+
+    def reset(self):
+        for path in (self.path, self.failures_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def iter_prepared(executor, sources, batch_size, prefetch, user_id, upload_folder):
+    """Đưa các batch vào thread pool trước prefetch batch, trả kết quả theo đúng thứ tự"""
+    pending = deque()
+    batch = []
+    for entry in sources:
+        batch.append(entry)
+        if len(batch) == batch_size:
+            pending.append((len(batch), executor.submit(prepare_batch, batch, user_id, upload_folder)))
+            batch = []
+            if len(pending) > prefetch:
+                count, future = pending.popleft()
+                yield count, future.result()
+    if batch:
+        pending.append((len(batch), executor.submit(prepare_batch, batch, user_id, upload_folder)))
+    while pending:
+        count, future = pending.popleft()
+        yield count, future.result()
+
+
+def write_chunk(rows, vectors, user_id, upload_folder, index_mode):
+    """Copy file, insert Image + ImageEmbedding của một chunk trong một transaction rồi thêm vào index"""
+    for source_path, relative_path, needs_copy, _, _ in rows:
+        if needs_copy:
+            target = os.path.join(upload_folder, relative_path)
+            if not (os.path.exists(target) and os.path.getsize(target) == os.path.getsize(source_path)):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copyfile(source_path, target)
+
+    image_ids = db.session.scalars(
+        insert(Image).returning(Image.image_id, sort_by_parameter_order=True),
+        [{'user_id': user_id, 'title': title, 'description': description or "Bulk import",
+          'file_path': relative_path}
+         for _, relative_path, _, title, description in rows]
+    ).all()
+    db.session.execute(insert(ImageEmbedding), [
+        {'image_id': image_id,
+         'embedding_vector': encode_vector(vectors[idx], Config.EMBEDDING_STORAGE_FORMAT),
+         'model': ai_service.model_tag}
+        for idx, image_id in enumerate(image_ids)
+    ])
+    db.session.commit()
+
+    if index_mode == 'direct':
+        ai_service.add_batch_to_index(vectors, np.array(image_ids, dtype=np.int64),
+                                      user_ids=[user_id] * len(image_ids))
+    return len(image_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--dir', help='Thư mục ảnh (duyệt đệ quy)')
+    source.add_argument('--manifest', help='File manifest, mỗi dòng một ảnh')
+    parser.add_argument('--user', required=True, help='user_id hoặc username sở hữu ảnh')
+    parser.add_argument('--index', choices=['direct', 'db'], default='direct',
+                        help='direct: ghi FAISS index (server phải dừng); db: để web tier đồng bộ')
+    parser.add_argument('--batch-size', type=int, default=Config.EMBED_INFERENCE_BATCH_SIZE,
+                        help='Số ảnh mỗi lần inference')
+    parser.add_argument('--chunk-size', type=int, default=2048, help='Số ảnh mỗi transaction/checkpoint')
+    parser.add_argument('--decode-workers', type=int, default=Config.EMBED_DECODE_WORKERS)
+    parser.add_argument('--torch-threads', type=int, default=0, help='torch.set_num_threads (0: mặc định)')
+    parser.add_argument('--upload-folder', default=os.path.join(os.getcwd(), 'uploads'))
+    parser.add_argument('--checkpoint', help='File checkpoint (mặc định trong instance/)')
+    parser.add_argument('--restart', action='store_true', help='Bỏ checkpoint cũ, import lại từ đầu')
+    parser.add_argument('--migrate', action='store_true',
+                        help='Sau khi import, chuyển index sang ANN nếu vượt ngưỡng (chỉ với --index direct)')
+    args = parser.parse_args()
+
+    if args.torch_threads:
+        import torch
+        torch.set_num_threads(args.torch_threads)
+
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    app.config['UPLOAD_FOLDER'] = args.upload_folder
+    db.init_app(app)
+
+    source_path = os.path.abspath(args.dir or args.manifest)
+    sources = iter_directory(source_path) if args.dir else iter_manifest(source_path)
+
+    stopping = []
+    signal.signal(signal.SIGINT, lambda sig, frame: stopping.append(sig))
+    signal.signal(signal.SIGTERM, lambda sig, frame: stopping.append(sig))
+
+    with app.app_context():
+        db.create_all()
+        user = User.query.filter((User.user_id == int(args.user)) if args.user.isdigit()
+                                 else (User.username == args.user)).first()
+        if user is None:
+            raise SystemExit(f"User {args.user} not found")
+        user_id = user.user_id
+
+        checkpoint_path = args.checkpoint or os.path.join(
+            app.instance_path,
+            f"bulk_ingest_{user_id}_{hashlib.sha1(source_path.encode('utf-8')).hexdigest()[:10]}.json"
+        )
+        os.makedirs(os.path.dirname(os.path.abspath(checkpoint_path)), exist_ok=True)
+        checkpoint = Checkpoint(checkpoint_path, source_path, user_id)
+        if args.restart:
+            checkpoint.reset()
+        elif checkpoint.load():
+            print(f"Resuming from checkpoint: {checkpoint.state['position']} entries done, "
+                  f"{checkpoint.state['imported']} imported")
+
+        if args.index == 'direct':
+            if Config.SEARCH_RERANK:
+                ai_service.open_vector_store()
+            ai_service.load_faiss_index()
+            # Chunk đã commit nhưng chưa kịp vào index trước khi bị dừng
+            _, recovered = ai_service.sync_index_from_db(db.session, checkpoint.state['embedding_watermark'])
+            if recovered:
+                print(f"Recovered {recovered} committed embeddings missing from the index")
+
+        # Bỏ qua phần nguồn đã xử lý xong ở lần chạy trước
+        position = checkpoint.state['position']
+        for _ in zip(range(position), sources):
+            pass
+
+        started = time.time()
+        chunk_rows, chunk_vectors, chunk_entries = [], [], 0
+
+        def flush(completed=False):
+            if chunk_rows:
+                checkpoint.state['imported'] += write_chunk(
+                    chunk_rows, np.vstack(chunk_vectors), user_id, args.upload_folder, args.index
+                )
+            checkpoint.state['position'] += chunk_entries
+            checkpoint.state['embedding_watermark'] = db.session.query(
+                func.max(ImageEmbedding.embedding_id)).scalar() or 0
+            checkpoint.state['completed'] = completed
+            checkpoint.save()
+            elapsed = time.time() - started
+            print(f"position={checkpoint.state['position']} imported={checkpoint.state['imported']} "
+                  f"failed={checkpoint.state['failed']} "
+                  f"({checkpoint.state['imported'] / max(elapsed, 1e-9):.1f} img/s)")
+
+        executor = ThreadPoolExecutor(max_workers=args.decode_workers, thread_name_prefix="ingest-decode")
+        try:
+            for count, (ok, pixel_values, failures) in iter_prepared(
+                    executor, sources, args.batch_size, args.decode_workers * 2, user_id, args.upload_folder):
+                checkpoint.log_failures(failures)
+                checkpoint.state['failed'] += len(failures)
+                chunk_entries += count
+
+                if ok:
+                    # Ảnh đã được import ở lần chạy bị ngắt giữa commit và checkpoint
+                    existing = {row[0] for row in db.session.query(Image.file_path)
+                                                            .filter(Image.user_id == user_id,
+                                                                    Image.file_path.in_([r[1] for r in ok]))
+                                                            .all()}
+                    keep = [idx for idx, row in enumerate(ok) if row[1] not in existing]
+                    checkpoint.state['skipped'] += len(ok) - len(keep)
+                    if keep:
+                        if len(keep) < len(ok):
+                            pixel_values = pixel_values[keep]
+                        chunk_rows.extend(ok[idx] for idx in keep)
+                        chunk_vectors.append(ai_service.encode_pixel_values(pixel_values))
+
+                if chunk_entries >= args.chunk_size or stopping:
+                    flush()
+                    chunk_rows, chunk_vectors, chunk_entries = [], [], 0
+                    if stopping:
+                        print("Interrupted, checkpoint saved. Run the same command to resume.")
+                        break
+            else:
+                flush(completed=True)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+            if args.index == 'direct':
+                if args.migrate and not stopping and ai_service.should_migrate_index():
+                    ai_service.migrate_index(db.session)
+                ai_service.close()
+
+    print(f"Bulk ingest finished: imported={checkpoint.state['imported']} "
+          f"skipped={checkpoint.state['skipped']} failed={checkpoint.state['failed']} "
+          f"(failures logged to {checkpoint.failures_path})")
+
+
+if __name__ == '__main__':
+    main()
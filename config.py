@@ -20,6 +20,103 @@ class Config:
     # Upload configuration
     UPLOAD_FOLDER = os.path.join(basedir, 'uploads')
     MAX_CONTENT_LENGTH = 200 * 1024 * 1024  # 5MB limit
+
+    # Embedding pipeline (decode/preprocess -> inference -> writer)
+    EMBED_DECODE_WORKERS = int(os.getenv('EMBED_DECODE_WORKERS', os.cpu_count() or 4))
+    EMBED_INFERENCE_WORKERS = int(os.getenv('EMBED_INFERENCE_WORKERS', 1))
+    EMBED_WRITER_WORKERS = int(os.getenv('EMBED_WRITER_WORKERS', 1))
+    EMBED_QUEUE_SIZE = int(os.getenv('EMBED_QUEUE_SIZE', 8))
+    EMBED_INFERENCE_BATCH_SIZE = int(os.getenv('EMBED_INFERENCE_BATCH_SIZE', 32))
+    # Queue job embedding lưu trong DB: lease, retry với backoff, quét ảnh chưa có embedding khi khởi động
+    EMBED_JOB_LEASE_SECONDS = int(os.getenv('EMBED_JOB_LEASE_SECONDS', 300))
+    EMBED_JOB_MAX_ATTEMPTS = int(os.getenv('EMBED_JOB_MAX_ATTEMPTS', 5))
+    EMBED_JOB_BACKOFF_BASE = float(os.getenv('EMBED_JOB_BACKOFF_BASE', 5))
+    EMBED_JOB_BACKOFF_MAX = float(os.getenv('EMBED_JOB_BACKOFF_MAX', 600))
+    EMBED_JOB_POLL_INTERVAL = float(os.getenv('EMBED_JOB_POLL_INTERVAL', 0.5))
+    EMBED_JOB_MAX_IN_FLIGHT = int(os.getenv('EMBED_JOB_MAX_IN_FLIGHT', 512))
+    EMBED_SWEEP_ON_STARTUP = os.getenv('EMBED_SWEEP_ON_STARTUP', 'true').lower() == 'true'
+    # thread: embed trong process web; pool: job do embed_workers.py xử lý, web chỉ đồng bộ index từ DB
+    EMBED_WORKER_MODE = os.getenv('EMBED_WORKER_MODE', 'thread')
+    EMBED_POOL_WORKERS = int(os.getenv('EMBED_POOL_WORKERS', max(1, (os.cpu_count() or 4) // 4)))
+    EMBED_POOL_TORCH_THREADS = int(os.getenv('EMBED_POOL_TORCH_THREADS', 4))
+    EMBED_INDEX_SYNC_INTERVAL = float(os.getenv('EMBED_INDEX_SYNC_INTERVAL', 2.0))
+    # Adaptive batching: batch theo thời gian inference đo được, SLO độ trễ upload -> searchable, giới hạn bộ nhớ
+    EMBED_LATENCY_SLO = float(os.getenv('EMBED_LATENCY_SLO', 1.0))
+    EMBED_BATCH_MAX_WAIT = float(os.getenv('EMBED_BATCH_MAX_WAIT', 0.2))
+    EMBED_BATCH_MAX_MEMORY_MB = int(os.getenv('EMBED_BATCH_MAX_MEMORY_MB', 1024))
+    EMBED_BATCH_ITEM_MB = float(os.getenv('EMBED_BATCH_ITEM_MB', 16))  # tensor + activation mỗi ảnh (ViT-L/14, 224px)
+    EMBED_BATCH_MAX_SIZE = int(os.getenv('EMBED_BATCH_MAX_SIZE', 128))
+
+    # Model embedding: EMBEDDING_MODEL là model ban đầu; model đang dùng sau khi chuyển được lưu trong
+    # EMBEDDING_MODEL_STATE_PATH. Đặt EMBEDDING_MODEL_TARGET để re-embed toàn bộ ảnh trong nền rồi chuyển sang
+    EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'openai/clip-vit-large-patch14')
+    EMBEDDING_MODEL_STATE_PATH = os.getenv('EMBEDDING_MODEL_STATE_PATH', os.path.join(basedir, 'instance', 'embedding_model.json'))
+    EMBEDDING_MODEL_TARGET = os.getenv('EMBEDDING_MODEL_TARGET', '')
+    REEMBED_BATCH_SIZE = int(os.getenv('REEMBED_BATCH_SIZE', 16))
+    REEMBED_MAX_IMAGES_PER_SEC = float(os.getenv('REEMBED_MAX_IMAGES_PER_SEC', 10))  # 0 = không giới hạn
+    REEMBED_YIELD_TO_JOBS = os.getenv('REEMBED_YIELD_TO_JOBS', 'true').lower() == 'true'
+
+    # FAISS index snapshot + write-ahead log
+    FAISS_INDEX_PATH = os.getenv('FAISS_INDEX_PATH', 'faiss_index.bin')
+    FAISS_WAL_PATH = os.getenv('FAISS_WAL_PATH', 'faiss_index.wal')
+    FAISS_WAL_FSYNC_BATCH = int(os.getenv('FAISS_WAL_FSYNC_BATCH', 256))
+    FAISS_WAL_FSYNC_INTERVAL = float(os.getenv('FAISS_WAL_FSYNC_INTERVAL', 1.0))
+    FAISS_WAL_MAX_BYTES = int(os.getenv('FAISS_WAL_MAX_BYTES', 256 * 1024 * 1024))
+    # mmap snapshot khi load (chỉ khi WAL trống) để khởi động không phải đọc cả index vào RAM.
+    # Không phải chế độ read-only: lần add đầu tiên đọc lại snapshot vào heap (ngoài lock)
+    FAISS_MMAP = os.getenv('FAISS_MMAP', 'false').lower() == 'true'
+
+    # Index khởi đầu: flat (float32) | sq_fp16 (giảm 2x bộ nhớ, không cần train)
+    FAISS_INDEX_TYPE = os.getenv('FAISS_INDEX_TYPE', 'flat')
+    # Định dạng lưu embedding trong image_embeddings: float32 | float16 | int8
+    EMBEDDING_STORAGE_FORMAT = os.getenv('EMBEDDING_STORAGE_FORMAT', 'float32')
+
+    # FAISS index: tự chuyển từ Flat sang ANN khi số vector vượt ngưỡng
+    FAISS_ANN_INDEX_TYPE = os.getenv('FAISS_ANN_INDEX_TYPE', 'ivf_flat')  # sq8 | ivf_flat | ivf_sq8 | ivf_pq | hnsw
+    FAISS_ANN_AUTO_MIGRATE = os.getenv('FAISS_ANN_AUTO_MIGRATE', 'true').lower() == 'true'
+    FAISS_ANN_THRESHOLD = int(os.getenv('FAISS_ANN_THRESHOLD', 100000))
+    FAISS_TRAIN_SAMPLE = int(os.getenv('FAISS_TRAIN_SAMPLE', 100000))
+    FAISS_IVF_NLIST = int(os.getenv('FAISS_IVF_NLIST', 0))  # 0 = tự tính theo số vector
+    FAISS_PQ_M = int(os.getenv('FAISS_PQ_M', 64))
+    FAISS_HNSW_M = int(os.getenv('FAISS_HNSW_M', 32))
+    FAISS_NPROBE = int(os.getenv('FAISS_NPROBE', 16))
+    FAISS_EF_SEARCH = int(os.getenv('FAISS_EF_SEARCH', 128))
+    # Search 2 tầng: lấy k*R ứng viên từ index nén/ANN rồi re-rank bằng vector float32
+    SEARCH_RERANK = os.getenv('SEARCH_RERANK', 'false').lower() == 'true'
+    SEARCH_RERANK_FACTOR = int(os.getenv('SEARCH_RERANK_FACTOR', 4))
+    VECTOR_STORE_PATH = os.getenv('VECTOR_STORE_PATH', os.path.join(basedir, 'instance', 'vector_store'))
+    # Search theo ngưỡng score (range search): số kết quả tối đa giữ lại, ngưỡng mặc định cho search ảnh
+    SEARCH_RANGE_MAX_RESULTS = int(os.getenv('SEARCH_RANGE_MAX_RESULTS', 1000))
+    # Số kết quả tối đa trên một trang search (per_page lớn hơn bị cắt về giá trị này)
+    SEARCH_MAX_PER_PAGE = int(os.getenv('SEARCH_MAX_PER_PAGE', 100))
+    # Có vector store: range search lấy thêm ứng viên trong khoảng này dưới ngưỡng rồi lọc lại bằng score chính xác
+    SEARCH_RANGE_RERANK_MARGIN = float(os.getenv('SEARCH_RANGE_RERANK_MARGIN', 0.02))
+    SEARCH_IMAGE_MIN_SCORE = float(os.getenv('SEARCH_IMAGE_MIN_SCORE', 0.20))
+    # Batch search: số query tối đa trong một request và k tối đa cho mỗi query
+    SEARCH_BATCH_MAX_QUERIES = int(os.getenv('SEARCH_BATCH_MAX_QUERIES', 1000))
+    SEARCH_BATCH_MAX_K = int(os.getenv('SEARCH_BATCH_MAX_K', 100))
+    # Compaction khi tỉ lệ vector đã xóa (tombstone) vượt ngưỡng
+    FAISS_TOMBSTONE_RATIO = float(os.getenv('FAISS_TOMBSTONE_RATIO', 0.1))
+
+    # Cache query text -> translated text -> embedding
+    QUERY_CACHE_MAX_BYTES = int(os.getenv('QUERY_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+    QUERY_CACHE_TTL = int(os.getenv('QUERY_CACHE_TTL', 3600))
+    QUERY_CACHE_SPILL_PATH = os.getenv('QUERY_CACHE_SPILL_PATH', os.path.join(basedir, 'instance', 'query_cache.npz'))
+    # Cache danh sách kết quả search (theo user + query + version index) để phân trang
+    RESULT_CACHE_MAX_ENTRIES = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', 10000))
+    RESULT_CACHE_TTL = int(os.getenv('RESULT_CACHE_TTL', 600))
+
+    # Translate service client
+    TRANSLATE_SERVICE_URL = os.getenv('TRANSLATE_SERVICE_URL', 'http://127.0.0.1:8080/')
+    TRANSLATE_CONNECT_TIMEOUT = float(os.getenv('TRANSLATE_CONNECT_TIMEOUT', 0.5))
+    TRANSLATE_READ_TIMEOUT = float(os.getenv('TRANSLATE_READ_TIMEOUT', 2.0))
+    TRANSLATE_MAX_RETRIES = int(os.getenv('TRANSLATE_MAX_RETRIES', 1))
+    TRANSLATE_POOL_SIZE = int(os.getenv('TRANSLATE_POOL_SIZE', 10))
+    TRANSLATE_BREAKER_THRESHOLD = int(os.getenv('TRANSLATE_BREAKER_THRESHOLD', 5))
+    TRANSLATE_BREAKER_RESET = float(os.getenv('TRANSLATE_BREAKER_RESET', 30))
+    TRANSLATE_SLOW_THRESHOLD = float(os.getenv('TRANSLATE_SLOW_THRESHOLD', 1.5))
+    # Bỏ qua bước dịch với query không phải tiếng Việt
+    TRANSLATE_SKIP_NON_VIETNAMESE = os.getenv('TRANSLATE_SKIP_NON_VIETNAMESE', 'true').lower() == 'true'
     
     # Email configuration
     MAIL_SERVER = 'smtp.gmail.com'
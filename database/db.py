@@ -3,11 +3,12 @@ import os
 from flask_sqlalchemy import SQLAlchemy
 from pathlib import Path
 from services.ai_service import ai_service
+from config import Config
 import atexit
 
 db = SQLAlchemy()
 
-def init_db(app):
+def init_db(app, start_services=True):
     # Đảm bảo thư mục instance tồn tại
     instance_path = Path(app.instance_path)
     instance_path.mkdir(parents=True, exist_ok=True)
@@ -19,6 +20,10 @@ def init_db(app):
     with app.app_context():
         # Tạo tất cả tables được định nghĩa trong models
         db.create_all()
+        # create_all không thêm index mới vào bảng đã tồn tại
+        from models import ImageEmbedding  # import tại đây để tránh vòng lặp import
+        for index in ImageEmbedding.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
         
         # Log để debug
         db_path = app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', '')        
@@ -27,18 +32,43 @@ def init_db(app):
             print("Database file created successfully!")
         else:
             print("Error: Database file was not created!")
+
+        # Process cha của reloader Werkzeug: không tải index, không chạy thread nền
+        if not start_services:
+            return
         
-        # Đường dẫn file FAISS index
-        faiss_file_path = "faiss_index.bin"
-        
-        # 1) Tải FAISS index từ file
-        ai_service.load_faiss_index(faiss_file_path)
+        # 1) Tải snapshot FAISS index từ file và replay WAL
+        if Config.SEARCH_RERANK:
+            ai_service.open_vector_store()
+        ai_service.load_faiss_index()
         
         # 2) Nếu index rỗng, thì nạp embedding từ DB
         if ai_service.index is None or ai_service.index.ntotal == 0:
             ai_service.load_embeddings_from_db(db.session)
+        # Snapshot + WAL thiếu vector so với DB (process chết trước khi record WAL
+        # xuống đĩa nhưng job đã done): thêm lại các embedding index còn thiếu
+        elif ai_service.indexed_image_count() != ai_service.db_image_count(db.session):
+            _, recovered = ai_service.sync_index_from_db(db.session)
+            if recovered:
+                print(f"Recovered {recovered} embeddings missing from the FAISS index")
+
+        # Bổ sung vector float32 cho re-rank nếu store còn thiếu so với DB
+        if ai_service.vector_store is not None and len(ai_service.vector_store) < ai_service.index.ntotal:
+            ai_service.fill_vector_store(db.session)
+
+        # 3) Dựng map user -> images để lọc search theo user ngay trong FAISS
+        ai_service.load_user_image_map(db.session)
+
+        # 4) Index Flat quá lớn -> chuyển sang ANN (IVF/HNSW) trong nền
+        if ai_service.should_migrate_index():
+            ai_service.start_index_migration(app)
+
+        # 5) Đổi model embedding: re-embed trong nền rồi chuyển (tiếp tục nếu lần trước chưa xong)
+        if Config.EMBEDDING_MODEL_TARGET and Config.EMBEDDING_MODEL_TARGET != ai_service.model_name:
+            from services.model_migration import model_migration  # import tại đây để tránh vòng lặp import
+            model_migration.start(app, Config.EMBEDDING_MODEL_TARGET)
         
         @atexit.register
         def save_faiss_on_exit():
-            faiss_file_path = "faiss_index.bin"
-            ai_service.save_faiss_index(faiss_file_path)
\ No newline at end of file
+            ai_service.close()
+            ai_service.query_cache.save()
\ No newline at end of file
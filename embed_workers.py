@@ -0,0 +1,73 @@
+# embed_workers.py
+"""
+Chạy worker pool sinh embedding (nhiều process) song song với web tier.
+Web tier cần chạy với EMBED_WORKER_MODE=pool để không tự xử lý job và chỉ
+đồng bộ các embedding mới từ DB vào FAISS index.
+
+    python embed_workers.py --workers 8 --torch-threads 4
+"""
+import argparse
+import signal
+import time
+import os
+from flask import Flask
+from config import Config
+from database.db import db
+from services.ai_service import ai_service
+from services.job_queue import job_queue
+from services.worker_pool import EmbeddingWorkerPool
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=Config.EMBED_POOL_WORKERS, help='Số process sinh embedding')
+    parser.add_argument('--torch-threads', type=int, default=Config.EMBED_POOL_TORCH_THREADS,
+                        help='torch.set_num_threads cho mỗi process')
+    parser.add_argument('--batch-size', type=int, default=Config.EMBED_INFERENCE_BATCH_SIZE,
+                        help='Số ảnh mỗi batch gửi cho một process')
+    parser.add_argument('--queue-size', type=int, default=0, help='Số batch tối đa đang xử lý (mặc định 2 x workers)')
+    parser.add_argument('--upload-folder', default=os.path.join(os.getcwd(), 'uploads'))
+    parser.add_argument('--no-sweep', action='store_true', help='Không quét ảnh chưa có embedding khi khởi động')
+    parser.add_argument('--stats-interval', type=float, default=30.0)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    app.config['UPLOAD_FOLDER'] = args.upload_folder
+    db.init_app(app)
+
+    with app.app_context():
+        db.create_all()
+        if not args.no_sweep:
+            queued = job_queue.sweep_unembedded(model=ai_service.model_tag)
+            if queued:
+                print(f"Queued {queued} images without embeddings")
+
+    pool = EmbeddingWorkerPool(
+        app,
+        num_workers=args.workers,
+        torch_threads=args.torch_threads,
+        batch_size=args.batch_size,
+        queue_size=args.queue_size or None
+    )
+    pool.start()
+
+    stopping = []
+    signal.signal(signal.SIGINT, lambda sig, frame: stopping.append(sig))
+    signal.signal(signal.SIGTERM, lambda sig, frame: stopping.append(sig))
+
+    last_stats = time.time()
+    while not stopping:
+        time.sleep(0.5)
+        if time.time() - last_stats >= args.stats_interval:
+            last_stats = time.time()
+            with app.app_context():
+                print(f"written={pool.written} failed={pool.failed} jobs={job_queue.stats()}")
+
+    print("Stopping worker pool, waiting for in-flight batches...")
+    pool.stop()
+    print(f"Worker pool stopped: written={pool.written} failed={pool.failed}")
+
+
+if __name__ == '__main__':
+    main()
@@ -38,6 +38,7 @@ class Image(db.Model):
 
     user = db.relationship("User", back_populates="images")
     embeddings = db.relationship("ImageEmbedding", back_populates="image", cascade="all, delete-orphan")
+    embedding_job = db.relationship("EmbeddingJob", back_populates="image", cascade="all, delete-orphan", uselist=False)
 
 class ImageEmbedding(db.Model):
     __tablename__ = 'image_embeddings'
@@ -49,3 +50,33 @@ class ImageEmbedding(db.Model):
 
     image = db.relationship("Image", back_populates="embeddings")
 
+    __table_args__ = (
+        # Tra embedding theo (ảnh, model): sweep ảnh chưa embed, re-embed sang model mới
+        db.Index('ix_image_embeddings_image_model', 'image_id', 'model'),
+    )
+
+class EmbeddingJob(db.Model):
+    """Job sinh embedding cho một ảnh (queue bền vững, sống qua restart)"""
+    __tablename__ = 'embedding_jobs'
+    __table_args__ = (
+        db.Index('ix_embedding_jobs_state_next_run', 'state', 'next_run_at'),
+    )
+
+    STATE_PENDING = 'pending'
+    STATE_RUNNING = 'running'
+    STATE_DONE = 'done'
+    STATE_FAILED = 'failed'
+
+    job_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    image_id = db.Column(db.Integer, db.ForeignKey('images.image_id'), nullable=False, unique=True)
+    state = db.Column(db.String(20), nullable=False, default=STATE_PENDING)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text)
+    # Worker đang giữ job và thời điểm hết hạn lease (hết hạn -> worker khác được nhận lại)
+    lease_owner = db.Column(db.String(100))
+    lease_expires_at = db.Column(db.DateTime)
+    next_run_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+    updated_at = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
+
+    image = db.relationship("Image", back_populates="embedding_job")
@@ -0,0 +1,123 @@
+# recall_eval.py
+"""
+So sánh recall@k của các kiểu nén vector (index SQ/IVF/PQ/HNSW và định dạng
+lưu blob float16/int8) với baseline Flat float32, dùng embedding trong DB.
+
+    python recall_eval.py --k 10 --queries 200 --sample 100000
+"""
+import argparse
+import time
+import numpy as np
+import faiss
+from flask import Flask
+from config import Config
+from database.db import db
+from services.ai_service import ai_service
+from services.faiss_index import INDEX_TYPES, build_index, search_params
+from services.vector_codec import encode_vector, decode_vectors
+
+
+def load_vectors(limit):
+    ids, chunks, loaded = [], [], 0
+    for chunk_ids, vectors in ai_service._iter_embedding_chunks(db.session):
+        ids.append(chunk_ids)
+        chunks.append(vectors)
+        loaded += len(chunk_ids)
+        if loaded >= limit:
+            break
+    if not chunks:
+        return None, None
+    return np.concatenate(ids)[:limit], np.vstack(chunks)[:limit]
+
+
+def recall_at_k(ground_truth, found):
+    k = ground_truth.shape[1]
+    hits = sum(len(set(gt) & set(f)) for gt, f in zip(ground_truth, found))
+    return hits / (len(ground_truth) * k)
+
+
+def evaluate_index(index_type, base, base_ids, queries, ground_truth, k, args):
+    start = time.time()
+    index = build_index(
+        index_type, base.shape[1], base[:args.train_sample],
+        nlist=args.nlist, pq_m=args.pq_m, hnsw_m=args.hnsw_m
+    )
+    index.add_with_ids(base, base_ids)
+    build_time = time.time() - start
+
+    params = search_params(index, nprobe=args.nprobe, ef_search=args.ef_search)
+    start = time.time()
+    _, found = index.search(queries, k, params=params)
+    latency_ms = (time.time() - start) * 1000 / len(queries)
+
+    return {
+        'recall': recall_at_k(ground_truth, found),
+        'bytes': len(faiss.serialize_index(index)),
+        'build_s': build_time,
+        'latency_ms': latency_ms
+    }
+
+
+def evaluate_storage(fmt, base, base_ids, queries, ground_truth, k):
+    blobs = [encode_vector(vector, fmt) for vector in base]
+    decoded = decode_vectors(blobs, base.shape[1])
+    index = faiss.IndexIDMap(faiss.IndexFlatIP(base.shape[1]))
+    index.add_with_ids(decoded, base_ids)
+    _, found = index.search(queries, k)
+    return {
+        'recall': recall_at_k(ground_truth, found),
+        'bytes_per_vector': len(blobs[0])
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--sample', type=int, default=100000, help='Số vector tối đa đọc từ DB')
+    parser.add_argument('--train-sample', type=int, default=Config.FAISS_TRAIN_SAMPLE)
+    parser.add_argument('--index-types', default=','.join(t for t in INDEX_TYPES if t != 'flat'))
+    parser.add_argument('--storage-formats', default='float16,int8')
+    parser.add_argument('--nlist', type=int, default=Config.FAISS_IVF_NLIST)
+    parser.add_argument('--pq-m', type=int, default=Config.FAISS_PQ_M)
+    parser.add_argument('--hnsw-m', type=int, default=Config.FAISS_HNSW_M)
+    parser.add_argument('--nprobe', type=int, default=Config.FAISS_NPROBE)
+    parser.add_argument('--ef-search', type=int, default=Config.FAISS_EF_SEARCH)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    db.init_app(app)
+
+    with app.app_context():
+        ids, vectors = load_vectors(args.sample + args.queries)
+    if vectors is None or len(vectors) <= args.queries:
+        print("Not enough embeddings in the database.")
+        return
+
+    # Giữ riêng một phần vector làm query (không nằm trong tập được index)
+    queries = np.ascontiguousarray(vectors[-args.queries:])
+    base, base_ids = np.ascontiguousarray(vectors[:-args.queries]), ids[:-args.queries]
+    k = min(args.k, len(base))
+
+    baseline = faiss.IndexIDMap(faiss.IndexFlatIP(base.shape[1]))
+    baseline.add_with_ids(base, base_ids)
+    _, ground_truth = baseline.search(queries, k)
+    baseline_bytes = len(faiss.serialize_index(baseline))
+
+    print(f"{len(base)} vectors, {len(queries)} queries, recall@{k} vs Flat float32 "
+          f"({baseline_bytes / 1e6:.1f} MB)")
+    print(f"{'index':<10} {'recall':>8} {'size MB':>9} {'ratio':>7} {'build s':>8} {'ms/query':>9}")
+    for index_type in filter(None, args.index_types.split(',')):
+        result = evaluate_index(index_type, base, base_ids, queries, ground_truth, k, args)
+        print(f"{index_type:<10} {result['recall']:>8.4f} {result['bytes'] / 1e6:>9.1f} "
+              f"{baseline_bytes / result['bytes']:>6.1f}x {result['build_s']:>8.2f} {result['latency_ms']:>9.3f}")
+
+    print(f"\n{'storage':<10} {'recall':>8} {'bytes/vec':>10}")
+    for fmt in filter(None, args.storage_formats.split(',')):
+        result = evaluate_storage(fmt, base, base_ids, queries, ground_truth, k)
+        print(f"{fmt:<10} {result['recall']:>8.4f} {result['bytes_per_vector']:>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,14 @@
 # routes/images.py
 from flask import Blueprint, request, jsonify, current_app, send_from_directory
 from database.db import db
-from models import Image
+from models import Image, ImageEmbedding
 from utils.file_handler import FileHandler
 from routes.auth import token_required
 import os
 from services.task_handler import task_handler
+from services.job_queue import job_queue
+from services.model_migration import model_migration
+from services.ai_service import ai_service
 
 images_bp = Blueprint('images', __name__)
 
@@ -78,7 +81,6 @@ def upload_image(current_user):
         
         task_handler.add_task(
             'generate_embedding',
-            app=current_app._get_current_object(),
             image_id=new_image.image_id
         )
         
@@ -139,6 +141,7 @@ def update_image(current_user, image_id):
             image.description = request.form['description']
             
         # Handle file update if present
+        file_replaced = False
         if 'file' in request.files:
             file = request.files['file']
             
@@ -154,8 +157,20 @@ def update_image(current_user, image_id):
             # Save new file
             relative_path = FileHandler.save_file(file, upload_folder)
             image.file_path = relative_path
+
+            # Embedding cũ không còn đúng với file mới
+            ImageEmbedding.query.filter_by(image_id=image.image_id).delete()
+            file_replaced = True
             
         db.session.commit()
+
+        if file_replaced:
+            # Tombstone vector cũ và embed lại file mới
+            ai_service.remove_from_index([image.image_id])
+            task_handler.add_task(
+                'generate_embedding',
+                image_id=image.image_id
+            )
         
         return jsonify({
             'message': 'Image updated successfully',
@@ -192,6 +207,11 @@ def delete_image(current_user, image_id):
         # Delete database record
         db.session.delete(image)
         db.session.commit()
+
+        # Tombstone vector trong FAISS, compaction khi tỉ lệ xóa vượt ngưỡng
+        ai_service.remove_from_index([image_id])
+        if ai_service.should_compact_index():
+            ai_service.start_index_compaction(current_app._get_current_object())
         
         return jsonify({'message': 'Image deleted successfully'})
         
@@ -237,13 +257,11 @@ def upload_multiple_images(current_user):
         # 2. Commit tất cả records một lần
         db.session.commit()
 
-        # 3. Tạo tasks cho batch processing
-        for image in results:
-            task_handler.add_task(
-                'generate_embedding',
-                app=current_app._get_current_object(),
-                image_id=image.image_id
-            )
+        # 3. Tạo job cho cả batch trong một lần ghi
+        task_handler.add_task(
+            'generate_embedding',
+            image_ids=[image.image_id for image in results]
+        )
 
         return jsonify({
             'message': 'Images uploaded successfully. Processing embeddings...',
@@ -307,7 +325,6 @@ def upload_multiple_images(current_user):
             # 4) Tạo task sinh embedding
             task_handler.add_task(
                 'generate_embedding',
-                app=current_app._get_current_object(),
                 image_id=new_image.image_id
             )
 
@@ -329,4 +346,13 @@ def upload_multiple_images(current_user):
 
     except Exception as e:
         db.session.rollback()
-        return jsonify({'message': 'Error uploading images', 'error': str(e)}), 500
\ No newline at end of file
+        return jsonify({'message': 'Error uploading images', 'error': str(e)}), 500
+@images_bp.route('/embedding/stats', methods=['GET'])
+@token_required
+def embedding_stats(current_user):
+    """Trạng thái queue job embedding, quyết định hiện tại của adaptive batcher và tiến độ đổi model"""
+    return jsonify({
+        'jobs': job_queue.stats(),
+        'batcher': task_handler.batcher.stats(),
+        'model': model_migration.stats()
+    })
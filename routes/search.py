@@ -1,74 +1,100 @@
 # routes/search.py
 from flask import Blueprint, request, jsonify, current_app
 from services.ai_service import ai_service
-from models import Image, ImageEmbedding
+from services.translate_client import translate_client
+from services.result_hydrator import rank_hits, build_page, hydrate_batch
+from services.result_cache import result_cache, query_fingerprint, encode_cursor, decode_cursor
 from routes.auth import token_required
-import numpy as np
+from database.db import db
+from models import Image
+from config import Config
 from PIL import Image as PILImage
+import numpy as np
+import base64
+import json
+import io
 
 search_bp = Blueprint('search', __name__)
 
+def _find_hits(query_embedding, user_id, min_score, k=100):
+    """
+    min_score != None: lấy mọi ảnh có score >= min_score (range search).
+    Ngược lại: top k ảnh gần nhất. Trả về (hits, total).
+    """
+    if min_score is None:
+        hits = ai_service.search_similar(query_embedding, k=k, user_id=user_id)
+        return hits, None
+    return ai_service.range_search_similar(query_embedding, min_score, user_id=user_id)
+
+def _paged_search(user_id, fingerprint, run_search, page, per_page):
+    """
+    Trả về một trang kết quả, dùng lại danh sách id đã xếp hạng trong cache
+    nếu index của user chưa đổi. Trang tiếp theo lấy bằng cursor (?cursor=...);
+    run_search=None nghĩa là request chỉ có cursor, không thể search lại.
+    """
+    if per_page is None or per_page < 1:
+        return jsonify({'message': 'Invalid per_page'}), 400
+    per_page = min(per_page, Config.SEARCH_MAX_PER_PAGE)
+    offset = (max(page or 1, 1) - 1) * per_page
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            cursor_fingerprint, _, offset, per_page = decode_cursor(cursor)
+        except ValueError:
+            return jsonify({'message': 'Invalid cursor'}), 400
+        per_page = min(per_page, Config.SEARCH_MAX_PER_PAGE)
+        if fingerprint is None:
+            fingerprint = cursor_fingerprint
+        elif fingerprint != cursor_fingerprint:
+            return jsonify({'message': 'Cursor does not match the search query'}), 400
+
+    version = ai_service.index_version(user_id)
+    cached = result_cache.get(user_id, fingerprint, version)
+    if cached is None:
+        if run_search is None:
+            return jsonify({'message': 'Cursor expired, please repeat the search'}), 410
+        hits, total = run_search()
+        ranked, total = rank_hits(user_id, hits, total)
+        cached = result_cache.put(user_id, fingerprint, version, ranked, total)
+
+    # Chỉ lấy thông tin ảnh của trang hiện tại
+    ids, scores, total = cached
+    response = build_page(user_id, ids, scores, total, offset, per_page)
+    next_offset = offset + per_page
+    response['pagination']['next_cursor'] = (
+        encode_cursor(fingerprint, version, next_offset, per_page) if next_offset < len(ids) else None
+    )
+    return jsonify(response)
+
 @search_bp.route('/text', methods=['POST'])
 @token_required
 def search_by_text(current_user):
     try:
-        data = request.get_json()
-        if not data or 'query' not in data:
+        data = request.get_json(silent=True) or {}
+        if 'query' not in data and not request.args.get('cursor'):
             return jsonify({'message': 'No search query provided'}), 400
 
         # Lấy tham số phân trang
         page = request.args.get('page', 1, type=int)
         per_page = request.args.get('per_page', 12, type=int)
 
-        # Tạo embedding cho text
-        query_embedding = ai_service.get_text_embedding(data['query'])
-
-        # Tìm tất cả ảnh tương tự
-        all_results = ai_service.search_similar(query_embedding, k=1)  # Lấy nhiều kết quả hơn
-        print('all_results: ', all_results)
-        if not all_results:
-            return jsonify({
-                'results': [],
-                'pagination': {
-                    'total': 0,
-                    'pages': 0,
-                    'current_page': page,
-                    'per_page': per_page
-                }
-            })
-
-        # Lọc kết quả theo user_id
-        filtered_results = []
-        for idx, score in all_results:
-            image = Image.query.get(int(idx))
-            print('image: ', image)
-            print('check id: ',image.user_id, current_user.user_id)
-
-            if image and image.user_id == current_user.user_id:
-                filtered_results.append({
-                    'image_id': image.image_id,
-                    'title': image.title,
-                    'description': image.description,
-                    'file_path': image.file_path,
-                    'similarity_score': float(score)
-                })
-
-        # Tính toán phân trang
-        total = len(filtered_results)
-        total_pages = (total + per_page - 1) // per_page
-        start_idx = (page - 1) * per_page
-        end_idx = start_idx + per_page
-
-        print('total: ', total)
-        return jsonify({
-            'results': filtered_results[start_idx:end_idx],
-            'pagination': {
-                'total': total,
-                'pages': total_pages,
-                'current_page': page,
-                'per_page': per_page
-            }
-        })
+        try:
+            min_score = data.get('min_score', request.args.get('min_score', type=float))
+            min_score = None if min_score is None else float(min_score)
+        except (TypeError, ValueError):
+            return jsonify({'message': 'Invalid min_score'}), 400
+
+        if 'query' not in data:
+            return _paged_search(current_user.user_id, None, None, page, per_page)
+
+        def run_search():
+            # Tạo embedding cho text
+            query_embedding = ai_service.get_text_embedding(data['query'])
+            # Tìm ảnh tương tự, chỉ trong ảnh của user hiện tại
+            return _find_hits(query_embedding, current_user.user_id, min_score)
+
+        fingerprint = query_fingerprint('text', data['query'], min_score)
+        return _paged_search(current_user.user_id, fingerprint, run_search, page, per_page)
 
     except Exception as e:
         return jsonify({'message': 'Error performing search', 'error': str(e)}), 500
@@ -76,63 +102,167 @@ def search_by_text(current_user):
 @token_required
 def search_by_image(current_user):
     try:
-        if 'file' not in request.files:
+        if 'file' not in request.files and not request.args.get('cursor'):
             return jsonify({'message': 'No image file uploaded'}), 400
 
         # Lấy tham số phân trang
         page = request.args.get('page', 1, type=int)
         per_page = request.args.get('per_page', 12, type=int)
 
-        file = request.files['file']
-        uploaded_image = PILImage.open(file)
-
-        # Tạo embedding cho ảnh upload
-        query_embedding = ai_service.get_image_embedding(uploaded_image)
-
-        # Tìm ảnh tương tự
-        all_results = ai_service.search_similar(query_embedding, k=100)  # Lấy nhiều kết quả hơn
-        if not all_results:
-            return jsonify({
-                'results': [],
-                'pagination': {
-                    'total': 0,
-                    'pages': 0,
-                    'current_page': page,
-                    'per_page': per_page
-                }
-            })
-
-        # Lọc kết quả theo user_id và similarity threshold
-        similarity_threshold = 0.20
-        filtered_results = []
-
-        for idx, score in all_results:
-            image = Image.query.get(int(idx))
-            if image and image.user_id == current_user.user_id:
-                if score >= similarity_threshold:
-                    filtered_results.append({
-                        'image_id': image.image_id,
-                        'title': image.title,
-                        'description': image.description,
-                        'file_path': image.file_path,
-                        'similarity_score': float(score)
-                    })
-
-        # Tính toán phân trang
-        total = len(filtered_results)
-        total_pages = (total + per_page - 1) // per_page
-        start_idx = (page - 1) * per_page
-        end_idx = start_idx + per_page
-
-        return jsonify({
-            'results': filtered_results[start_idx:end_idx],
-            'pagination': {
-                'total': total,
-                'pages': total_pages,
-                'current_page': page,
-                'per_page': per_page
+        try:
+            min_score = float(request.values.get('min_score', Config.SEARCH_IMAGE_MIN_SCORE))
+        except ValueError:
+            return jsonify({'message': 'Invalid min_score'}), 400
+
+        if 'file' not in request.files:
+            return _paged_search(current_user.user_id, None, None, page, per_page)
+
+        image_bytes = request.files['file'].read()
+
+        def run_search():
+            # Tạo embedding cho ảnh upload
+            query_embedding = ai_service.get_image_embedding(PILImage.open(io.BytesIO(image_bytes)))
+            # Tìm mọi ảnh của user hiện tại có score >= min_score
+            return _find_hits(query_embedding, current_user.user_id, min_score)
+
+        fingerprint = query_fingerprint('image', image_bytes, min_score)
+        return _paged_search(current_user.user_id, fingerprint, run_search, page, per_page)
+
+    except Exception as e:
+        return jsonify({'message': 'Error performing search', 'error': str(e)}), 500
+
+@search_bp.route('/similar/<int:image_id>', methods=['GET'])
+@token_required
+def search_similar_image(current_user, image_id):
+    """Tìm ảnh giống một ảnh đã có trong thư viện bằng vector đã lưu (không encode lại)"""
+    try:
+        image = Image.query.filter_by(image_id=image_id, user_id=current_user.user_id).first()
+        if not image:
+            return jsonify({'message': 'Image not found'}), 404
+
+        # Lấy tham số phân trang
+        page = request.args.get('page', 1, type=int)
+        per_page = request.args.get('per_page', 12, type=int)
+        min_score = request.args.get('min_score', type=float)
+
+        query_embedding = ai_service.get_stored_embedding(image_id, db.session)
+        if query_embedding is None:
+            return jsonify({'message': 'Image has not been embedded yet'}), 409
+
+        def run_search():
+            # Bỏ chính ảnh query khỏi kết quả
+            hits, total = _find_hits(query_embedding, current_user.user_id, min_score, k=101)
+            filtered = [(idx, score) for idx, score in hits if int(idx) != image_id]
+            if total is not None:
+                total -= len(hits) - len(filtered)
+            return filtered, total
+
+        fingerprint = query_fingerprint('similar', image_id, min_score)
+        return _paged_search(current_user.user_id, fingerprint, run_search, page, per_page)
+
+    except Exception as e:
+        return jsonify({'message': 'Error performing search', 'error': str(e)}), 500
+
+def _parse_batch_queries():
+    """
+    Đọc danh sách query của batch search, trả về (queries, options).
+    - JSON: {"queries": [{"text": "..."} | {"image": "<base64>"}], "k": 10, "min_score": 0.2}
+    - multipart: field "queries" là JSON như trên, ảnh dạng {"file": "<tên field file>"}
+    """
+    if request.files or request.form:
+        queries = json.loads(request.form.get('queries', '[]'))
+        options = request.form
+    else:
+        data = request.get_json(silent=True) or {}
+        queries = data.get('queries', [])
+        options = data
+    if not isinstance(queries, list):
+        raise ValueError('queries must be a list')
+    return queries, options
+
+def _load_query_image(query):
+    if 'file' in query:
+        if query['file'] not in request.files:
+            raise ValueError(f"Missing file field '{query['file']}'")
+        return PILImage.open(request.files[query['file']])
+    return PILImage.open(io.BytesIO(base64.b64decode(query['image'])))
+
+@search_bp.route('/batch', methods=['POST'])
+@token_required
+def search_batch(current_user):
+    """
+    Search nhiều query text/ảnh trong một request: encode theo batch rồi
+    chạy một lần FAISS search trên ma trận query.
+    """
+    try:
+        try:
+            queries, options = _parse_batch_queries()
+            k = min(int(options.get('k', 10)), Config.SEARCH_BATCH_MAX_K)
+            min_score = options.get('min_score')
+            min_score = None if min_score is None else float(min_score)
+        except (TypeError, ValueError) as e:
+            return jsonify({'message': 'Invalid batch search request', 'error': str(e)}), 400
+
+        if not queries:
+            return jsonify({'message': 'No search queries provided'}), 400
+        if len(queries) > Config.SEARCH_BATCH_MAX_QUERIES:
+            return jsonify({'message': f'Too many queries (max {Config.SEARCH_BATCH_MAX_QUERIES})'}), 400
+
+        # Tách query text / ảnh, ghi lại lỗi riêng cho từng query không hợp lệ
+        errors = {}
+        text_positions, texts = [], []
+        image_positions, images = [], []
+        for position, query in enumerate(queries):
+            if not isinstance(query, dict):
+                errors[position] = 'Query must be an object'
+            elif 'text' in query:
+                text_positions.append(position)
+                texts.append(str(query['text']))
+            elif 'image' in query or 'file' in query:
+                try:
+                    images.append(_load_query_image(query))
+                    image_positions.append(position)
+                except Exception as e:
+                    errors[position] = f'Invalid image: {str(e)}'
+            else:
+                errors[position] = 'Query must have "text", "image" or "file"'
+
+        # Encode theo batch rồi search một lần trên toàn bộ ma trận query
+        embeddings = []
+        if texts:
+            embeddings.append(ai_service.get_text_embeddings(texts))
+        if images:
+            embeddings.append(ai_service.get_image_embeddings(images))
+        positions = text_positions + image_positions
+
+        hits_per_query = []
+        if positions:
+            hits_per_query = ai_service.search_similar_batch(np.vstack(embeddings), k=k, user_id=current_user.user_id)
+            if min_score is not None:
+                hits_per_query = [[(idx, score) for idx, score in hits if score >= min_score] for hits in hits_per_query]
+
+        results = [None] * len(queries)
+        for position, hits in zip(positions, hydrate_batch(current_user.user_id, hits_per_query)):
+            results[position] = {
+                'query_index': position,
+                'type': 'text' if 'text' in queries[position] else 'image',
+                'results': hits
             }
-        })
+        for position, error in errors.items():
+            results[position] = {'query_index': position, 'error': error, 'results': []}
+
+        return jsonify({'results': results})
 
     except Exception as e:
-        return jsonify({'message': 'Error performing search', 'error': str(e)}), 500
\ No newline at end of file
+        return jsonify({'message': 'Error performing batch search', 'error': str(e)}), 500
+
+@search_bp.route('/stats', methods=['GET'])
+@token_required
+def search_stats(current_user):
+    """Số liệu của các lớp cache / gom request phía search"""
+    return jsonify({
+        'coalescing': ai_service.coalescing_stats(),
+        'query_cache': ai_service.query_cache.stats(),
+        'result_cache': result_cache.stats(),
+        'translate': translate_client.metrics()
+    })
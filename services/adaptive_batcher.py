@@ -0,0 +1,159 @@
+# services/adaptive_batcher.py
+from collections import deque
+import threading
+import time
+from config import Config
+
+
+class AdaptiveBatcher:
+    """
+    Chọn kích thước batch embedding theo thời gian inference đo được và độ dài
+    queue thay vì batch_size/timeout cố định:
+      - mô hình thời gian một batch: overhead + n * per_item (ước lượng online,
+        hồi quy tuyến tính với trọng số giảm dần theo thời gian)
+      - queue ngắn: batch lớn nhất vẫn xong trong latency_slo, chỉ chờ gom thêm
+        khi còn dư thời gian so với SLO (tối đa max_wait)
+      - queue dài (bulk import): batch lớn nhất theo giới hạn bộ nhớ, không chờ
+    """
+
+    def __init__(self, latency_slo=1.0, max_wait=0.2, max_batch_bytes=512 * 1024 * 1024,
+                 item_bytes=16 * 1024 * 1024, max_batch_size=256, initial_batch_size=32, decay=0.9):
+        self.latency_slo = latency_slo
+        self.max_wait = max_wait
+        self.max_batch_bytes = max_batch_bytes
+        self.item_bytes = item_bytes
+        self.max_batch_size = max_batch_size
+        self.initial_batch_size = initial_batch_size
+        self.decay = decay
+        self._lock = threading.Lock()
+
+        # Trung bình có trọng số của n, t, n*n, n*t cho hồi quy t = overhead + per_item * n
+        self._weight = 0.0
+        self._sum_n = self._sum_t = self._sum_nn = self._sum_nt = 0.0
+        self._latencies = deque(maxlen=1000)
+        self.batches = 0
+        self.items = 0
+        self.last_decision = None
+
+    def record_batch(self, n_items, seconds):
+        """Ghi nhận thời gian inference của một batch n_items ảnh"""
+        if n_items <= 0:
+            return
+        with self._lock:
+            d = self.decay
+            self._weight = self._weight * d + 1.0
+            self._sum_n = self._sum_n * d + n_items
+            self._sum_t = self._sum_t * d + seconds
+            self._sum_nn = self._sum_nn * d + n_items * n_items
+            self._sum_nt = self._sum_nt * d + n_items * seconds
+            self.batches += 1
+            self.items += n_items
+
+    def record_latency(self, seconds):
+        """Thời gian từ lúc job được nhận tới lúc embedding đã vào index"""
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def _cost_model(self):
+        """(overhead, per_item) giây; None nếu chưa có số đo"""
+        if self._weight == 0:
+            return None
+        mean_n = self._sum_n / self._weight
+        mean_t = self._sum_t / self._weight
+        var_n = self._sum_nn / self._weight - mean_n * mean_n
+        if var_n > 1e-6:
+            per_item = (self._sum_nt / self._weight - mean_n * mean_t) / var_n
+            overhead = mean_t - per_item * mean_n
+            if per_item > 0 and overhead >= 0:
+                return overhead, per_item
+        # Chưa đủ batch với kích thước khác nhau -> coi toàn bộ là chi phí theo ảnh
+        return 0.0, mean_t / max(mean_n, 1e-9)
+
+    def predict(self, n_items):
+        """Thời gian inference dự kiến cho batch n_items ảnh (None nếu chưa có số đo)"""
+        with self._lock:
+            model = self._cost_model()
+        if model is None:
+            return None
+        overhead, per_item = model
+        return overhead + per_item * n_items
+
+    def plan(self, queue_depth, waited=0.0):
+        """
+        Quyết định cho batch tiếp theo. queue_depth: số ảnh đang chờ (kể cả đã
+        nhận vào batch hiện tại), waited: thời gian ảnh đầu tiên của batch đã chờ.
+        Trả về (batch_size, max_wait): gửi batch khi đủ batch_size ảnh hoặc khi
+        ảnh đầu tiên đã chờ quá max_wait giây.
+        """
+        memory_cap = max(1, min(self.max_batch_size, self.max_batch_bytes // max(self.item_bytes, 1)))
+        with self._lock:
+            model = self._cost_model()
+
+        if model is None:
+            latency_cap = min(self.initial_batch_size, memory_cap)
+            max_wait = self.max_wait
+            reason = 'warmup'
+        else:
+            overhead, per_item = model
+            # Batch lớn nhất vẫn xong trong phần SLO còn lại
+            budget = max(self.latency_slo - waited - overhead, 0.0)
+            latency_cap = max(1, min(int(budget / per_item), memory_cap))
+            # Chỉ chờ gom thêm khi batch hiện tại xong sớm hơn SLO
+            slack = self.latency_slo - (overhead + per_item * max(queue_depth, 1))
+            max_wait = max(0.0, min(self.max_wait, slack))
+            reason = 'latency'
+
+        if queue_depth > latency_cap:
+            # Backlog dài: ưu tiên throughput, batch lớn nhất bộ nhớ cho phép
+            batch_size, max_wait, reason = memory_cap, 0.0, 'backlog'
+        else:
+            batch_size = latency_cap
+
+        decision = {
+            'batch_size': batch_size,
+            'max_wait': max_wait,
+            'queue_depth': queue_depth,
+            'waited': waited,
+            'memory_cap': memory_cap,
+            'reason': reason,
+            'at': time.time()
+        }
+        with self._lock:
+            self.last_decision = decision
+        return batch_size, max_wait
+
+    def stats(self):
+        with self._lock:
+            model = self._cost_model()
+            latencies = sorted(self._latencies)
+            decision = dict(self.last_decision) if self.last_decision else None
+            batches, items = self.batches, self.items
+
+        def percentile(p):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+        return {
+            'latency_slo': self.latency_slo,
+            'overhead_ms': model[0] * 1000 if model else None,
+            'per_item_ms': model[1] * 1000 if model else None,
+            'batches': batches,
+            'items': items,
+            'avg_batch_size': items / batches if batches else 0.0,
+            'latency_p50': percentile(0.50),
+            'latency_p95': percentile(0.95),
+            'latency_p99': percentile(0.99),
+            'last_decision': decision
+        }
+
+
+# Singleton instance
+embedding_batcher = AdaptiveBatcher(
+    latency_slo=Config.EMBED_LATENCY_SLO,
+    max_wait=Config.EMBED_BATCH_MAX_WAIT,
+    max_batch_bytes=Config.EMBED_BATCH_MAX_MEMORY_MB * 1024 * 1024,
+    item_bytes=int(Config.EMBED_BATCH_ITEM_MB * 1024 * 1024),
+    max_batch_size=Config.EMBED_BATCH_MAX_SIZE,
+    initial_batch_size=Config.EMBED_INFERENCE_BATCH_SIZE
+)
@@ -1,15 +1,63 @@
 import torch
 from PIL import Image
 import numpy as np
-from transformers import CLIPProcessor, CLIPModel
+from transformers import CLIPProcessor, CLIPModel, CLIPConfig
 import faiss
 import threading
-import os
+import time
 import json
-import requests
+import os
+from config import Config
+from services.query_cache import QueryEmbeddingCache, normalize_query
+from services.single_flight import SingleFlight
+from services.rw_lock import ReadWriteLock
+from services.translate_client import translate_client
+from services.lang_detect import is_vietnamese
+from services.faiss_index import (
+    BASE_INDEX_TYPES, build_index, index_kind, index_type_name, search_params
+)
+from services.vector_codec import decode_vectors
+from services.vector_store import MmapVectorStore
+from services.index_wal import VectorWAL, OP_ADD, OP_DELETE
 
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 
+
+def model_tag(model_name):
+    """Tên lưu ở cột image_embeddings.model, vd 'openai/clip-vit-large-patch14' -> 'clip-vit-large-patch14'"""
+    return model_name.rstrip('/').split('/')[-1]
+
+
+def read_model_state():
+    """
+    Model đang dùng và các file index/WAL/vector store của nó. Mặc định là
+    EMBEDDING_MODEL với đường dẫn trong config; sau khi chuyển model, file
+    EMBEDDING_MODEL_STATE_PATH ghi đè.
+    """
+    state = {
+        'model_name': Config.EMBEDDING_MODEL,
+        'index_path': Config.FAISS_INDEX_PATH,
+        'wal_path': Config.FAISS_WAL_PATH,
+        'vector_store_path': Config.VECTOR_STORE_PATH
+    }
+    if os.path.exists(Config.EMBEDDING_MODEL_STATE_PATH):
+        with open(Config.EMBEDDING_MODEL_STATE_PATH, encoding='utf-8') as f:
+            state.update(json.load(f))
+    return state
+
+
+def model_state_for(model_name):
+    """Đường dẫn riêng cho index/WAL/vector store của một model (không dùng chung file với model cũ)"""
+    tag = model_tag(model_name)
+    index_root, index_ext = os.path.splitext(Config.FAISS_INDEX_PATH)
+    wal_root, wal_ext = os.path.splitext(Config.FAISS_WAL_PATH)
+    return {
+        'model_name': model_name,
+        'index_path': f"{index_root}.{tag}{index_ext}",
+        'wal_path': f"{wal_root}.{tag}{wal_ext}",
+        'vector_store_path': f"{Config.VECTOR_STORE_PATH}.{tag}"
+    }
+
 class AIService:
     _instance = None
     _lock = threading.Lock()
@@ -21,101 +69,495 @@ class AIService:
                     cls._instance = super(AIService, cls).__new__(cls)
                     cls._instance.model = None
                     cls._instance.processor = None
+                    cls._instance.model_state = read_model_state()
+                    # Re-embed sang model mới đang chạy (ModelMigration), nhận các ảnh bị xóa trong lúc đó
+                    cls._instance.reembedding = None
                     cls._instance.index = None
+                    cls._instance.index_path = cls._instance.model_state['index_path']
+                    cls._instance.wal = None
+                    # Vector float32 chính xác để re-rank (None nếu không bật)
+                    cls._instance.vector_store = None
+                    # Index đang được mmap read-only từ snapshot (chưa bị sửa)
+                    cls._instance.index_mmapped = False
+                    # user_id -> set(image_id) đã có trong index, dùng để lọc search theo user
+                    cls._instance.user_image_ids = {}
+                    cls._instance._user_map_lock = threading.Lock()
+                    # Version của index (toàn cục + theo user) để invalidate cache kết quả search
+                    cls._instance.index_epoch = 0
+                    cls._instance.user_versions = {}
+                    # FAISS không an toàn khi add và search đồng thời: search lấy quyền
+                    # đọc (chạy song song), add/remove/thay index lấy quyền ghi
+                    cls._instance._index_lock = ReadWriteLock()
+                    # Mỗi lúc chỉ một snapshot được ghi ra file
+                    cls._instance._snapshot_lock = threading.Lock()
+                    cls._instance.nprobe = Config.FAISS_NPROBE
+                    cls._instance.ef_search = Config.FAISS_EF_SEARCH
+                    cls._instance.index_migrating = False
+                    cls._instance.index_compacting = False
+                    # Các image_id đã bị xóa nhưng vector vẫn còn trong index
+                    cls._instance.tombstones = set()
+                    cls._instance._migration_buffer = None
+                    cls._instance.query_cache = QueryEmbeddingCache(
+                        max_bytes=Config.QUERY_CACHE_MAX_BYTES,
+                        ttl=Config.QUERY_CACHE_TTL,
+                        spill_path=Config.QUERY_CACHE_SPILL_PATH
+                    )
+                    # Gom các request giống nhau đang chạy đồng thời (translate + encode, search)
+                    cls._instance.text_flight = SingleFlight('text_embedding')
+                    cls._instance.search_flight = SingleFlight('search')
                     # Nếu có GPU và đủ VRAM, dùng CUDA
                     cls._instance.device = "cuda" if torch.cuda.is_available() else "cpu"
         return cls._instance
 
+    @property
+    def model_name(self):
+        return self.model_state['model_name']
+
+    @property
+    def model_tag(self):
+        return model_tag(self.model_name)
+
+    @property
+    def dimension(self):
+        """Số chiều embedding của model đang dùng (không cần load model)"""
+        if self.model is not None:
+            return self.model.config.projection_dim
+        if self.index is not None:
+            return self.index.d
+        if 'dimension' not in self.model_state:
+            # Chỉ tải config.json của model
+            self.model_state['dimension'] = CLIPConfig.from_pretrained(self.model_name, revision="main").projection_dim
+        return self.model_state['dimension']
+
+    def load_clip(self, model_name):
+        """Load một CLIP model + processor (không gán vào service)"""
+        model = CLIPModel.from_pretrained(model_name, revision="main")
+        processor = CLIPProcessor.from_pretrained(model_name, revision="main")
+        model.to(self.device)
+        return model, processor
+
     def load_model(self):
         """Lazy load CLIP model"""
         if self.model is None:
             try:
-                # Dùng mô hình lớn hơn: clip-vit-large-patch14
-                self.model = CLIPModel.from_pretrained("openai/clip-vit-large-patch14", revision="main")
-                self.processor = CLIPProcessor.from_pretrained("openai/clip-vit-large-patch14", revision="main")
-                self.model.to(self.device)
-                print(f"CLIP model (ViT-L/14) loaded successfully on {self.device}")
+                self.model, self.processor = self.load_clip(self.model_name)
+                print(f"CLIP model ({self.model_name}) loaded successfully on {self.device}")
             except Exception as e:
                 print(f"Error loading CLIP model: {str(e)}")
                 raise
 
+    def refresh_active_model(self):
+        """
+        Process khác (web tier) đã chuyển sang model mới: đọc lại file state và
+        load model mới nếu process này đã load model. Trả về True nếu có đổi.
+        """
+        state = read_model_state()
+        if state['model_name'] == self.model_name:
+            return False
+        loaded = self.model is not None
+        self.model_state = state
+        self.model = self.processor = None
+        if loaded:
+            self.load_model()
+        print(f"Switched embedding model to {self.model_name}")
+        return True
+
+    def open_image(self, image_path_or_object):
+        """Mở ảnh từ đường dẫn hoặc PIL.Image và chuyển sang RGB"""
+        if isinstance(image_path_or_object, str):
+            return Image.open(image_path_or_object).convert("RGB")
+        return image_path_or_object.convert("RGB")
+
+    @staticmethod
+    def _normalize_rows(matrix):
+        """Chuẩn hóa L2 từng dòng của ma trận embedding (vectorized)"""
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
     def get_image_embedding(self, image_path_or_object):
         """
         Generate embedding for an image (có thể là đường dẫn hoặc PIL.Image).
         """
         try:
+            return self.get_image_embeddings([image_path_or_object], batch_size=1)[0]
+        except Exception as e:
+            print(f"Error generating image embedding: {str(e)}")
+            raise
+
+    def preprocess_images(self, images, processor=None):
+        """
+        Decode + preprocess một nhóm ảnh thành tensor pixel_values (chạy trên CPU).
+        Tách riêng để pipeline có thể chạy bước này song song với inference.
+        processor: dùng processor của model khác (re-embed), mặc định model hiện tại.
+        """
+        if processor is None:
+            self.load_model()  # processor được load cùng model
+            processor = self.processor
+        pil_images = [self.open_image(img) for img in images]
+        return processor(images=pil_images, return_tensors="pt")["pixel_values"]
+
+    def encode_pixel_values(self, pixel_values, model=None):
+        """Chạy image tower trên tensor đã preprocess, trả về ma trận đã chuẩn hóa"""
+        if model is None:
             self.load_model()  # Ensure model is loaded
-            
-            # Nếu truyền vào là đường dẫn, mở ảnh bằng PIL
-            if isinstance(image_path_or_object, str):
-                image = Image.open(image_path_or_object).convert("RGB")
-            else:
-                image = image_path_or_object.convert("RGB")
+            model = self.model
+        with torch.no_grad():
+            image_features = model.get_image_features(
+                pixel_values=pixel_values.to(self.device)
+            )
+        return self._normalize_rows(image_features.cpu().numpy())
+
+    def get_image_embeddings(self, images, batch_size=32):
+        """
+        Generate embeddings cho nhiều ảnh (đường dẫn hoặc PIL.Image).
+        Mỗi mini-batch được preprocess thành một tensor và chạy một lần
+        get_image_features. Trả về ma trận float32 (len(images), dim) đã chuẩn hóa.
+        """
+        try:
+            self.load_model()  # Ensure model is loaded
+
+            batches = []
+            for start in range(0, len(images), batch_size):
+                pixel_values = self.preprocess_images(images[start:start + batch_size])
+                batches.append(self.encode_pixel_values(pixel_values))
+
+            if not batches:
+                return np.empty((0, self.model.config.projection_dim), dtype=np.float32)
+
+            return np.vstack(batches)
 
-            inputs = self.processor(images=image, return_tensors="pt").to(self.device)
-            
-            with torch.no_grad():
-                image_features = self.model.get_image_features(**inputs)
-            
-            # Chuyển sang numpy, chuẩn hóa vector
-            embedding = image_features.cpu().numpy()[0]
-            embedding = embedding / np.linalg.norm(embedding)
-            
-            return embedding
-            
         except Exception as e:
-            print(f"Error generating image embedding: {str(e)}")
+            print(f"Error generating image embeddings: {str(e)}")
             raise
 
     def get_text_embedding(self, text):
-        """Generate embedding for text query"""
+        """
+        Generate embedding for text query. Các request cùng query đến đồng thời
+        chỉ dịch + encode một lần và dùng chung kết quả.
+        """
         try:
-            self.load_model()  # Ensure model is loaded
-            
-            # make request to translate_service
-            _reponse = requests.post(url = "http://127.0.0.1:8080/", 
-                         json = json.dumps({'query': text},ensure_ascii= False), 
-                         headers= {'Content-Type': 'application/json'}
-            )
-            translated_text = _reponse.json()['translated_text'].lower()
-            print('translated_text: ', translated_text)
-            inputs = self.processor(
-                text=[translated_text],
-                return_tensors="pt",
-                padding=True,
-                truncation=True,      # <-- Bắt buộc (quan trọng)
-                max_length=77         # <-- Giới hạn của CLIP text encoder
-            ).to(self.device)
-                        
-            with torch.no_grad():
-                text_features = self.model.get_text_features(**inputs)
-            
-            # Chuyển sang numpy, chuẩn hóa
-            embedding = text_features.cpu().numpy()[0]
-            embedding = embedding / np.linalg.norm(embedding)
-            
+            cached = self.query_cache.get(text)
+            if cached is not None:
+                return cached[1]
+
+            return self.text_flight.do(normalize_query(text), self._encode_text_query, text)
 
-            print('done text embeddings')
-            return embedding
-            
         except Exception as e:
             print(f"Error generating text embedding: {str(e)}")
             raise
 
-    def init_faiss_index(self, dimension=768):
+    def _encode_text_query(self, text):
+        # get_text_embedding đã tính miss; request trước có thể vừa ghi cache xong
+        cached = self.query_cache.peek(text)
+        if cached is not None:
+            return cached[1]
+        return self._embed_uncached([text])[0]
+
+    def _translate_queries(self, texts):
+        """
+        Dịch các query tiếng Việt trong một request tới translate service.
+        Trả về list (text đã dịch, dịch thành công hay không).
+        """
+        results = [(text, True) for text in texts]
+        if Config.TRANSLATE_SKIP_NON_VIETNAMESE:
+            pending = [i for i, text in enumerate(texts) if is_vietnamese(text)]
+        else:
+            pending = list(range(len(texts)))
+        if not pending:
+            return results
+
+        if len(pending) == 1:
+            translated = translate_client.try_translate(texts[pending[0]])
+            translated = None if translated is None else [translated]
+        else:
+            translated = translate_client.try_translate_batch([texts[i] for i in pending])
+        for position, i in enumerate(pending):
+            # Service lỗi/chậm -> encode query gốc
+            if translated is None:
+                results[i] = (texts[i], False)
+            else:
+                results[i] = (translated[position], True)
+        return results
+
+    def encode_texts(self, texts):
+        """Chạy text tower cho một batch text, trả về ma trận float32 đã chuẩn hóa"""
+        inputs = self.processor(
+            text=list(texts),
+            return_tensors="pt",
+            padding=True,
+            truncation=True,      # <-- Bắt buộc (quan trọng)
+            max_length=77         # <-- Giới hạn của CLIP text encoder
+        ).to(self.device)
+
+        with torch.no_grad():
+            text_features = self.model.get_text_features(**inputs)
+
+        return self._normalize_rows(text_features.cpu().numpy())
+
+    def get_text_embeddings(self, texts, batch_size=64):
+        """
+        Generate embeddings cho nhiều text query: lấy từ cache nếu có, dịch
+        các query còn lại trong một request và encode theo mini-batch.
+        Trả về ma trận float32 (len(texts), dim) đã chuẩn hóa.
+        """
+        try:
+            embeddings = [None] * len(texts)
+            missing = {}
+            for i, text in enumerate(texts):
+                # Query lặp lại được trả về từ cache, không cần dịch + encode lại
+                cached = self.query_cache.get(text)
+                if cached is not None:
+                    embeddings[i] = cached[1]
+                else:
+                    missing.setdefault(text, []).append(i)
+
+            if missing:
+                unique_texts = list(missing)
+                for text, vector in zip(unique_texts, self._embed_uncached(unique_texts, batch_size)):
+                    for i in missing[text]:
+                        embeddings[i] = vector
+
+            if not embeddings:
+                return np.empty((0, self.dimension), dtype=np.float32)
+            return np.vstack(embeddings).astype(np.float32, copy=False)
+
+        except Exception as e:
+            print(f"Error generating text embeddings: {str(e)}")
+            raise
+
+    def _embed_uncached(self, texts, batch_size=64):
+        """Dịch + encode các query (không đọc cache), ghi kết quả dịch thành công vào cache"""
+        self.load_model()  # Ensure model is loaded
+        translations = self._translate_queries(texts)
+        results = []
+        for start in range(0, len(texts), batch_size):
+            chunk = translations[start:start + batch_size]
+            vectors = self.encode_texts([translated.lower() for translated, _ in chunk])
+            for text, (translated, ok), vector in zip(texts[start:start + batch_size], chunk, vectors):
+                # Không cache kết quả fallback để lần sau vẫn thử dịch lại
+                if ok:
+                    self.query_cache.put(text, translated.lower(), vector)
+                results.append(vector)
+        return results
+
+    @staticmethod
+    def _new_base_index(dimension):
+        """Index khởi đầu (không cần train): Flat float32 hoặc SQfp16 theo config"""
+        index_type = Config.FAISS_INDEX_TYPE
+        if index_type not in BASE_INDEX_TYPES:
+            print(f"FAISS index type '{index_type}' needs training, starting with 'flat'")
+            index_type = 'flat'
+        return build_index(index_type, dimension)
+
+    def init_faiss_index(self, dimension=None):
         """
         Initialize FAISS index với IndexIDMap (để lưu ID = image_id thật).
-        Mặc định CLIP ViT-L/14 => 768 chiều
+        Mặc định theo số chiều của model đang dùng (CLIP ViT-L/14 => 768 chiều)
         """
         try:
-            index_flat = faiss.IndexFlatIP(dimension)  # Inner product similarity
-            self.index = faiss.IndexIDMap(index_flat)
-            print("FAISS index (IDMap) initialized with dimension =", dimension)
+            dimension = dimension or self.dimension
+            self.index = self._new_base_index(dimension)  # Inner product similarity
+            print(f"FAISS index (IDMap, {index_type_name(self.index)}) initialized with dimension =", dimension)
         except Exception as e:
             print(f"Error initializing FAISS index: {str(e)}")
             raise
 
-    def add_to_index(self, embedding, image_id):
+    def register_user_images(self, user_id, image_ids):
+        """Ghi nhận các image_id thuộc về user (để lọc khi search)"""
+        with self._user_map_lock:
+            self.user_image_ids.setdefault(int(user_id), set()).update(int(i) for i in image_ids)
+            self.user_versions[int(user_id)] = self.user_versions.get(int(user_id), 0) + 1
+
+    def unregister_images(self, image_ids):
+        """Xóa các image_id khỏi map user -> images"""
+        image_ids = set(int(i) for i in image_ids)
+        with self._user_map_lock:
+            for user_id, ids in self.user_image_ids.items():
+                if not ids.isdisjoint(image_ids):
+                    ids.difference_update(image_ids)
+                    self.user_versions[user_id] = self.user_versions.get(user_id, 0) + 1
+
+    def index_version(self, user_id=None):
+        """
+        Version của index nhìn từ một user: đổi khi ảnh của user được thêm/xóa
+        hoặc khi cả index được dựng lại / load lại.
+        """
+        with self._user_map_lock:
+            user_version = self.user_versions.get(int(user_id), 0) if user_id is not None else 0
+            return f"{self.index_epoch}.{user_version}"
+
+    def _bump_index_epoch(self):
+        with self._user_map_lock:
+            self.index_epoch += 1
+
+    def load_user_image_map(self, session):
+        """Dựng lại map user_id -> image_ids từ các ảnh đã có embedding trong DB"""
+        try:
+            from models import Image, ImageEmbedding  # import tại đây để tránh vòng lặp import
+
+            rows = session.query(Image.user_id, Image.image_id)\
+                          .join(ImageEmbedding, (ImageEmbedding.image_id == Image.image_id) &
+                                                (ImageEmbedding.model == self.model_tag))\
+                          .distinct().all()
+
+            user_image_ids = {}
+            for user_id, image_id in rows:
+                user_image_ids.setdefault(user_id, set()).add(image_id)
+
+            with self._user_map_lock:
+                self.user_image_ids = user_image_ids
+                self.index_epoch += 1
+            print(f"Loaded image ownership for {len(user_image_ids)} users")
+        except Exception as e:
+            print(f"Error loading user image map: {str(e)}")
+            raise
+
+    def _add_with_ids(self, embeddings, image_ids, model=None):
+        """
+        Thêm vào index hiện tại và ghi WAL; nếu đang migrate thì giữ lại để
+        thêm vào index mới. model: tag của model đã sinh embeddings, raise nếu
+        service đã chuyển model (gọi khi đang giữ _index_lock nên không thể
+        chuyển model giữa lúc kiểm tra và add).
+        """
+        if model is not None and model != self.model_tag:
+            raise RuntimeError(f"Embedding model switched from {model} to {self.model_tag}")
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        image_ids = np.ascontiguousarray(image_ids, dtype=np.int64)
+        self._ensure_writable()
+        self._purge_replaced(image_ids)
+        self.index.add_with_ids(embeddings, image_ids)
+        if self.wal is not None:
+            self.wal.append(image_ids, embeddings)
+        if self.vector_store is not None:
+            self.vector_store.add(image_ids, embeddings)
+        if self._migration_buffer is not None:
+            self._migration_buffer.append((embeddings, image_ids))
+
+    def _purge_replaced(self, image_ids):
+        """
+        Ảnh được embed lại (file bị thay) có id nằm trong tombstones: xóa hẳn
+        vector cũ trước khi add vector mới để không có 2 vector cùng id.
+        Gọi khi đang giữ _index_lock.
+        """
+        if not self.tombstones:
+            return
+        replaced = [int(i) for i in image_ids if int(i) in self.tombstones]
+        if not replaced:
+            return
+        try:
+            self.index.remove_ids(faiss.IDSelectorBatch(np.array(replaced, dtype=np.int64)))
+        except RuntimeError:
+            # Index không hỗ trợ remove_ids (HNSW): vector cũ còn lại tới lần compaction,
+            # search sẽ loại id trùng
+            print(f"Index does not support remove_ids, {len(replaced)} stale vectors kept until compaction")
+        self.tombstones.difference_update(replaced)
+
+    def remove_from_index(self, image_ids):
+        """
+        Đánh dấu xóa (tombstone) các image_id: search sẽ bỏ qua ngay, vector
+        được xóa vật lý ở lần compaction. Ghi record delete vào WAL.
+        """
+        image_ids = np.array([int(i) for i in image_ids], dtype=np.int64)
+        if len(image_ids) == 0:
+            return
+        self.unregister_images(image_ids)
+        if self.vector_store is not None:
+            self.vector_store.remove(image_ids)
+        with self._index_lock:
+            self.tombstones.update(image_ids.tolist())
+            if self.wal is not None:
+                self.wal.append_delete(image_ids)
+            if self.reembedding is not None:
+                # Shadow index của model mới cũng phải bỏ các ảnh này khi chuyển
+                self.reembedding.removed.update(image_ids.tolist())
+
+    def tombstone_ratio(self):
+        with self._index_lock.read():
+            if self.index is None or self.index.ntotal == 0:
+                return 0.0
+            return len(self.tombstones) / self.index.ntotal
+
+    def should_compact_index(self):
+        return (
+            not self.index_compacting
+            and not self.index_migrating
+            and len(self.tombstones) > 0
+            and self.tombstone_ratio() >= Config.FAISS_TOMBSTONE_RATIO
+        )
+
+    def compact_index(self, session=None):
+        """
+        Xóa vật lý các vector đã bị tombstone. Index hỗ trợ remove_ids (Flat, IVF)
+        được xóa trên một bản copy rồi thay index (search vẫn chạy trên index cũ);
+        HNSW không hỗ trợ nên dựng lại từ DB (cần session).
+        """
+        with self._index_lock:
+            if self.index_compacting or not self.tombstones:
+                return False
+            self.index_compacting = True
+
+        try:
+            if index_kind(self.index) == 'hnsw':
+                if session is None:
+                    print("Index does not support remove_ids, compaction needs a DB rebuild")
+                    return False
+                # DB đã xóa các ảnh này nên index dựng lại từ DB không còn vector chết
+                with self._index_lock.read():
+                    dead_ids = np.fromiter(self.tombstones, dtype=np.int64)
+                if not self.migrate_index(session, 'hnsw'):
+                    # Không dựng lại được (đang dựng index khác / DB trống): giữ tombstones
+                    return False
+                with self._index_lock:
+                    # Chỉ bỏ tombstone của các id index mới thật sự không còn chứa
+                    present = faiss.vector_to_array(self.index.id_map)
+                    excluded = dead_ids[~np.isin(dead_ids, present)]
+                    self.tombstones.difference_update(excluded.tolist())
+                removed = len(excluded)
+            else:
+                removed = self._compact_copy()
+                if removed is None:
+                    return False
+                self.save_faiss_index(force=True)
+
+            if self.vector_store is not None:
+                # Bỏ luôn các dòng đã xóa / bị thay trong file của vector store
+                self.vector_store.compact()
+            print(f"FAISS index compacted: {removed} vectors removed")
+            return True
+        except Exception as e:
+            print(f"Error compacting FAISS index: {str(e)}")
+            raise
+        finally:
+            self.index_compacting = False
+
+    def _compact_copy(self):
+        """
+        Xóa các vector tombstone trên bản copy của index ngoài lock; các add trong
+        lúc đó được gom vào _migration_buffer và áp lại lên bản copy trước khi thay.
+        Trả về số vector đã xóa (None nếu đang dựng index khác).
+        """
+        if not self._begin_rebuild():
+            return None
+        try:
+            with self._index_lock.read():
+                dead_ids = np.fromiter(self.tombstones, dtype=np.int64)
+                compacted = faiss.deserialize_index(faiss.serialize_index(self.index))
+            removed = compacted.remove_ids(faiss.IDSelectorBatch(dead_ids))
+
+            with self._index_lock:
+                readded = self._apply_migration_buffer(compacted)
+                self.index = compacted
+                self.index_mmapped = False
+                # id được add lại rồi xóa lần nữa trong lúc compact vẫn phải giữ tombstone
+                self.tombstones.difference_update(set(dead_ids.tolist()) - readded)
+                self._bump_index_epoch()
+            return removed
+        finally:
+            self._end_rebuild()
+
+    def add_to_index(self, embedding, image_id, user_id=None, model=None):
         try:
             if self.index is None:
                 self.init_faiss_index(dimension=embedding.shape[0])
@@ -123,64 +565,563 @@ class AIService:
             # Thêm embedding vào index
             embedding_f32 = embedding.reshape(1, -1).astype(np.float32)
             ids = np.array([image_id], dtype=np.int64)
-            self.index.add_with_ids(embedding_f32, ids)
+            self._detach_mmap()
+            with self._index_lock:
+                self._add_with_ids(embedding_f32, ids, model=model)
+            if user_id is not None:
+                self.register_user_images(user_id, [image_id])
             
-            # Lưu index ngay sau khi thêm
-            self.save_faiss_index("faiss_index.bin")
+            # Vector đã nằm trong WAL, chỉ snapshot lại khi WAL quá lớn
+            self._maybe_snapshot()
             return True
         except Exception as e:
             print(f"Error adding to FAISS index: {str(e)}")
             raise
-    def add_batch_to_index(self, embeddings, image_ids):
-        """Thêm nhiều embeddings vào FAISS index cùng lúc"""
+    def add_batch_to_index(self, embeddings, image_ids, user_ids=None, model=None):
+        """
+        Thêm nhiều embeddings vào FAISS index cùng lúc. model: tag của model đã
+        sinh embeddings; batch bị từ chối (RuntimeError) nếu service đã chuyển model.
+        """
         try:
             if self.index is None:
                 self.init_faiss_index(dimension=embeddings.shape[1])
             
             # Thêm tất cả embeddings vào index
-            self.index.add_with_ids(embeddings, image_ids)
+            self._detach_mmap()
+            with self._index_lock:
+                self._add_with_ids(embeddings, image_ids, model=model)
+            if user_ids is not None:
+                for user_id, image_id in zip(user_ids, image_ids):
+                    self.register_user_images(user_id, [image_id])
             
-            # Lưu index sau khi thêm batch
-            self.save_faiss_index("faiss_index.bin")
+            # Vector đã nằm trong WAL, chỉ snapshot lại khi WAL quá lớn
+            self._maybe_snapshot()
             return True
         except Exception as e:
             print(f"Error adding batch to FAISS index: {str(e)}")
             raise
-    def search_similar(self, query_embedding, k=5):
-        """Search for similar embeddings, trả về list (image_id, distance)"""
+    def _build_selector(self, user_id=None):
+        """
+        Dựng IDSelector cho search: theo ảnh của user (map user -> images đã
+        loại ảnh bị xóa), hoặc loại các id trong tombstones nếu không lọc user.
+        Trả về (selector, số ứng viên tối đa).
+        """
+        if user_id is not None:
+            with self._user_map_lock:
+                user_ids = np.fromiter(self.user_image_ids.get(int(user_id), ()), dtype=np.int64)
+            if len(user_ids) == 0:
+                return None, 0
+            return faiss.IDSelectorBatch(user_ids), min(len(user_ids), self.index.ntotal)
+
+        with self._index_lock.read():
+            if not self.tombstones:
+                return None, self.index.ntotal
+            dead_ids = np.fromiter(self.tombstones, dtype=np.int64)
+        inner = faiss.IDSelectorBatch(dead_ids)
+        selector = faiss.IDSelectorNot(inner)
+        selector.referenced_objects = [inner]  # giữ inner sống cùng selector
+        return selector, max(self.index.ntotal - len(dead_ids), 0)
+
+    @staticmethod
+    def _collect_hits(ids, distances):
+        """Bỏ id -1 và id trùng (vector cũ chưa compaction), giữ thứ tự score"""
+        seen = set()
+        results = []
+        for idx, dist in zip(ids, distances):
+            if idx == -1 or idx in seen:
+                continue
+            seen.add(idx)
+            results.append((idx, dist))
+        return results
+
+    def search_similar(self, query_embedding, k=5, user_id=None, rerank=None):
+        """
+        Search for similar embeddings, trả về list (image_id, distance).
+        Nếu có user_id, chỉ tìm trong ảnh của user đó (lọc ngay trong FAISS
+        bằng IDSelector) nên luôn trả về đúng k kết quả tốt nhất của user.
+        rerank=R (mặc định SEARCH_RERANK_FACTOR khi có vector store): lấy k*R
+        ứng viên từ index nén/ANN rồi tính lại score bằng vector float32 chính xác.
+        Các search giống hệt nhau đang chạy đồng thời chỉ chạy FAISS một lần.
+        """
+        query_embedding = np.ascontiguousarray(query_embedding, dtype=np.float32).reshape(1, -1)
+        key = (query_embedding.tobytes(), k, user_id, rerank, self.index_version(user_id))
+        results = self.search_flight.do(key, self.search_similar_batch, query_embedding, k, user_id, rerank)
+        return list(results[0])
+
+    def search_similar_batch(self, query_embeddings, k=5, user_id=None, rerank=None):
+        """
+        Giống search_similar nhưng cho nhiều query: một lần index.search trên
+        ma trận query (nq, dim). Trả về list kết quả cho từng query.
+        """
         try:
-            if self.index is None or self.index.ntotal == 0:
-                return []
-            
-            # Ép query_embedding sang float32
-            query_embedding_f32 = query_embedding.reshape(1, -1).astype(np.float32)
-            
-            distances, ids = self.index.search(query_embedding_f32, min(k, self.index.ntotal))
-            
-            return list(zip(ids[0], distances[0]))
+            # Ép query_embeddings sang float32
+            queries = np.ascontiguousarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1)
+            if self.index is None or self.index.ntotal == 0 or len(queries) == 0:
+                return [[] for _ in range(len(queries))]
+
+            selector, n_candidates = self._build_selector(user_id)
+            if n_candidates == 0:
+                return [[] for _ in range(len(queries))]
+            k = min(k, n_candidates)
+
+            if rerank is None:
+                rerank = Config.SEARCH_RERANK_FACTOR if self.vector_store is not None else 1
+            k_fetch = min(k * max(int(rerank), 1), n_candidates)
+
+            with self._index_lock.read():
+                params = search_params(self.index, selector, self.nprobe, self.ef_search)
+                distances, ids = self.index.search(queries, k_fetch, params=params)
+                results = [self._collect_hits(row_ids, row_distances) for row_ids, row_distances in zip(ids, distances)]
+
+                # Với index ANN, lọc theo user có thể trả thiếu kết quả (ảnh của user
+                # nằm ngoài các cluster được probe) -> search lại kiểu exhaustive
+                short = [i for i, hits in enumerate(results) if len(hits) < k_fetch]
+                if user_id is not None and short and index_kind(self.index) != 'flat':
+                    params = search_params(self.index, selector, exhaustive=True)
+                    distances, ids = self.index.search(queries[short], k_fetch, params=params)
+                    for i, row_ids, row_distances in zip(short, ids, distances):
+                        results[i] = self._collect_hits(row_ids, row_distances)
+
+            if k_fetch > k and self.vector_store is not None:
+                results = [self._rerank(query, hits) for query, hits in zip(queries, results)]
+            return [hits[:k] for hits in results]
             
         except Exception as e:
             print(f"Error searching index: {str(e)}")
             raise
+
+    def _rerank(self, query_vector, hits):
+        """Tính lại score của các ứng viên bằng vector float32 (một phép matmul)"""
+        if not hits:
+            return hits
+        candidate_ids = np.array([idx for idx, _ in hits], dtype=np.int64)
+        approx_scores = np.array([score for _, score in hits], dtype=np.float32)
+
+        found, vectors = self.vector_store.get(candidate_ids)
+        # Ứng viên chưa có trong vector store giữ score xấp xỉ của index
+        scores = np.where(found, vectors @ query_vector, approx_scores)
+        order = np.argsort(-scores, kind='stable')
+        return [(candidate_ids[i], scores[i]) for i in order]
         
-    def save_faiss_index(self, file_path):
+    def range_search_similar(self, query_embedding, min_score, user_id=None, max_results=None):
         """
-        Lưu FAISS index ra file.
-        Giúp chúng ta không bị mất index khi server dừng.
+        Tìm tất cả ảnh có score >= min_score (FAISS range_search).
+        Trả về (list (image_id, score) đã sắp xếp, tối đa max_results phần tử,
+        tổng số ảnh thỏa ngưỡng).
+        Lọc theo user trên index ANN thì quét exhaustive như search top-k; có
+        vector store thì lấy rộng hơn ngưỡng một khoảng SEARCH_RANGE_RERANK_MARGIN
+        rồi tính lại score và lọc ngưỡng bằng vector float32 chính xác.
         """
         try:
-            if self.index is not None:
-                faiss.write_index(self.index, file_path)
+            if self.index is None or self.index.ntotal == 0:
+                return [], 0
+            max_results = max_results or Config.SEARCH_RANGE_MAX_RESULTS
+
+            query_embedding_f32 = query_embedding.reshape(1, -1).astype(np.float32)
+            selector, n_candidates = self._build_selector(user_id)
+            if n_candidates == 0:
+                return [], 0
+
+            # Score của index nén (SQ/PQ) là xấp xỉ: lấy thêm ứng viên sát dưới ngưỡng để re-rank
+            exact = self.vector_store is not None
+            margin = Config.SEARCH_RANGE_RERANK_MARGIN if exact else 0.0
+            # Với inner product, range_search trả về các vector có score > radius
+            radius = float(np.nextafter(np.float32(min_score - margin), np.float32(-np.inf)))
+            with self._index_lock.read():
+                # Lọc theo user trên IVF/HNSW với nprobe/efSearch mặc định bỏ sót ảnh
+                # của user nằm ngoài vùng được probe -> quét exhaustive
+                exhaustive = user_id is not None and index_kind(self.index) != 'flat'
+                params = search_params(self.index, selector, self.nprobe, self.ef_search, exhaustive=exhaustive)
+                lims, distances, ids = self.index.range_search(query_embedding_f32, radius, params=params)
+
+            # Kết quả range_search không có thứ tự -> sắp xếp theo score giảm dần
+            order = np.argsort(-distances[lims[0]:lims[1]], kind='stable')
+            hits = self._collect_hits(ids[lims[0]:lims[1]][order], distances[lims[0]:lims[1]][order])
+            if exact:
+                hits = [(idx, score) for idx, score in self._rerank(query_embedding_f32[0], hits)
+                        if score >= min_score]
+            return hits[:max_results], len(hits)
+
+        except Exception as e:
+            print(f"Error range searching index: {str(e)}")
+            raise
+
+    def coalescing_stats(self):
+        """Số request được gom (dùng chung kết quả) của text embedding và search"""
+        return {
+            'text_embedding': self.text_flight.stats(),
+            'search': self.search_flight.stats()
+        }
+
+    def set_search_params(self, nprobe=None, ef_search=None):
+        """Điều chỉnh tham số search runtime cho index ANN (IVF nprobe / HNSW efSearch)"""
+        if nprobe is not None:
+            self.nprobe = int(nprobe)
+        if ef_search is not None:
+            self.ef_search = int(ef_search)
+
+    def _iter_embedding_chunks(self, session, chunk_size=10000, model=None, dimension=None):
+        """
+        Đọc (image_id, embedding_vector) của một model (mặc định model hiện tại)
+        từ DB theo từng chunk, trả về (ids, matrix)
+        """
+        from models import ImageEmbedding  # import tại đây để tránh vòng lặp import
+
+        query = session.query(ImageEmbedding.image_id, ImageEmbedding.embedding_vector)\
+                       .filter(ImageEmbedding.model == (model or self.model_tag))\
+                       .order_by(ImageEmbedding.embedding_id)\
+                       .yield_per(chunk_size)
+        ids, blobs = [], []
+        for image_id, blob in query:
+            ids.append(image_id)
+            blobs.append(blob)
+            if len(ids) >= chunk_size:
+                yield self._decode_chunk(ids, blobs, dimension)
+                ids, blobs = [], []
+        if ids:
+            yield self._decode_chunk(ids, blobs, dimension)
+
+    def _decode_chunk(self, ids, blobs, dimension=None):
+        dimension = dimension or self.dimension
+        return np.array(ids, dtype=np.int64), decode_vectors(blobs, dimension)
+
+    def _sample_training_vectors(self, session, sample_size):
+        from models import ImageEmbedding  # import tại đây để tránh vòng lặp import
+
+        # ORDER BY random() đọc + sắp xếp cả bảng blob: chọn mẫu trên cột id trước
+        embedding_ids = np.array([row[0] for row in session.query(ImageEmbedding.embedding_id)
+                                                           .filter(ImageEmbedding.model == self.model_tag)],
+                                 dtype=np.int64)
+        if len(embedding_ids) == 0:
+            return None
+        if len(embedding_ids) > sample_size:
+            embedding_ids = np.random.choice(embedding_ids, sample_size, replace=False)
+
+        rows = []
+        for start in range(0, len(embedding_ids), 900):
+            rows.extend(session.query(ImageEmbedding.image_id, ImageEmbedding.embedding_vector)
+                               .filter(ImageEmbedding.embedding_id.in_(embedding_ids[start:start + 900].tolist()))
+                               .all())
+        return self._decode_chunk([r[0] for r in rows], [r[1] for r in rows])[1]
+
+    def get_stored_embedding(self, image_id, session=None):
+        """
+        Lấy vector đã lưu của một ảnh (không encode lại): từ vector store, rồi
+        bảng image_embeddings, cuối cùng reconstruct từ FAISS index.
+        Trả về None nếu ảnh chưa có embedding.
+        """
+        image_id = int(image_id)
+        if image_id in self.tombstones:
+            return None
+
+        if self.vector_store is not None and image_id in self.vector_store:
+            found, vectors = self.vector_store.get([image_id])
+            if found[0]:
+                return vectors[0]
+
+        if session is not None:
+            from models import ImageEmbedding  # import tại đây để tránh vòng lặp import
+
+            row = session.query(ImageEmbedding.embedding_vector)\
+                         .filter(ImageEmbedding.image_id == image_id,
+                                 ImageEmbedding.model == self.model_tag)\
+                         .order_by(ImageEmbedding.embedding_id.desc())\
+                         .first()
+            if row is not None:
+                return self._decode_chunk([image_id], [row[0]])[1][0]
+
+        return self._reconstruct(image_id)
+
+    def _reconstruct(self, image_id):
+        """Đọc lại vector từ index (vector mới nhất nếu id xuất hiện nhiều lần)"""
+        with self._index_lock.read():
+            if self.index is None or self.index.ntotal == 0 or not hasattr(self.index, 'id_map'):
+                return None
+            positions = np.flatnonzero(faiss.vector_to_array(self.index.id_map) == image_id)
+            if len(positions) == 0:
+                return None
+            inner = faiss.downcast_index(self.index.index)
+            # IVF cần direct map (làm remove_ids khi compaction không dùng được) -> bỏ qua
+            if isinstance(inner, faiss.IndexIVF):
+                return None
+            try:
+                return inner.reconstruct(int(positions[-1]))
+            except RuntimeError as e:
+                print(f"Cannot reconstruct vector {image_id} from index: {str(e)}")
+                return None
+
+    def should_migrate_index(self):
+        """Index khởi đầu (Flat/SQfp16) đã vượt ngưỡng và cần chuyển sang ANN"""
+        return (
+            Config.FAISS_ANN_AUTO_MIGRATE
+            and Config.FAISS_ANN_INDEX_TYPE not in ('', 'flat')
+            and not self.index_migrating
+            and self.index is not None
+            and self.index.ntotal >= Config.FAISS_ANN_THRESHOLD
+            and index_type_name(self.index) in BASE_INDEX_TYPES
+            and index_type_name(self.index) != Config.FAISS_ANN_INDEX_TYPE
+        )
+
+    def _begin_rebuild(self):
+        """Đánh dấu đang dựng index mới; các vector add trong lúc này được giữ lại"""
+        with self._index_lock:
+            if self.index_migrating:
+                return False
+            self.index_migrating = True
+            self._migration_buffer = []
+            return True
+
+    def _end_rebuild(self):
+        with self._index_lock:
+            self._migration_buffer = None
+            self.index_migrating = False
+
+    def _fill_index_from_db(self, session, new_index, chunk_size=10000, progress=None):
+        """Stream toàn bộ vector trong DB vào new_index, trả về mảng id đã nạp"""
+        from models import ImageEmbedding  # import tại đây để tránh vòng lặp import
+        from sqlalchemy import func
+
+        total = session.query(func.count(ImageEmbedding.embedding_id))\
+                       .filter(ImageEmbedding.model == self.model_tag).scalar() or 0
+        loaded_ids = []
+        loaded = 0
+        start = time.time()
+        for ids, vectors in self._iter_embedding_chunks(session, chunk_size):
+            new_index.add_with_ids(vectors, ids)
+            loaded_ids.append(ids)
+            loaded += len(ids)
+            if progress:
+                progress(loaded, total)
+            else:
+                rate = loaded / max(time.time() - start, 1e-6)
+                print(f"Rebuilding FAISS index: {loaded}/{total} vectors ({rate:.0f} vectors/s)")
+        return np.concatenate(loaded_ids) if loaded_ids else np.empty(0, dtype=np.int64)
+
+    def _apply_migration_buffer(self, new_index):
+        """
+        Áp lại lên new_index các vector được add trong lúc dựng, theo thứ tự:
+        xóa vector cùng id (ảnh được embed lại, bản cũ có thể đã được nạp vào
+        new_index) rồi add. Trả về set id đã add. Gọi khi đang giữ _index_lock.
+        """
+        readded = set()
+        for vectors, ids in self._migration_buffer or ():
+            try:
+                new_index.remove_ids(faiss.IDSelectorBatch(ids))
+            except RuntimeError:
+                # HNSW không hỗ trợ remove_ids: vector cũ còn lại tới lần compaction,
+                # search sẽ loại id trùng
+                pass
+            new_index.add_with_ids(vectors, ids)
+            readded.update(ids.tolist())
+        return readded
+
+    def _swap_index(self, new_index):
+        """Thay index hiện tại bằng new_index rồi lưu snapshot (truncate WAL)"""
+        with self._index_lock:
+            self._apply_migration_buffer(new_index)
+            self.index = new_index
+            self.index_mmapped = False
+            self._bump_index_epoch()
+        self.save_faiss_index(force=True)
+
+    def migrate_index(self, session, index_type=None):
+        """
+        Dựng index ANN mới (train từ mẫu embedding trong image_embeddings), nạp
+        toàn bộ vector từ DB rồi thay index hiện tại. Search vẫn chạy trên index
+        cũ trong lúc dựng; các vector được thêm trong lúc đó sẽ được bổ sung
+        vào index mới trước khi thay.
+        """
+        index_type = index_type or Config.FAISS_ANN_INDEX_TYPE
+        if not self._begin_rebuild():
+            return False
+
+        try:
+            print(f"Building FAISS index '{index_type}'...")
+            training_vectors = self._sample_training_vectors(session, Config.FAISS_TRAIN_SAMPLE)
+            if training_vectors is None:
+                print("No embeddings found in the database, skip index migration.")
+                return False
+
+            new_index = build_index(
+                index_type,
+                training_vectors.shape[1],
+                training_vectors,
+                nlist=Config.FAISS_IVF_NLIST,
+                pq_m=Config.FAISS_PQ_M,
+                hnsw_m=Config.FAISS_HNSW_M
+            )
+
+            self._fill_index_from_db(session, new_index)
+            self._swap_index(new_index)
+            print(f"FAISS index migrated to '{index_type}' with {new_index.ntotal} vectors")
+            return True
+        except Exception as e:
+            print(f"Error migrating FAISS index: {str(e)}")
+            raise
+        finally:
+            self._end_rebuild()
+
+    def _run_in_background(self, app, name, func, *args):
+        """Chạy func(session, *args) trong thread nền với app context"""
+        def run():
+            from database.db import db  # import tại đây để tránh vòng lặp import
+            with app.app_context():
+                try:
+                    func(db.session, *args)
+                except Exception:
+                    pass
+                finally:
+                    db.session.remove()
+
+        thread = threading.Thread(target=run, name=name)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def start_index_migration(self, app, index_type=None):
+        """Chạy migrate_index trong thread nền với app context"""
+        return self._run_in_background(app, "faiss-migrate", self.migrate_index, index_type)
+
+    def start_index_compaction(self, app):
+        """Chạy compact_index trong thread nền với app context"""
+        return self._run_in_background(app, "faiss-compact", self.compact_index)
+
+    def switch_model(self, model_name, model, processor, new_index, session=None):
+        """
+        Chuyển sang model embedding mới cùng index đã dựng cho nó. Snapshot và
+        WAL mới nằm ở file riêng của model; file state được ghi (atomic) sau
+        cùng nên crash giữa chừng vẫn khởi động lại với model + index cũ.
+        """
+        state = model_state_for(model_name)
+        state['dimension'] = new_index.d
+        with self._index_lock:
+            tmp_path = state['index_path'] + '.tmp'
+            faiss.write_index(new_index, tmp_path)
+            os.replace(tmp_path, state['index_path'])
+            tombstones_path = self._tombstones_path(state['index_path'])
+            if os.path.exists(tombstones_path):
+                os.remove(tombstones_path)
+            if os.path.exists(state['wal_path']):
+                os.remove(state['wal_path'])
+            new_wal = VectorWAL(
+                state['wal_path'],
+                new_index.d,
+                fsync_batch=Config.FAISS_WAL_FSYNC_BATCH,
+                fsync_interval=Config.FAISS_WAL_FSYNC_INTERVAL
+            )
+
+            os.makedirs(os.path.dirname(os.path.abspath(Config.EMBEDDING_MODEL_STATE_PATH)), exist_ok=True)
+            tmp_path = Config.EMBEDDING_MODEL_STATE_PATH + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, Config.EMBEDDING_MODEL_STATE_PATH)
+
+            old_wal = self.wal
+            self.model_state = state
+            self.model, self.processor = model, processor
+            self.index = new_index
+            self.index_path = state['index_path']
+            self.index_mmapped = False
+            self.tombstones = set()
+            self.wal = new_wal
+            self._bump_index_epoch()
+
+        if old_wal is not None:
+            old_wal.close()
+        # Embedding query và vector re-rank của model cũ không còn dùng được
+        self.query_cache.clear()
+        if self.vector_store is not None:
+            self.open_vector_store(dimension=new_index.d)
+            if session is not None:
+                self.fill_vector_store(session)
+        print(f"Switched to embedding model {model_name} ({new_index.ntotal} vectors)")
+
+    def _maybe_snapshot(self):
+        """Ghi snapshot (và truncate WAL) khi WAL vượt quá FAISS_WAL_MAX_BYTES"""
+        if self.wal is not None and self.wal.size >= Config.FAISS_WAL_MAX_BYTES:
+            self.save_faiss_index()
+
+    def save_faiss_index(self, file_path=None, force=False):
+        """
+        Lưu snapshot FAISS index ra file (ghi file tạm rồi rename để không hỏng
+        snapshot cũ nếu crash giữa chừng), sau đó truncate WAL vì mọi thay đổi
+        đã nằm trong snapshot. WAL trống nghĩa là snapshot đã mới nhất nên bỏ
+        qua; force=True khi index bị thay mà không qua WAL (rebuild, compaction).
+        Trả về True nếu đã ghi snapshot.
+        """
+        file_path = file_path or self.index_path
+        if (not force and file_path == self.index_path and os.path.exists(file_path)
+                and self.wal is not None and self.wal.size == 0):
+            return False
+        try:
+            with self._snapshot_lock:
+                # Chỉ giữ quyền ghi trong lúc copy index ra bộ nhớ, ghi file ngoài lock
+                # để search/add không phải chờ cả lần write_index
+                with self._index_lock:
+                    # Index mmap chưa bị sửa thì giống hệt snapshot trên đĩa, không cần ghi lại
+                    if self.index_mmapped and file_path == self.index_path:
+                        return False
+                    if self.index is None:
+                        return False
+                    data = faiss.serialize_index(self.index)
+                    tombstones = set(self.tombstones)
+                    wal = self.wal if file_path == self.index_path else None
+                    # Record WAL ghi sau điểm này chưa có trong snapshot, phải giữ lại
+                    wal_offset = wal.size if wal is not None else 0
+
+                self._save_tombstones(file_path, tombstones)
+                tmp_path = file_path + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(data.tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, file_path)
+                if wal is not None:
+                    wal.truncate(wal_offset)
                 print(f"FAISS index saved to {file_path}")
+                return True
         except Exception as e:
             print(f"Error saving FAISS index: {str(e)}")
+            return False
+
+    @staticmethod
+    def _tombstones_path(file_path):
+        return file_path + '.tombstones.npy'
+
+    def _save_tombstones(self, file_path, tombstones):
+        """Lưu tombstones đi kèm snapshot (WAL sẽ bị truncate sau snapshot)"""
+        path = self._tombstones_path(file_path)
+        if not tombstones:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        tmp_path = path + '.tmp.npy'
+        np.save(tmp_path, np.fromiter(tombstones, dtype=np.int64))
+        os.replace(tmp_path, path)
+
+    def _load_tombstones(self, file_path):
+        path = self._tombstones_path(file_path)
+        self.tombstones = set(np.load(path).tolist()) if os.path.exists(path) else set()
 
-    def load_faiss_index(self, file_path):
+    def load_faiss_index(self, file_path=None):
         """
-        Tải FAISS index từ file. Nếu file không tồn tại, tạo index trống.
+        Tải snapshot FAISS index từ file (nếu không có thì tạo index trống),
+        rồi replay phần WAL ghi sau snapshot.
         """
+        file_path = file_path or self.model_state['index_path']
+        self.index_path = file_path
+        self.index_mmapped = False
+        wal_path = self.model_state['wal_path']
+        # WAL còn record chưa nằm trong snapshot: replay cần index ghi được nên đọc thẳng vào heap
+        wal_pending = os.path.exists(wal_path) and os.path.getsize(wal_path) > 0
         try:
-            if os.path.exists(file_path):
+            if os.path.exists(file_path) and Config.FAISS_MMAP and not wal_pending:
+                # mmap snapshot: khởi động không phải đọc cả index vào RAM;
+                # lần add đầu tiên sẽ đọc snapshot vào heap (_detach_mmap)
+                self.index = faiss.read_index(file_path, self._mmap_io_flags())
+                self.index_mmapped = True
+                print(f"FAISS index memory-mapped from {file_path}")
+            elif os.path.exists(file_path):
                 self.index = faiss.read_index(file_path)
                 print(f"FAISS index loaded from {file_path}")
             else:
@@ -191,30 +1132,221 @@ class AIService:
             # Nếu có lỗi, khởi tạo index rỗng
             self.init_faiss_index()
 
-    def load_embeddings_from_db(self, session):
+        try:
+            self._load_tombstones(file_path)
+        except Exception as e:
+            print(f"Error loading FAISS tombstones: {str(e)}")
+            self.tombstones = set()
+
+        self.open_wal(wal_path)
+        self._bump_index_epoch()
+
+    @staticmethod
+    def _mmap_io_flags():
+        # IO_FLAG_MMAP_IFC map trực tiếp phần codes của index (faiss >= 1.10);
+        # bản cũ hơn chỉ có IO_FLAG_MMAP (áp dụng cho inverted lists của IVF)
+        mmap_flag = getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP)
+        return mmap_flag | faiss.IO_FLAG_READ_ONLY
+
+    def _detach_mmap(self):
+        """
+        Index mmap là read-only (add/remove trên đó sẽ abort process), nên trước
+        lần sửa đầu tiên phải đọc lại snapshot vào heap. Index mmap chưa bị sửa
+        nên giống hệt file snapshot: đọc file ngoài lock (search vẫn chạy trên
+        index mmap trong lúc đọc) rồi chỉ giữ quyền ghi lúc thay index.
+        """
+        if not self.index_mmapped:
+            return
+        index_path = self.index_path
+        index = faiss.read_index(index_path)
+        with self._index_lock:
+            if self.index_mmapped and self.index_path == index_path:
+                self.index = index
+                self.index_mmapped = False
+                print("FAISS index detached from mmap for writing")
+
+    def _ensure_writable(self):
+        """
+        Chốt chặn khi đang giữ _index_lock: index vẫn mmap (chưa qua _detach_mmap)
+        thì đọc snapshot vào heap ngay trong lock.
+        """
+        if self.index_mmapped:
+            self.index = faiss.read_index(self.index_path)
+            self.index_mmapped = False
+            print("FAISS index detached from mmap for writing")
+
+    def open_wal(self, wal_path):
+        """Mở WAL cho index hiện tại và replay các record chưa có trong snapshot"""
+        try:
+            with self._index_lock:
+                if self.wal is not None:
+                    self.wal.close()
+                self.wal = VectorWAL(
+                    wal_path,
+                    self.index.d,
+                    fsync_batch=Config.FAISS_WAL_FSYNC_BATCH,
+                    fsync_interval=Config.FAISS_WAL_FSYNC_INTERVAL
+                )
+                self._replay_wal()
+        except Exception as e:
+            print(f"Error opening FAISS WAL: {str(e)}")
+            raise
+
+    def _replay_wal(self):
+        # Replay idempotent: bỏ qua id đã có (snapshot có thể đã chứa record
+        # nếu crash xảy ra giữa lúc ghi snapshot và truncate WAL)
+        present = set(faiss.vector_to_array(self.index.id_map).tolist())
+        added = removed = 0
+        for op, ids, vectors in self.wal.replay():
+            if op == OP_ADD:
+                # id đã có trong snapshot và không bị tombstone -> record đã được áp dụng
+                mask = np.array([i not in present or i in self.tombstones for i in ids.tolist()], dtype=bool)
+                if mask.any():
+                    self._ensure_writable()
+                    self._purge_replaced(ids[mask])
+                    self.index.add_with_ids(vectors[mask], ids[mask])
+                    if self.vector_store is not None:
+                        self.vector_store.add(ids[mask], vectors[mask])
+                    present.update(ids[mask].tolist())
+                    added += int(mask.sum())
+            elif op == OP_DELETE:
+                self.tombstones.update(ids.tolist())
+                removed += len(ids)
+        if added or removed:
+            print(f"Replayed FAISS WAL: {added} vectors added, {removed} tombstoned")
+
+    def close(self):
+        """Snapshot index và đóng WAL (gọi khi tắt server)"""
+        # wal là None khi chưa mở hoặc đã đóng (SIGTERM handler và atexit đều gọi close)
+        if self.wal is not None:
+            self.save_faiss_index()
+            self.wal.close()
+            self.wal = None
+        if self.vector_store is not None:
+            self.vector_store.close()
+            self.vector_store = None
+
+    def open_vector_store(self, path=None, dimension=None):
+        """Mở kho vector float32 dùng cho re-rank"""
+        path = path or self.model_state['vector_store_path']
+        dimension = dimension or self.dimension
+        if self.vector_store is not None:
+            self.vector_store.close()
+        self.vector_store = MmapVectorStore(path, dimension)
+        print(f"Vector store opened at {path} ({len(self.vector_store)} vectors)")
+
+    def sync_index_from_db(self, session, after_embedding_id=0, chunk_size=10000):
+        """
+        Thêm vào index các embedding được ghi vào DB bởi process khác (worker
+        pool, bulk ingest): đọc các dòng có embedding_id > after_embedding_id,
+        bỏ các ảnh index đã có, decode và add theo chunk.
+        Trả về (embedding_id lớn nhất đã đọc, số vector đã thêm).
+        """
+        from models import Image, ImageEmbedding  # import tại đây để tránh vòng lặp import
+
+        model = self.model_tag
+        indexed = None
+        added_ids = set()
+        while True:
+            rows = session.query(ImageEmbedding.embedding_id, ImageEmbedding.image_id, Image.user_id)\
+                          .join(Image, Image.image_id == ImageEmbedding.image_id)\
+                          .filter(ImageEmbedding.embedding_id > after_embedding_id,
+                                  ImageEmbedding.model == model)\
+                          .order_by(ImageEmbedding.embedding_id)\
+                          .limit(chunk_size).all()
+            if not rows:
+                return after_embedding_id, len(added_ids)
+            after_embedding_id = rows[-1][0]
+
+            if indexed is None:
+                # Các id đang có trong index (trừ tombstone), chỉ đọc khi có dòng mới
+                with self._index_lock.read():
+                    indexed = faiss.vector_to_array(self.index.id_map) if self.index.ntotal else np.empty(0, np.int64)
+                    dead = np.fromiter(self.tombstones, dtype=np.int64)
+                indexed = np.setdiff1d(indexed, dead)
+
+            image_ids = np.array([row[1] for row in rows], dtype=np.int64)
+            missing = ~np.isin(image_ids, indexed)
+
+            # Mỗi ảnh chỉ thêm một lần (dòng mới nhất nếu ảnh được embed lại)
+            latest = {}
+            for (embedding_id, image_id, user_id), is_missing in zip(rows, missing):
+                if is_missing and image_id not in added_ids:
+                    latest[image_id] = (embedding_id, user_id)
+            if not latest:
+                continue
+
+            embedding_ids = [embedding_id for embedding_id, _ in latest.values()]
+            blobs = {}
+            for start in range(0, len(embedding_ids), 900):
+                blobs.update(session.query(ImageEmbedding.embedding_id, ImageEmbedding.embedding_vector)
+                                    .filter(ImageEmbedding.embedding_id.in_(embedding_ids[start:start + 900]))
+                                    .all())
+            ids, vectors = self._decode_chunk(list(latest), [blobs[embedding_id] for embedding_id in embedding_ids])
+            self.add_batch_to_index(vectors, ids, user_ids=[user_id for _, user_id in latest.values()], model=model)
+            added_ids.update(latest)
+
+    def indexed_image_count(self):
+        """Số ảnh đang có vector trong index (không tính tombstone, id trùng tính một lần)"""
+        with self._index_lock.read():
+            if self.index is None or self.index.ntotal == 0:
+                return 0
+            ids = faiss.vector_to_array(self.index.id_map)
+            dead = np.fromiter(self.tombstones, dtype=np.int64)
+        return len(np.setdiff1d(ids, dead))
+
+    def db_image_count(self, session):
+        """Số ảnh có embedding của model hiện tại trong DB"""
+        from models import Image, ImageEmbedding  # import tại đây để tránh vòng lặp import
+        from sqlalchemy import func
+
+        return session.query(func.count(func.distinct(ImageEmbedding.image_id)))\
+                      .join(Image, Image.image_id == ImageEmbedding.image_id)\
+                      .filter(ImageEmbedding.model == self.model_tag).scalar() or 0
+
+    def fill_vector_store(self, session, chunk_size=10000):
+        """Nạp vào vector store các embedding trong DB mà store chưa có"""
+        if self.vector_store is None:
+            return
+        added = 0
+        for ids, vectors in self._iter_embedding_chunks(session, chunk_size):
+            missing = ~self.vector_store.contains(ids)
+            if missing.any():
+                self.vector_store.add(ids[missing], vectors[missing])
+                added += int(missing.sum())
+        if added:
+            print(f"Added {added} embeddings from the database to the vector store")
+
+    def load_embeddings_from_db(self, session, chunk_size=10000, progress=None):
         """
-        Đọc tất cả embedding từ DB và thêm vào FAISS index.
+        Đọc tất cả embedding từ DB và dựng lại FAISS index.
         Dùng khi ta không có sẵn file FAISS hoặc muốn đồng bộ lại từ DB.
+        Đọc thẳng các tuple (image_id, embedding_vector) theo chunk (không tạo
+        ORM object), decode mỗi chunk bằng một lần np.frombuffer, add_with_ids
+        một lần cho mỗi chunk và chỉ lưu index một lần ở cuối.
+        progress(loaded, total) được gọi sau mỗi chunk.
         """
+        if not self._begin_rebuild():
+            print("FAISS index is already being rebuilt.")
+            return
+
         try:
-            from models import ImageEmbedding  # import tại đây để tránh vòng lặp import
+            # Dựng index mới bên cạnh, search vẫn dùng index cũ cho tới khi xong
+            dimension = self.dimension
+            new_index = self._new_base_index(dimension)
 
-            embeddings = session.query(ImageEmbedding).all()
-            if not embeddings:
+            loaded_ids = self._fill_index_from_db(session, new_index, chunk_size, progress)
+            if len(loaded_ids) == 0:
                 print("No embeddings found in the database.")
                 return
 
-            # Khởi tạo lại FAISS index
-            self.init_faiss_index()
-
-            for emb in embeddings:
-                vector = np.frombuffer(emb.embedding_vector, dtype=np.float32)
-                self.add_to_index(vector, emb.image_id)
-
-            print(f"Loaded {len(embeddings)} embeddings from the database into FAISS index.")
+            self._swap_index(new_index)
+            print(f"Loaded {len(loaded_ids)} embeddings from the database into FAISS index.")
         except Exception as e:
             print(f"Error loading embeddings from database: {str(e)}")
             raise
+        finally:
+            self._end_rebuild()
 
 
 # Singleton instance
@@ -0,0 +1,172 @@
+# services/embedding_pipeline.py
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from queue import Queue
+import time
+import numpy as np
+from database.db import db
+from models import ImageEmbedding
+from services.ai_service import ai_service
+from services.vector_codec import encode_vector
+from config import Config
+
+_STOP = object()
+
+
+class EmbeddingPipeline:
+    """
+    Pipeline 3 tầng cho việc sinh embedding:
+      1. decode/preprocess: thread pool mở ảnh + CLIPProcessor -> tensor
+      2. inference: chạy image tower trên từng mini-batch tensor
+      3. writer: lưu ImageEmbedding + thêm vào FAISS index
+    Các tầng nối với nhau bằng queue có giới hạn để tạo backpressure.
+    Nếu có batcher, thời gian inference của từng mini-batch được báo cho
+    batcher.record_batch để chọn kích thước batch tiếp theo.
+    """
+
+    def __init__(self, decode_workers=4, inference_workers=1, writer_workers=1,
+                 queue_size=8, inference_batch_size=32, batcher=None):
+        self.inference_batch_size = inference_batch_size
+        self.batcher = batcher
+        self.decode_pool = ThreadPoolExecutor(
+            max_workers=decode_workers, thread_name_prefix="embed-decode"
+        )
+        self.inference_queue = Queue(maxsize=queue_size)
+        self.write_queue = Queue(maxsize=queue_size)
+
+        self.inference_threads = self._start_threads(
+            self._inference_loop, inference_workers, "embed-infer"
+        )
+        self.writer_threads = self._start_threads(
+            self._writer_loop, writer_workers, "embed-writer"
+        )
+
+    @staticmethod
+    def _start_threads(target, count, name):
+        threads = []
+        for i in range(max(1, count)):
+            thread = Thread(target=target, name=f"{name}-{i}")
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def submit(self, app, items, on_written=None, on_failed=None, batch_size=None):
+        """
+        Đưa một nhóm ảnh vào pipeline.
+        items: list (image_id, image_path, user_id). on_written(image_ids) được gọi
+        sau khi một mini-batch đã được ghi xong; on_failed(image_ids, error) khi
+        ảnh lỗi ở bất kỳ tầng nào. batch_size ghi đè kích thước mini-batch inference.
+        """
+        callbacks = (on_written, on_failed)
+        batch_size = batch_size or self.inference_batch_size
+        for start in range(0, len(items), batch_size):
+            chunk = items[start:start + batch_size]
+            self.decode_pool.submit(self._decode_chunk, app, chunk, callbacks)
+
+    @staticmethod
+    def _notify_failed(callbacks, image_ids, error):
+        on_failed = callbacks[1]
+        if on_failed and image_ids:
+            try:
+                on_failed(image_ids, error)
+            except Exception as e:
+                print(f"Error in embedding failure callback: {str(e)}")
+
+    def _decode_chunk(self, app, chunk, callbacks):
+        image_ids = []
+        user_ids = []
+        images = []
+        for image_id, image_path, user_id in chunk:
+            try:
+                images.append(ai_service.open_image(image_path))
+                image_ids.append(image_id)
+                user_ids.append(user_id)
+            except Exception as e:
+                print(f"Error decoding image {image_id}: {str(e)}")
+                self._notify_failed(callbacks, [image_id], e)
+
+        if not images:
+            return
+
+        try:
+            pixel_values = ai_service.preprocess_images(images)
+        except Exception as e:
+            print(f"Error preprocessing batch: {str(e)}")
+            self._notify_failed(callbacks, image_ids, e)
+            return
+
+        # Block khi tầng inference đang bận (backpressure)
+        self.inference_queue.put((app, image_ids, user_ids, pixel_values, callbacks))
+
+    def _inference_loop(self):
+        while True:
+            item = self.inference_queue.get()
+            if item is _STOP:
+                break
+            app, image_ids, user_ids, pixel_values, callbacks = item
+            try:
+                started = time.perf_counter()
+                model = ai_service.model_tag
+                embeddings = ai_service.encode_pixel_values(pixel_values)
+                if self.batcher is not None:
+                    self.batcher.record_batch(len(image_ids), time.perf_counter() - started)
+                self.write_queue.put((app, image_ids, user_ids, embeddings, model, callbacks))
+            except Exception as e:
+                print(f"Error running inference: {str(e)}")
+                self._notify_failed(callbacks, image_ids, e)
+
+    def _writer_loop(self):
+        while True:
+            item = self.write_queue.get()
+            if item is _STOP:
+                break
+            app, image_ids, user_ids, embeddings, model, callbacks = item
+            on_written = callbacks[0]
+            if model != ai_service.model_tag:
+                # Service đã chuyển model trong lúc batch đang chạy -> job chạy lại với model mới
+                # (kiểm tra sớm để khỏi ghi DB; add_batch_to_index kiểm tra lại dưới _index_lock)
+                self._notify_failed(callbacks, image_ids, RuntimeError(f"Embedding model switched from {model}"))
+                continue
+            with app.app_context():
+                try:
+                    # Job có thể được chạy lại (retry, lease hết hạn) -> thay embedding cũ của model này nếu có
+                    ImageEmbedding.query.filter(ImageEmbedding.image_id.in_(image_ids),
+                                                ImageEmbedding.model == model)\
+                                        .delete(synchronize_session=False)
+                    db.session.bulk_save_objects([
+                        ImageEmbedding(
+                            image_id=image_id,
+                            embedding_vector=encode_vector(embeddings[idx], Config.EMBEDDING_STORAGE_FORMAT),
+                            model=model
+                        )
+                        for idx, image_id in enumerate(image_ids)
+                    ])
+                    db.session.commit()
+
+                    ids_array = np.array(image_ids, dtype=np.int64)
+                    ai_service.add_batch_to_index(embeddings, ids_array, user_ids=user_ids, model=model)
+                    print(f"Processed batch of {len(image_ids)} images")
+
+                    # Index Flat đã đủ lớn -> chuyển sang ANN trong nền
+                    if ai_service.should_migrate_index():
+                        ai_service.start_index_migration(app)
+
+                    if on_written:
+                        on_written(image_ids)
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Error writing embedding batch: {str(e)}")
+                    self._notify_failed(callbacks, image_ids, e)
+
+    def stop(self):
+        """Chờ các tầng xử lý hết việc đang có rồi dừng"""
+        self.decode_pool.shutdown(wait=True)
+        for _ in self.inference_threads:
+            self.inference_queue.put(_STOP)
+        for thread in self.inference_threads:
+            thread.join()
+        for _ in self.writer_threads:
+            self.write_queue.put(_STOP)
+        for thread in self.writer_threads:
+            thread.join()
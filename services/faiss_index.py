@@ -0,0 +1,102 @@
+# services/faiss_index.py
+import faiss
+
+# Các loại index hỗ trợ. Tất cả đều bọc trong IDMap để lưu ID = image_id thật
+INDEX_TYPES = ('flat', 'sq_fp16', 'sq8', 'ivf_flat', 'ivf_sq8', 'ivf_pq', 'hnsw')
+
+# Loại index dùng được khi chưa có dữ liệu train (index khởi đầu)
+BASE_INDEX_TYPES = ('flat', 'sq_fp16')
+
+
+def default_nlist(n_vectors, max_nlist=65536):
+    """Số cluster IVF theo kinh nghiệm: ~4*sqrt(N), cần >= 39 điểm train/cluster"""
+    nlist = int(4 * n_vectors ** 0.5)
+    return max(1, min(nlist, n_vectors // 39, max_nlist))
+
+
+def factory_string(index_type, n_vectors=0, nlist=0, pq_m=64, hnsw_m=32):
+    if index_type == 'flat':
+        return "IDMap,Flat"
+    if index_type == 'sq_fp16':
+        return "IDMap,SQfp16"
+    if index_type == 'sq8':
+        return "IDMap,SQ8"
+    if index_type == 'ivf_sq8':
+        return f"IDMap,IVF{nlist or default_nlist(n_vectors)},SQ8"
+    if index_type == 'ivf_flat':
+        return f"IDMap,IVF{nlist or default_nlist(n_vectors)},Flat"
+    if index_type == 'ivf_pq':
+        return f"IDMap,IVF{nlist or default_nlist(n_vectors)},PQ{pq_m}"
+    if index_type == 'hnsw':
+        return f"IDMap,HNSW{hnsw_m}"
+    raise ValueError(f"Unknown FAISS index type: {index_type}")
+
+
+def build_index(index_type, dimension, training_vectors=None, nlist=0, pq_m=64, hnsw_m=32):
+    """Tạo index rỗng theo index_type và train nếu loại index cần train"""
+    n_vectors = 0 if training_vectors is None else len(training_vectors)
+    index = faiss.index_factory(
+        dimension,
+        factory_string(index_type, n_vectors, nlist, pq_m, hnsw_m),
+        faiss.METRIC_INNER_PRODUCT
+    )
+    if not index.is_trained:
+        if training_vectors is None or n_vectors == 0:
+            raise ValueError(f"Index type {index_type} requires training vectors")
+        index.train(training_vectors)
+    return index
+
+
+def index_kind(index):
+    """
+    Trả về cách search của index bên trong IDMap: 'flat' (quét toàn bộ, kể cả
+    SQ), 'ivf', 'hnsw' hoặc tên class
+    """
+    inner = faiss.downcast_index(index.index) if hasattr(index, 'id_map') else index
+    if isinstance(inner, faiss.IndexIVF):
+        return 'ivf'
+    if isinstance(inner, faiss.IndexHNSW):
+        return 'hnsw'
+    if isinstance(inner, (faiss.IndexFlat, faiss.IndexScalarQuantizer)):
+        return 'flat'
+    return type(inner).__name__
+
+
+def index_type_name(index):
+    """Tên loại index (theo INDEX_TYPES) của một index IDMap"""
+    inner = faiss.downcast_index(index.index) if hasattr(index, 'id_map') else index
+    if isinstance(inner, faiss.IndexHNSW):
+        return 'hnsw'
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return 'ivf_pq'
+    if isinstance(inner, faiss.IndexIVFScalarQuantizer):
+        return 'ivf_sq8'
+    if isinstance(inner, faiss.IndexIVF):
+        return 'ivf_flat'
+    if isinstance(inner, faiss.IndexScalarQuantizer):
+        return 'sq_fp16' if inner.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else 'sq8'
+    if isinstance(inner, faiss.IndexFlat):
+        return 'flat'
+    return type(inner).__name__
+
+
+def search_params(index, selector=None, nprobe=None, ef_search=None, exhaustive=False):
+    """
+    Dựng SearchParameters phù hợp với loại index (kèm IDSelector nếu có).
+    exhaustive=True: quét toàn bộ IVF list / mở rộng efSearch, dùng khi lọc
+    theo selector mà lần search thường trả về thiếu kết quả.
+    """
+    kind = index_kind(index)
+    if kind == 'ivf' and (nprobe or exhaustive):
+        inner = faiss.downcast_index(index.index)
+        params = faiss.SearchParametersIVF(nprobe=inner.nlist if exhaustive else nprobe)
+    elif kind == 'hnsw' and (ef_search or exhaustive):
+        params = faiss.SearchParametersHNSW(efSearch=max(ef_search or 0, 1024) if exhaustive else ef_search)
+    elif selector is None:
+        return None
+    else:
+        params = faiss.SearchParameters()
+
+    if selector is not None:
+        params.sel = selector
+    return params
@@ -0,0 +1,185 @@
+# services/index_wal.py
+import threading
+import struct
+import time
+import zlib
+import os
+import numpy as np
+
+OP_ADD = 1
+OP_DELETE = 2
+
+# Mỗi record: op (uint8) + image_id (int64) + crc32 (uint32) + vector float32[dim]
+_HEADER = struct.Struct('<BqI')
+
+
+class VectorWAL:
+    """
+    Write-ahead log append-only cho các thay đổi của FAISS index.
+    Thay vì ghi lại toàn bộ index sau mỗi lần add, chỉ append record
+    (id + vector) vào cuối file. Mỗi lần append được flush xuống OS ngay (process
+    chết vẫn không mất record), chỉ fsync được gom theo số record / thời gian.
+    Snapshot index định kỳ rồi truncate WAL (xem AIService.save_faiss_index).
+    """
+
+    def __init__(self, path, dimension, fsync_batch=256, fsync_interval=1.0):
+        self.path = path
+        self.dimension = dimension
+        self.record_size = _HEADER.size + dimension * 4
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._truncate_invalid_tail()
+        self._file = open(path, 'ab')
+        self._unsynced = 0
+        self._last_sync = time.time()
+        self._closed = False
+
+        # Thread fsync nền: giới hạn thời gian dữ liệu nằm trong buffer
+        self._sync_thread = threading.Thread(target=self._sync_loop, name="wal-sync")
+        self._sync_thread.daemon = True
+        self._sync_thread.start()
+
+    def _truncate_invalid_tail(self):
+        """Cắt bỏ record ghi dở ở cuối file (crash giữa chừng) trước khi append tiếp"""
+        if not os.path.exists(self.path):
+            return
+        valid_size = 0
+        with open(self.path, 'r+b') as f:
+            while True:
+                record = f.read(self.record_size)
+                if len(record) < self.record_size:
+                    break
+                op, _, crc = _HEADER.unpack_from(record)
+                if op not in (OP_ADD, OP_DELETE) or zlib.crc32(record[_HEADER.size:]) != crc:
+                    break
+                valid_size += self.record_size
+            if valid_size != os.path.getsize(self.path):
+                print(f"Truncating invalid WAL tail at offset {valid_size}")
+                f.truncate(valid_size)
+
+    @property
+    def size(self):
+        with self._lock:
+            return self._file.tell()
+
+    def _encode(self, op, ids, vectors):
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        if vectors is None:
+            vectors = np.zeros((len(ids), self.dimension), dtype=np.float32)
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(len(ids), self.dimension)
+
+        records = bytearray()
+        for image_id, vector in zip(ids, vectors):
+            payload = vector.tobytes()
+            records += _HEADER.pack(op, int(image_id), zlib.crc32(payload))
+            records += payload
+        return bytes(records)
+
+    def append(self, ids, vectors):
+        self._write(self._encode(OP_ADD, ids, vectors), len(ids))
+
+    def append_delete(self, ids):
+        self._write(self._encode(OP_DELETE, ids, None), len(ids))
+
+    def _write(self, data, count):
+        with self._lock:
+            self._file.write(data)
+            # Flush mỗi lần ghi: record nằm trong page cache của OS ngay, chỉ fsync là gom
+            self._file.flush()
+            self._unsynced += count
+            if self._unsynced >= self.fsync_batch:
+                self._sync_locked()
+
+    def _sync_locked(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def sync(self):
+        with self._lock:
+            if self._unsynced:
+                self._sync_locked()
+
+    def _sync_loop(self):
+        while not self._closed:
+            time.sleep(self.fsync_interval)
+            try:
+                with self._lock:
+                    if self._closed:
+                        break
+                    if self._unsynced and time.time() - self._last_sync >= self.fsync_interval:
+                        self._sync_locked()
+            except Exception as e:
+                print(f"Error syncing WAL: {str(e)}")
+
+    def truncate(self, upto=None):
+        """
+        Xóa WAL (gọi sau khi snapshot index đã được ghi xong). upto: chỉ xóa phần
+        đầu tới offset này (đã nằm trong snapshot), các record ghi sau đó được
+        chép sang file mới rồi rename thay WAL cũ.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._file.flush()
+            if upto is None or upto >= self._file.tell():
+                self._file.seek(0)
+                self._file.truncate()
+                self._sync_locked()
+                return
+
+            with open(self.path, 'rb') as f:
+                f.seek(upto)
+                tail = f.read()
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(tail)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self._file.close()
+            self._file = open(self.path, 'ab')
+            self._unsynced = 0
+            self._last_sync = time.time()
+
+    def replay(self, chunk_records=10000):
+        """
+        Đọc lại WAL theo thứ tự, yield (op, ids, vectors) cho từng nhóm record
+        liên tiếp cùng op. Dừng ở record cuối bị ghi dở / sai checksum.
+        """
+        self.sync()
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, 'rb') as f:
+            current_op, ids, vectors = None, [], []
+            while True:
+                record = f.read(self.record_size)
+                if len(record) < self.record_size:
+                    break
+                op, image_id, crc = _HEADER.unpack_from(record)
+                payload = record[_HEADER.size:]
+                if op not in (OP_ADD, OP_DELETE) or zlib.crc32(payload) != crc:
+                    print(f"WAL corrupted at offset {f.tell() - self.record_size}, stop replay")
+                    break
+
+                if op != current_op or len(ids) >= chunk_records:
+                    if ids:
+                        yield current_op, np.array(ids, dtype=np.int64), np.vstack(vectors)
+                    current_op, ids, vectors = op, [], []
+                ids.append(image_id)
+                vectors.append(np.frombuffer(payload, dtype=np.float32))
+
+            if ids:
+                yield current_op, np.array(ids, dtype=np.int64), np.vstack(vectors)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
@@ -0,0 +1,208 @@
+# services/job_queue.py
+from datetime import datetime, timedelta, timezone
+import socket
+import os
+from sqlalchemy import func, and_, or_, update, select, literal
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from database.db import db
+from models import Image, ImageEmbedding, EmbeddingJob
+from config import Config
+
+# Số dòng mỗi câu INSERT (4 tham số/dòng, dưới giới hạn 999 tham số của SQLite cũ)
+ENQUEUE_CHUNK_SIZE = 200
+
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class EmbeddingJobQueue:
+    """
+    Queue job sinh embedding lưu trong bảng embedding_jobs (SQLite).
+    Job đi qua các trạng thái pending -> running -> done / failed:
+      - claim: nhận job pending đến hạn (hoặc running đã hết lease) kèm lease
+      - complete / fail: fail thì retry với backoff lũy thừa, quá số lần thì failed
+    Worker chết giữa chừng -> lease hết hạn -> job được worker khác nhận lại.
+    Mọi method cần chạy trong app context.
+    """
+
+    def __init__(self, lease_seconds=300, max_attempts=5, backoff_base=5, backoff_max=600):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def enqueue(self, image_ids):
+        """Tạo job pending cho các ảnh (job cũ của ảnh được đặt lại về pending)"""
+        image_ids = sorted({int(i) for i in image_ids})
+        if not image_ids:
+            return 0
+        now = _utcnow()
+        for start in range(0, len(image_ids), ENQUEUE_CHUNK_SIZE):
+            stmt = sqlite_insert(EmbeddingJob).values([
+                {'image_id': image_id, 'state': EmbeddingJob.STATE_PENDING, 'attempts': 0, 'next_run_at': now}
+                for image_id in image_ids[start:start + ENQUEUE_CHUNK_SIZE]
+            ])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[EmbeddingJob.image_id],
+                set_={
+                    'state': EmbeddingJob.STATE_PENDING,
+                    'attempts': 0,
+                    'last_error': None,
+                    'lease_owner': None,
+                    'lease_expires_at': None,
+                    'next_run_at': now,
+                    'updated_at': now
+                }
+            )
+            db.session.execute(stmt)
+        db.session.commit()
+        return len(image_ids)
+
+    def sweep_unembedded(self, model=None):
+        """
+        Đưa vào queue (một câu INSERT ... SELECT) mọi ảnh chưa có embedding (của
+        model nếu truyền vào) và chưa có job đang chờ/chạy: ảnh upload trước khi
+        crash, job 'done' nhưng embedding bị mất, ảnh còn thiếu sau khi chuyển
+        model. Job 'failed' giữ nguyên để không retry vô hạn.
+        """
+        embedded = ImageEmbedding.image_id == Image.image_id
+        if model is not None:
+            embedded = and_(embedded, ImageEmbedding.model == model)
+        now = _utcnow()
+        unembedded = select(
+            Image.image_id,
+            literal(EmbeddingJob.STATE_PENDING),
+            literal(0),
+            literal(now)
+        ).outerjoin(
+            ImageEmbedding, embedded
+        ).where(ImageEmbedding.image_id.is_(None))
+
+        stmt = sqlite_insert(EmbeddingJob).from_select(
+            ['image_id', 'state', 'attempts', 'next_run_at'], unembedded
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[EmbeddingJob.image_id],
+            set_={'state': EmbeddingJob.STATE_PENDING, 'attempts': 0, 'next_run_at': now, 'updated_at': now},
+            where=EmbeddingJob.state == EmbeddingJob.STATE_DONE
+        )
+        result = db.session.execute(stmt)
+        db.session.commit()
+        return result.rowcount
+
+    def _claimable(self, now):
+        return or_(
+            and_(EmbeddingJob.state == EmbeddingJob.STATE_PENDING, EmbeddingJob.next_run_at <= now),
+            and_(EmbeddingJob.state == EmbeddingJob.STATE_RUNNING, EmbeddingJob.lease_expires_at < now)
+        )
+
+    def claim(self, worker_id, limit):
+        """
+        Nhận tối đa limit job. UPDATE có điều kiện nên 2 worker không thể nhận
+        cùng một job (SQLite tuần tự hóa các lệnh ghi).
+        Trả về list (job_id, image_id, attempts).
+        """
+        now = _utcnow()
+        # Job làm worker chết (lease hết hạn) quá nhiều lần -> failed thay vì nhận lại mãi
+        db.session.execute(
+            update(EmbeddingJob)
+            .where(EmbeddingJob.state == EmbeddingJob.STATE_RUNNING,
+                   EmbeddingJob.lease_expires_at < now,
+                   EmbeddingJob.attempts >= self.max_attempts)
+            .values(state=EmbeddingJob.STATE_FAILED, lease_owner=None, lease_expires_at=None,
+                    last_error='Lease expired too many times', updated_at=now)
+            .execution_options(synchronize_session=False)
+        )
+        candidate_ids = [
+            row[0] for row in db.session.query(EmbeddingJob.job_id)
+                                        .filter(self._claimable(now))
+                                        .order_by(EmbeddingJob.next_run_at, EmbeddingJob.job_id)
+                                        .limit(limit).all()
+        ]
+        if not candidate_ids:
+            db.session.commit()
+            return []
+
+        db.session.execute(
+            update(EmbeddingJob)
+            .where(EmbeddingJob.job_id.in_(candidate_ids), self._claimable(now))
+            .values(
+                state=EmbeddingJob.STATE_RUNNING,
+                lease_owner=worker_id,
+                lease_expires_at=now + timedelta(seconds=self.lease_seconds),
+                attempts=EmbeddingJob.attempts + 1,
+                updated_at=now
+            )
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+
+        return db.session.query(EmbeddingJob.job_id, EmbeddingJob.image_id, EmbeddingJob.attempts)\
+                         .filter(EmbeddingJob.job_id.in_(candidate_ids),
+                                 EmbeddingJob.state == EmbeddingJob.STATE_RUNNING,
+                                 EmbeddingJob.lease_owner == worker_id)\
+                         .all()
+
+    def complete(self, worker_id, image_ids):
+        """Đánh dấu done các job (của worker này) cho các ảnh đã được ghi embedding"""
+        if not image_ids:
+            return
+        db.session.execute(
+            update(EmbeddingJob)
+            .where(EmbeddingJob.image_id.in_([int(i) for i in image_ids]),
+                   EmbeddingJob.state == EmbeddingJob.STATE_RUNNING,
+                   EmbeddingJob.lease_owner == worker_id)
+            .values(state=EmbeddingJob.STATE_DONE, lease_owner=None, lease_expires_at=None,
+                    last_error=None, updated_at=_utcnow())
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+
+    def fail(self, worker_id, image_ids, error):
+        """Job lỗi: retry sau backoff 2^(attempts-1) * base giây, quá max_attempts -> failed"""
+        if not image_ids:
+            return
+        now = _utcnow()
+        jobs = EmbeddingJob.query.filter(
+            EmbeddingJob.image_id.in_([int(i) for i in image_ids]),
+            EmbeddingJob.state == EmbeddingJob.STATE_RUNNING,
+            EmbeddingJob.lease_owner == worker_id
+        ).all()
+        for job in jobs:
+            job.last_error = str(error)[:1000]
+            job.lease_owner = None
+            job.lease_expires_at = None
+            if job.attempts >= self.max_attempts:
+                job.state = EmbeddingJob.STATE_FAILED
+            else:
+                delay = min(self.backoff_base * 2 ** max(job.attempts - 1, 0), self.backoff_max)
+                job.state = EmbeddingJob.STATE_PENDING
+                job.next_run_at = now + timedelta(seconds=delay)
+        db.session.commit()
+
+    def claimable_count(self):
+        """Số job có thể nhận ngay (độ dài queue cho adaptive batching)"""
+        return db.session.query(func.count(EmbeddingJob.job_id))\
+                         .filter(self._claimable(_utcnow())).scalar()
+
+    def stats(self):
+        counts = dict(db.session.query(EmbeddingJob.state, func.count(EmbeddingJob.job_id))
+                                .group_by(EmbeddingJob.state).all())
+        return {state: counts.get(state, 0) for state in (
+            EmbeddingJob.STATE_PENDING, EmbeddingJob.STATE_RUNNING,
+            EmbeddingJob.STATE_DONE, EmbeddingJob.STATE_FAILED
+        )}
+
+
+# Singleton instance
+job_queue = EmbeddingJobQueue(
+    lease_seconds=Config.EMBED_JOB_LEASE_SECONDS,
+    max_attempts=Config.EMBED_JOB_MAX_ATTEMPTS,
+    backoff_base=Config.EMBED_JOB_BACKOFF_BASE,
+    backoff_max=Config.EMBED_JOB_BACKOFF_MAX
+)
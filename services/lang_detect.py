@@ -0,0 +1,54 @@
+# services/lang_detect.py
+import re
+import unicodedata
+
+# Chữ cái chỉ có trong tiếng Việt: ă â đ ê ô ơ ư (kể cả khi mang dấu thanh)
+# và dấu hỏi / ngã / nặng trên nguyên âm. Không gồm á, à, é, ... vì các dấu này
+# cũng có trong từ mượn tiếng Anh và tiếng Pháp/Tây Ban Nha (café, résumé).
+# ã, õ cũng có trong tiếng Bồ Đào Nha (São Paulo) nhưng vẫn giữ: dịch thừa một
+# query như vậy vô hại, bỏ sót "ngã ba", "bão" thì search sai.
+VIETNAMESE_CHARS = set(
+    'ăằắẳẵặâầấẩẫậđêềếểễệôồốổỗộơờớởỡợưừứửữự'
+    'ảãạẻẽẹỉĩịỏõọủũụỷỹỵ'
+)
+
+# Các âm tiết tiếng Việt phổ biến khi gõ không dấu (kể cả trong địa danh: ha noi,
+# sai gon, vung tau), đã bỏ các từ trùng với từ / tên / viết tắt tiếng Anh thông
+# dụng (an, to, me, do, bay, song, con, long, hue, ho, ...)
+UNACCENTED_VIETNAMESE_WORDS = {
+    'anh', 'ao', 'bai', 'bien', 'bong', 'buc', 'cac', 'cai', 'canh', 'chi', 'cho',
+    'choi', 'chu', 'chung', 'cua', 'cuoi', 'da', 'dang', 'dau', 'dem', 'dep', 'di',
+    'dien', 'du', 'duoi', 'duong', 'gai', 'ga', 'gan', 'gio', 'gon', 'ha', 'hai',
+    'hinh', 'hoa', 'hoc', 'khi', 'khong', 'lat', 'len', 'lon', 'mau', 'meo', 'minh',
+    'moi', 'mot', 'mua', 'mui', 'nang', 'ngay', 'nguoi', 'nha', 'nhieu', 'nho',
+    'nhung', 'noi', 'nuoc', 'nui', 'ong', 'phong', 'phu', 'quan', 'quoc', 'rat',
+    'sai', 'tau', 'thanh', 'tho', 'toi', 'trai', 'trang', 'tren', 'trong', 'tu',
+    'va', 'vang', 'vinh', 'voi', 'vung', 'vuon', 'xanh', 'xe'
+}
+
+_TOKEN_RE = re.compile(r'[^\W\d_]+', re.UNICODE)
+
+
+def _strip_accents(token):
+    return ''.join(ch for ch in unicodedata.normalize('NFD', token)
+                   if not unicodedata.combining(ch))
+
+
+def is_vietnamese(text, min_unaccented_ratio=0.5):
+    """
+    Heuristic nhận diện query tiếng Việt:
+    - Có chữ cái đặc trưng tiếng Việt -> tiếng Việt.
+    - Không dấu (hoặc chỉ có dấu sắc/huyền như "chó mèo"): tỉ lệ từ (đã bỏ dấu)
+      thuộc nhóm âm tiết tiếng Việt phổ biến >= ngưỡng.
+    Các query còn lại (tiếng Anh, keyword, mã số) coi như không cần dịch.
+    """
+    text = unicodedata.normalize('NFC', text.lower())
+    if any(ch in VIETNAMESE_CHARS for ch in text):
+        return True
+
+    tokens = [_strip_accents(token) for token in _TOKEN_RE.findall(text)]
+    if not tokens:
+        return False
+
+    matches = sum(1 for token in tokens if token in UNACCENTED_VIETNAMESE_WORDS)
+    return matches / len(tokens) >= min_unaccented_ratio
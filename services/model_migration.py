@@ -0,0 +1,219 @@
+# services/model_migration.py
+from threading import Event, Lock
+import time
+import os
+import numpy as np
+import faiss
+from flask import current_app
+from sqlalchemy import and_, exists, func
+from models import Image, ImageEmbedding
+from services.ai_service import ai_service, model_tag
+from services.job_queue import job_queue
+from services.vector_codec import encode_vector
+from config import Config
+
+
+class ModelMigration:
+    """
+    Re-embed toàn bộ ảnh bằng model mới trong nền, trong lúc service vẫn
+    search/embed bằng model cũ:
+      - load model mới riêng, dựng shadow index từ file ảnh gốc theo batch
+        (giới hạn ảnh/giây, nhường khi queue job embedding đang có việc)
+      - tiến độ là các dòng image_embeddings (image_id, model mới): chạy lại sau
+        restart chỉ nạp lại vector đã có từ DB rồi làm tiếp phần còn thiếu
+      - xong thì AIService.switch_model chuyển index + encoder một lần, sau đó
+        sweep các ảnh còn thiếu (upload/thay file trong lúc chuyển) vào queue job
+    """
+
+    STATE_IDLE = 'idle'
+    STATE_RUNNING = 'running'
+    STATE_SWITCHING = 'switching'
+    STATE_DONE = 'done'
+    STATE_FAILED = 'failed'
+
+    def __init__(self, batch_size=16, max_rate=10.0, yield_to_jobs=True):
+        self.batch_size = batch_size
+        self.max_rate = max_rate
+        self.yield_to_jobs = yield_to_jobs
+        self._lock = Lock()
+        self._stop = Event()
+        self.state = self.STATE_IDLE
+        self.target = None
+        self.total = 0
+        self.embedded = 0
+        self.failed = 0
+        self.error = None
+        self.started_at = None
+        # image_id bị xóa/thay file trong lúc re-embed (AIService.remove_from_index ghi vào)
+        self.removed = set()
+
+    def start(self, app, model_name):
+        """Chạy run trong thread nền; bỏ qua nếu đang có lần re-embed khác"""
+        with self._lock:
+            if self.state in (self.STATE_RUNNING, self.STATE_SWITCHING):
+                return False
+            self.state = self.STATE_RUNNING
+        self._stop.clear()
+        ai_service._run_in_background(app, "model-migration", self.run, model_name, app)
+        return True
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self, session, model_name, app=None):
+        tag = model_tag(model_name)
+        if tag == ai_service.model_tag:
+            print(f"Embedding model {model_name} is already active")
+            self.state = self.STATE_IDLE
+            return False
+
+        self.state = self.STATE_RUNNING
+        self.target = model_name
+        self.embedded = self.failed = 0
+        self.error = None
+        self.started_at = time.time()
+        try:
+            model, processor = ai_service.load_clip(model_name)
+            dimension = model.config.projection_dim
+            shadow = ai_service._new_base_index(dimension)
+
+            with ai_service._index_lock:
+                self.removed = set()
+                ai_service.reembedding = self
+
+            # Tiếp tục lần chạy trước: vector của model mới đã có trong DB
+            for ids, vectors in ai_service._iter_embedding_chunks(session, model=tag, dimension=dimension):
+                shadow.add_with_ids(vectors, ids)
+            self.embedded = shadow.ntotal
+            self.total = session.query(func.count(Image.image_id)).scalar() or 0
+            print(f"Re-embedding {self.total} images with {model_name} ({self.embedded} already done)")
+
+            if not self._reembed_missing(session, tag, model, processor, shadow):
+                print("Re-embedding stopped, progress is kept in image_embeddings")
+                self.state = self.STATE_IDLE
+                return False
+
+            self._switch(session, model_name, model, processor, shadow)
+            if app is not None and ai_service.should_migrate_index():
+                ai_service.start_index_migration(app)
+            return True
+        except Exception as e:
+            print(f"Error re-embedding with {model_name}: {str(e)}")
+            session.rollback()
+            self.state = self.STATE_FAILED
+            self.error = str(e)
+            raise
+        finally:
+            with ai_service._index_lock:
+                if ai_service.reembedding is self:
+                    ai_service.reembedding = None
+
+    def _reembed_missing(self, session, tag, model, processor, shadow):
+        """Embed theo thứ tự image_id các ảnh chưa có embedding của model mới"""
+        upload_folder = current_app.config['UPLOAD_FOLDER']
+        not_embedded = ~exists().where(and_(ImageEmbedding.image_id == Image.image_id,
+                                            ImageEmbedding.model == tag))
+        cursor = 0
+        while not self._stop.is_set():
+            if self.yield_to_jobs and job_queue.claimable_count():
+                # Ưu tiên ảnh người dùng vừa upload
+                self._stop.wait(Config.EMBED_JOB_POLL_INTERVAL)
+                continue
+
+            started = time.time()
+            with ai_service._index_lock:
+                removed_before = set(self.removed)
+            rows = session.query(Image.image_id, Image.file_path)\
+                          .filter(Image.image_id > cursor, not_embedded)\
+                          .order_by(Image.image_id)\
+                          .limit(self.batch_size).all()
+            if not rows:
+                return True
+            cursor = rows[-1].image_id
+
+            image_ids, images = [], []
+            for row in rows:
+                try:
+                    images.append(ai_service.open_image(os.path.join(upload_folder, row.file_path)))
+                    image_ids.append(row.image_id)
+                except Exception as e:
+                    # Sau khi chuyển model, sweep sẽ đưa ảnh này vào queue job (có retry)
+                    print(f"Error opening image {row.image_id} for re-embedding: {str(e)}")
+                    self.failed += 1
+            if image_ids:
+                vectors = ai_service.encode_pixel_values(ai_service.preprocess_images(images, processor), model)
+                session.query(ImageEmbedding)\
+                       .filter(ImageEmbedding.image_id.in_(image_ids), ImageEmbedding.model == tag)\
+                       .delete(synchronize_session=False)
+                session.bulk_save_objects([
+                    ImageEmbedding(
+                        image_id=image_id,
+                        embedding_vector=encode_vector(vectors[idx], Config.EMBEDDING_STORAGE_FORMAT),
+                        model=tag
+                    )
+                    for idx, image_id in enumerate(image_ids)
+                ])
+                session.commit()
+                with ai_service._index_lock:
+                    shadow.add_with_ids(vectors, np.array(image_ids, dtype=np.int64))
+                    # Ảnh bị thay file trước khi batch này đọc file thì vector mới đã đúng;
+                    # ảnh bị xóa/thay trong lúc batch chạy vẫn giữ lại để bỏ khi chuyển
+                    self.removed.difference_update(removed_before.intersection(image_ids))
+                self.embedded += len(image_ids)
+
+            if self.max_rate > 0:
+                # Giới hạn số ảnh/giây để không chiếm hết CPU của web tier
+                self._stop.wait(max(0.0, len(rows) / self.max_rate - (time.time() - started)))
+        return False
+
+    def _switch(self, session, model_name, model, processor, shadow):
+        self.state = self.STATE_SWITCHING
+        # Không chuyển khi đang migrate/compact index cũ
+        while not ai_service._begin_rebuild():
+            time.sleep(1)
+        try:
+            with ai_service._index_lock:
+                removed = np.fromiter(self.removed, dtype=np.int64)
+                ai_service.reembedding = None
+                if len(removed):
+                    shadow.remove_ids(faiss.IDSelectorBatch(removed))
+                    # Ảnh bị thay file: bỏ vector mới đã embed từ file cũ để sweep embed lại
+                    for start in range(0, len(removed), 900):
+                        session.query(ImageEmbedding).filter(
+                            ImageEmbedding.image_id.in_(removed[start:start + 900].tolist()),
+                            ImageEmbedding.model == model_tag(model_name)
+                        ).delete(synchronize_session=False)
+                    session.commit()
+                ai_service.switch_model(model_name, model, processor, shadow)
+        finally:
+            ai_service._end_rebuild()
+
+        if ai_service.vector_store is not None:
+            ai_service.fill_vector_store(session)
+
+        queued = job_queue.sweep_unembedded(model=ai_service.model_tag)
+        if queued:
+            print(f"Queued {queued} images still missing {model_name} embeddings")
+        self.state = self.STATE_DONE
+
+    def stats(self):
+        elapsed = time.time() - self.started_at if self.started_at else 0.0
+        return {
+            'active_model': ai_service.model_name,
+            'target_model': self.target,
+            'state': self.state,
+            'embedded': self.embedded,
+            'total': self.total,
+            'failed': self.failed,
+            'progress': self.embedded / self.total if self.total else 0.0,
+            'elapsed_s': elapsed,
+            'error': self.error
+        }
+
+
+# Singleton instance
+model_migration = ModelMigration(
+    batch_size=Config.REEMBED_BATCH_SIZE,
+    max_rate=Config.REEMBED_MAX_IMAGES_PER_SEC,
+    yield_to_jobs=Config.REEMBED_YIELD_TO_JOBS
+)
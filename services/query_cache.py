@@ -0,0 +1,150 @@
+# services/query_cache.py
+from collections import OrderedDict
+import threading
+import time
+import os
+import re
+import numpy as np
+
+
+def normalize_query(text):
+    """Chuẩn hóa query để làm key cache: bỏ khoảng trắng thừa, viết thường"""
+    return re.sub(r'\s+', ' ', text).strip().lower()
+
+
+class QueryEmbeddingCache:
+    """
+    LRU + TTL cache: query đã chuẩn hóa -> (translated_text, embedding).
+    Giới hạn theo tổng số byte của các embedding và text đang giữ.
+    Có thể ghi ra file .npz (spill_path) để giữ cache qua các lần restart:
+    mảng key / text đã dịch / thời điểm tạo + ma trận embedding, đọc lại bằng
+    np.load không cần pickle (file bị sửa không thể chạy code khi load).
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=3600, spill_path=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.spill_path = spill_path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.spill_path:
+            self.load()
+
+    @staticmethod
+    def _entry_size(key, translated_text, embedding):
+        return embedding.nbytes + len(key.encode('utf-8')) + len(translated_text.encode('utf-8'))
+
+    def get(self, query):
+        """Trả về (translated_text, embedding) hoặc None nếu miss/hết hạn"""
+        return self._lookup(query, count=True)
+
+    def peek(self, query):
+        """Giống get nhưng không tính vào hits/misses (kiểm tra lại sau một lần get)"""
+        return self._lookup(query, count=False)
+
+    def _lookup(self, query, count):
+        key = normalize_query(query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if count:
+                    self.misses += 1
+                return None
+
+            translated_text, embedding, created_at, size = entry
+            if self.ttl and time.time() - created_at > self.ttl:
+                del self._entries[key]
+                self.current_bytes -= size
+                if count:
+                    self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            if count:
+                self.hits += 1
+            return translated_text, embedding.copy()
+
+    def put(self, query, translated_text, embedding, created_at=None):
+        key = normalize_query(query)
+        size = self._entry_size(key, translated_text, embedding)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[3]
+
+            self._entries[key] = (translated_text, embedding.copy(), created_at or time.time(), size)
+            self.current_bytes += size
+
+            # Loại bỏ các entry ít dùng nhất khi vượt giới hạn bộ nhớ
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted[3]
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+    def save(self):
+        """Ghi các entry còn hạn ra spill_path"""
+        if not self.spill_path:
+            return
+        try:
+            with self._lock:
+                entries = [
+                    (key, translated_text, embedding, created_at)
+                    for key, (translated_text, embedding, created_at, _) in self._entries.items()
+                ]
+            tmp_path = self.spill_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.savez(
+                    f,
+                    keys=np.array([entry[0] for entry in entries], dtype=str),
+                    translated=np.array([entry[1] for entry in entries], dtype=str),
+                    created_at=np.array([entry[3] for entry in entries], dtype=np.float64),
+                    embeddings=(np.vstack([entry[2] for entry in entries]).astype(np.float32, copy=False)
+                                if entries else np.empty((0, 0), dtype=np.float32))
+                )
+            os.replace(tmp_path, self.spill_path)
+            print(f"Query cache saved to {self.spill_path} ({len(entries)} entries)")
+        except Exception as e:
+            print(f"Error saving query cache: {str(e)}")
+
+    def load(self):
+        """Nạp lại cache từ spill_path, bỏ qua các entry đã hết hạn"""
+        if not self.spill_path or not os.path.exists(self.spill_path):
+            return
+        try:
+            with np.load(self.spill_path, allow_pickle=False) as data:
+                entries = list(zip(data['keys'].tolist(), data['translated'].tolist(),
+                                   data['embeddings'], data['created_at'].tolist()))
+            now = time.time()
+            for key, translated_text, embedding, created_at in entries:
+                if self.ttl and now - created_at > self.ttl:
+                    continue
+                self.put(key, translated_text, embedding, created_at=created_at)
+            print(f"Query cache loaded from {self.spill_path} ({len(self._entries)} entries)")
+        except Exception as e:
+            print(f"Error loading query cache: {str(e)}")
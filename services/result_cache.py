@@ -0,0 +1,103 @@
+# services/result_cache.py
+from collections import OrderedDict
+import threading
+import hashlib
+import base64
+import json
+import time
+import numpy as np
+from config import Config
+from services.query_cache import normalize_query
+
+
+def query_fingerprint(kind, *parts):
+    """Fingerprint của một search: loại search + query (text / bytes ảnh / image_id) + tham số"""
+    digest = hashlib.sha1(kind.encode('utf-8'))
+    for part in parts:
+        if isinstance(part, str):
+            part = normalize_query(part)
+        if not isinstance(part, bytes):
+            part = repr(part).encode('utf-8')
+        digest.update(b'\x00' + part)
+    return digest.hexdigest()
+
+
+def encode_cursor(fingerprint, version, offset, per_page):
+    """Cursor opaque cho trang tiếp theo của một kết quả đã cache"""
+    payload = json.dumps({'f': fingerprint, 'v': version, 'o': offset, 'n': per_page}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Trả về (fingerprint, version, offset, per_page); ValueError nếu cursor không hợp lệ"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        fingerprint, version, offset, per_page = data['f'], data['v'], int(data['o']), int(data['n'])
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if offset < 0 or per_page < 1:
+        raise ValueError('Invalid cursor')
+    return fingerprint, version, offset, per_page
+
+
+class SearchResultCache:
+    """
+    LRU + TTL cache: (user_id, fingerprint) -> (index version, danh sách image_id
+    đã xếp hạng kèm score, tổng số kết quả). Khi index thay đổi (add/xóa ảnh
+    của user, swap index) version đổi nên entry cũ không còn được dùng.
+    """
+
+    def __init__(self, max_entries=10000, ttl=600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, fingerprint, version):
+        """Trả về (ids, scores, total) hoặc None nếu miss / hết hạn / version cũ"""
+        key = (int(user_id), fingerprint)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] != version or (self.ttl and time.time() - entry[4] > self.ttl)):
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1:4]
+
+    def put(self, user_id, fingerprint, version, ranked, total):
+        """ranked: list (image_id, score) đã lọc theo DB và sắp xếp theo score"""
+        ids = np.array([int(image_id) for image_id, _ in ranked], dtype=np.int64)
+        scores = np.array([float(score) for _, score in ranked], dtype=np.float32)
+        with self._lock:
+            # Mỗi (user, query) chỉ giữ kết quả của version mới nhất
+            self._entries[(int(user_id), fingerprint)] = (version, ids, scores, total, time.time())
+            self._entries.move_to_end((int(user_id), fingerprint))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return ids, scores, total
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+# Singleton instance
+result_cache = SearchResultCache(
+    max_entries=Config.RESULT_CACHE_MAX_ENTRIES,
+    ttl=Config.RESULT_CACHE_TTL
+)
@@ -0,0 +1,81 @@
+# services/result_hydrator.py
+from models import Image
+
+# Giới hạn số tham số trong một câu IN (...) của SQLite
+IN_QUERY_CHUNK_SIZE = 900
+
+
+def _fetch_rows(user_id, candidate_ids, columns=None):
+    """image_id -> row (chỉ ảnh của user), query IN (...) chia chunk"""
+    columns = columns or (Image.image_id, Image.title, Image.description, Image.file_path)
+    rows_by_id = {}
+    for start in range(0, len(candidate_ids), IN_QUERY_CHUNK_SIZE):
+        rows = Image.query.with_entities(*columns).filter(
+            Image.user_id == user_id,
+            Image.image_id.in_(candidate_ids[start:start + IN_QUERY_CHUNK_SIZE])
+        ).all()
+        rows_by_id.update((row.image_id, row) for row in rows)
+    return rows_by_id
+
+
+def _to_result(row, score):
+    return {
+        'image_id': row.image_id,
+        'title': row.title,
+        'description': row.description,
+        'file_path': row.file_path,
+        'similarity_score': float(score)
+    }
+
+
+def rank_hits(user_id, hits, total=None):
+    """
+    Lọc kết quả FAISS theo DB: bỏ các id không còn trong DB / không thuộc user,
+    giữ nguyên thứ tự score. Chỉ query cột image_id (IN (...) chia chunk).
+    total: tổng số kết quả khi hits đã bị cắt bớt (range search có giới hạn).
+    Trả về (ranked, total).
+    """
+    existing = _fetch_rows(user_id, [int(image_id) for image_id, _ in hits], (Image.image_id,))
+    ranked = [(int(image_id), score) for image_id, score in hits if int(image_id) in existing]
+
+    # Trừ đi các id bị bỏ trong phần hits đang có; phần bị cắt bớt giữ nguyên
+    total = len(ranked) if total is None else max(total - (len(hits) - len(ranked)), len(ranked))
+    return ranked, total
+
+
+def build_page(user_id, ids, scores, total, offset, per_page):
+    """
+    Dựng một trang từ danh sách id đã xếp hạng: chỉ query thông tin của các
+    ảnh trong trang (ids/scores là mảng song song, offset tính theo phần tử).
+    """
+    window_ids = [int(image_id) for image_id in ids[offset:offset + per_page]]
+    rows_by_id = _fetch_rows(user_id, window_ids) if window_ids else {}
+    results = [
+        _to_result(rows_by_id[image_id], score)
+        for image_id, score in zip(window_ids, scores[offset:offset + per_page])
+        if image_id in rows_by_id
+    ]
+
+    return {
+        'results': results,
+        'pagination': {
+            'total': total,
+            # Chỉ phân trang được trên phần kết quả đã lấy về
+            'pages': (len(ids) + per_page - 1) // per_page,
+            'current_page': offset // per_page + 1,
+            'per_page': per_page
+        }
+    }
+
+
+def hydrate_batch(user_id, hits_per_query):
+    """
+    Gắn thông tin ảnh cho kết quả của nhiều query (batch search): gom id của
+    tất cả query vào cùng một lượt query DB. Trả về list kết quả cho từng query.
+    """
+    candidate_ids = sorted({int(image_id) for hits in hits_per_query for image_id, _ in hits})
+    rows_by_id = _fetch_rows(user_id, candidate_ids) if candidate_ids else {}
+    return [
+        [_to_result(rows_by_id[int(image_id)], score) for image_id, score in hits if int(image_id) in rows_by_id]
+        for hits in hits_per_query
+    ]
@@ -0,0 +1,82 @@
+# services/rw_lock.py
+from contextlib import contextmanager
+import threading
+
+
+class ReadWriteLock:
+    """
+    Lock nhiều reader / một writer cho FAISS index: search (const) chạy song
+    song với nhau, add/remove/thay index cần độc quyền.
+      - `with lock:` lấy quyền ghi (reentrant cho thread đang giữ, giống RLock)
+      - `with lock.read():` lấy quyền đọc; thread đang giữ quyền ghi hoặc đọc
+        được lấy lại quyền đọc mà không chờ
+    Writer được ưu tiên: khi có writer đang chờ, reader mới phải chờ để add
+    không bị đói khi search liên tục. Không hỗ trợ nâng quyền đọc lên ghi.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._write_depth = 0
+        self._writers_waiting = 0
+        self._local = threading.local()
+
+    def _read_depth(self):
+        return getattr(self._local, 'depth', 0)
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me and self._read_depth() == 0:
+                while self._writer is not None or self._writers_waiting:
+                    self._cond.wait()
+            self._readers += 1
+        self._local.depth = self._read_depth() + 1
+
+    def release_read(self):
+        self._local.depth = self._read_depth() - 1
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    def acquire(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._write_depth += 1
+                return True
+            if self._read_depth():
+                raise RuntimeError("Cannot upgrade a read lock to a write lock")
+            self._writers_waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = me
+            self._write_depth = 1
+            return True
+
+    def release(self):
+        with self._cond:
+            if self._writer != threading.get_ident():
+                raise RuntimeError("Cannot release a write lock held by another thread")
+            self._write_depth -= 1
+            if self._write_depth == 0:
+                self._writer = None
+                self._cond.notify_all()
+
+    __enter__ = acquire
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
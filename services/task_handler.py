@@ -1,21 +1,63 @@
 # services/task_handler.py
-from threading import Thread
-from queue import Queue
+from threading import Thread, Event, Lock
 import time
 from database.db import db
-from models import Image, ImageEmbedding
+from models import Image
 from services.ai_service import ai_service
-import numpy as np
+from services.embedding_pipeline import EmbeddingPipeline
+from services.adaptive_batcher import embedding_batcher
+from services.job_queue import job_queue, default_worker_id
+from config import Config
 import os
-from queue import Queue, Empty
 
 class TaskHandler:
+    """
+    Chạy các job sinh embedding lưu trong bảng embedding_jobs: nhận job theo
+    batch (có lease), đưa vào EmbeddingPipeline, đánh dấu done/failed khi xong.
+    Job nằm trong DB nên restart/crash không làm mất ảnh chưa được embed.
+    Kích thước batch và thời gian chờ gom do embedding_batcher quyết định.
+    """
+
     def __init__(self):
-        self.task_queue = Queue()
-        self.batch_size = 100
-        self.batch_timeout = 10
+        self.app = None
+        self.batcher = embedding_batcher
+        self.is_running = False
+        self.worker_id = default_worker_id()
+        self._wakeup = Event()
+        self._in_flight = 0
+        self._in_flight_lock = Lock()
+        self._claimed_at = {}  # image_id -> thời điểm nhận job, để đo độ trễ tới khi vào index
+        self.pipeline = None
+        self.worker_thread = None
+        self.backup_thread = None
+
+    def init_app(self, app):
+        """Quét ảnh chưa có embedding rồi bắt đầu xử lý job (gọi một lần khi khởi động)"""
+        if self.is_running:
+            return
+        self.app = app
+
+        if Config.EMBED_SWEEP_ON_STARTUP:
+            with app.app_context():
+                queued = job_queue.sweep_unembedded(model=ai_service.model_tag)
+                if queued:
+                    print(f"Queued {queued} images without embeddings")
+
         self.is_running = True
-        self.worker_thread = Thread(target=self._process_tasks)
+        if Config.EMBED_WORKER_MODE == 'pool':
+            # Job do worker pool (embed_workers.py) xử lý; web tier chỉ đưa
+            # các embedding mới trong DB vào FAISS index
+            self.worker_thread = Thread(target=self._follow_index)
+        else:
+            self.pipeline = EmbeddingPipeline(
+                decode_workers=Config.EMBED_DECODE_WORKERS,
+                inference_workers=Config.EMBED_INFERENCE_WORKERS,
+                writer_workers=Config.EMBED_WRITER_WORKERS,
+                queue_size=Config.EMBED_QUEUE_SIZE,
+                inference_batch_size=Config.EMBED_INFERENCE_BATCH_SIZE,
+                batcher=self.batcher
+            )
+            self.worker_thread = Thread(target=self._process_tasks)
         self.worker_thread.daemon = True
         self.worker_thread.start()
 
@@ -24,123 +66,150 @@ class TaskHandler:
         self.backup_thread.daemon = True
         self.backup_thread.start()
 
-        
     def _periodic_backup(self):
         while self.is_running:
             try:
-                # Backup mỗi 5 phút
+                # Snapshot mỗi 5 phút để WAL không dài ra mãi
                 time.sleep(300)
                 from services.ai_service import ai_service
-                ai_service.save_faiss_index("faiss_index.bin")
-                print("Periodic FAISS index backup completed")
+                # WAL trống (không có thay đổi từ snapshot trước) thì không ghi lại
+                if ai_service.save_faiss_index():
+                    print("Periodic FAISS index snapshot completed")
             except Exception as e:
                 print(f"Error in periodic backup: {str(e)}")
-          
-    def _process_tasks(self):
+
+    def _follow_index(self):
+        """Định kỳ thêm vào index các embedding mà worker pool đã ghi vào DB"""
+        watermark = 0
         while self.is_running:
             try:
-                batch = []
-                batch_start = time.time()
-
-                while len(batch) < self.batch_size and \
-                      time.time() - batch_start < self.batch_timeout:
-                    try:
-                        task = self.task_queue.get(timeout=0.5)
-                        batch.append(task)
-                    except Empty:  # Sử dụng Empty thay vì Queue.Empty
-                        if batch:
-                            break
-                        continue
+                with self.app.app_context():
+                    watermark, added = ai_service.sync_index_from_db(db.session, watermark)
+                    if added:
+                        print(f"Added {added} embeddings from worker pool to the index")
+                        # Index Flat đã đủ lớn -> chuyển sang ANN trong nền
+                        if ai_service.should_migrate_index():
+                            ai_service.start_index_migration(self.app)
+            except Exception as e:
+                print(f"Error syncing index from database: {str(e)}")
+            self._wakeup.wait(Config.EMBED_INDEX_SYNC_INTERVAL)
+            self._wakeup.clear()
+
+    def _claim_batch(self):
+        """
+        Gom job thành batch: mỗi vòng hỏi batcher kích thước batch và thời gian
+        chờ tối đa theo độ dài queue hiện tại. Queue dài -> gửi ngay batch lớn;
+        ít ảnh -> chờ thêm tối đa max_wait để gom rồi gửi, giữ độ trễ trong SLO.
+        Không nhận thêm khi pipeline đang giữ quá EMBED_JOB_MAX_IN_FLIGHT ảnh.
+        """
+        batch = []
+        first_claimed = None
+        while self.is_running:
+            waited = time.time() - first_claimed if batch else 0.0
+            with self.app.app_context():
+                queue_depth = len(batch) + job_queue.claimable_count()
+            batch_size, max_wait = self.batcher.plan(queue_depth, waited)
+            if len(batch) >= batch_size:
+                break
+
+            with self._in_flight_lock:
+                capacity = Config.EMBED_JOB_MAX_IN_FLIGHT - self._in_flight - len(batch)
+            claimed = []
+            if capacity > 0 and queue_depth > len(batch):
+                with self.app.app_context():
+                    claimed = job_queue.claim(self.worker_id, min(batch_size - len(batch), capacity))
+            if claimed:
+                if not batch:
+                    first_claimed = time.time()
+                batch.extend(claimed)
+                continue
+            if batch and waited >= max_wait:
+                break
+            self._wakeup.wait(max_wait - waited if batch else Config.EMBED_JOB_POLL_INTERVAL)
+            self._wakeup.clear()
+        return batch
 
+    def _process_tasks(self):
+        while self.is_running:
+            try:
+                batch = self._claim_batch()
                 if batch:
                     self._handle_batch_embedding(batch)
-                    
             except Exception as e:
                 print(f"Error processing batch: {str(e)}")
+                time.sleep(Config.EMBED_JOB_POLL_INTERVAL)
+
     def _handle_batch_embedding(self, batch):
+        image_ids = [image_id for _, image_id, _ in batch]
         try:
-            app = batch[0]['app']  # Lấy app context từ task đầu tiên
-            
-            with app.app_context():
-                embeddings = []
-                image_ids = []
-
-                # 1. Tạo embeddings cho cả batch
-                for task in batch:
-                    image_id = task['image_id']
-                    image = Image.query.get(image_id)
-                    if not image:
-                        continue
-                        
-                    image_path = os.path.join(app.config['UPLOAD_FOLDER'], image.file_path)
-                    embedding = ai_service.get_image_embedding(image_path)
-                    
-                    embeddings.append(embedding)
-                    image_ids.append(image_id)
-
-                if not embeddings:
-                    return
-
-                # 2. Lưu vào database trong một transaction
-                image_embedding_objects = []
-                for idx, image_id in enumerate(image_ids):
-                    image_embedding = ImageEmbedding(
-                        image_id=image_id,
-                        embedding_vector=embeddings[idx].tobytes(),
-                        model='clip-vit-large-patch14'
-                    )
-                    image_embedding_objects.append(image_embedding)
-
-                db.session.bulk_save_objects(image_embedding_objects)
-                db.session.commit()
-
-                # 3. Thêm vào FAISS index trong một lần
-                embeddings_array = np.vstack(embeddings).astype(np.float32)
-                ids_array = np.array(image_ids, dtype=np.int64)
-                ai_service.add_batch_to_index(embeddings_array, ids_array)
-
-                print(f"Processed batch of {len(batch)} images")
+            with self.app.app_context():
+                # Lấy thông tin ảnh của cả batch trong một query
+                images = Image.query.with_entities(Image.image_id, Image.file_path, Image.user_id)\
+                                    .filter(Image.image_id.in_(image_ids)).all()
+                images_by_id = {image.image_id: image for image in images}
+
+                # Ảnh đã bị xóa thì không cần embed nữa
+                missing = [image_id for image_id in image_ids if image_id not in images_by_id]
+                job_queue.complete(self.worker_id, missing)
+
+            items = [
+                (image_id,
+                 os.path.join(self.app.config['UPLOAD_FOLDER'], images_by_id[image_id].file_path),
+                 images_by_id[image_id].user_id)
+                for image_id in image_ids if image_id in images_by_id
+            ]
+            if not items:
+                return
+
+            self._track_in_flight(len(items), [item[0] for item in items])
+            # Decode/preprocess, inference và ghi DB/FAISS chạy chồng lấp trong pipeline;
+            # batch đã được batcher giới hạn theo bộ nhớ nên chạy inference một lần
+            self.pipeline.submit(self.app, items, on_written=self._on_written, on_failed=self._on_failed,
+                                 batch_size=len(items))
 
         except Exception as e:
-            db.session.rollback()
             print(f"Error processing embedding batch: {str(e)}")
-    def _handle_embedding_generation(self, task):
-        try:
-            app = task['app']
-            image_id = task['image_id']
-            
-            with app.app_context():
-                # Lấy image từ DB
-                image = Image.query.get(image_id)
-                if not image:
-                    return
-                
-                # Tạo embedding
-                image_path = os.path.join(app.config['UPLOAD_FOLDER'], image.file_path)
-                embedding = ai_service.get_image_embedding(image_path)
-                
-                # Lưu embedding vào DB
-                image_embedding = ImageEmbedding(
-                    image_id=image_id,
-                    embedding_vector=embedding.tobytes(),
-                    model='clip-vit-large-patch14'
-                )
-                
-                db.session.add(image_embedding)
-                db.session.commit()
-                
-                # Thêm vào Faiss index
-                ai_service.add_to_index(embedding, image_id)
-                
-        except Exception as e:
-            print(f"Error generating embedding: {str(e)}")
+            with self.app.app_context():
+                job_queue.fail(self.worker_id, image_ids, e)
+
+    def _track_in_flight(self, delta, image_ids=()):
+        now = time.time()
+        with self._in_flight_lock:
+            self._in_flight += delta
+            if delta > 0:
+                self._claimed_at.update((image_id, now) for image_id in image_ids)
+                return []
+            return [now - self._claimed_at.pop(image_id) for image_id in image_ids
+                    if image_id in self._claimed_at]
+
+    def _on_written(self, image_ids):
+        # Gọi trong app context của writer
+        for latency in self._track_in_flight(-len(image_ids), image_ids):
+            self.batcher.record_latency(latency)
+        job_queue.complete(self.worker_id, image_ids)
+
+    def _on_failed(self, image_ids, error):
+        self._track_in_flight(-len(image_ids), image_ids)
+        with self.app.app_context():
+            job_queue.fail(self.worker_id, image_ids, error)
 
-    def add_task(self, task_type, **kwargs):
-        self.task_queue.put({'type': task_type, **kwargs})
+    def add_task(self, task_type, image_id=None, image_ids=None, **kwargs):
+        """
+        Ghi job vào bảng embedding_jobs (gọi trong app context, sau khi ảnh
+        đã được commit). task_type hiện chỉ có 'generate_embedding'.
+        """
+        ids = list(image_ids or []) + ([image_id] if image_id is not None else [])
+        job_queue.enqueue(ids)
+        self._wakeup.set()
 
     def stop(self):
+        if not self.is_running:
+            return
         self.is_running = False
+        self._wakeup.set()
         self.worker_thread.join()
+        if self.pipeline is not None:
+            self.pipeline.stop()
 
 # Singleton instance
 task_handler = TaskHandler()
@@ -0,0 +1,171 @@
+# services/translate_client.py
+from collections import deque
+from urllib.parse import urljoin
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from config import Config
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker đơn giản: sau failure_threshold lỗi (hoặc request quá chậm)
+    liên tiếp thì mở mạch trong reset_timeout giây, sau đó cho một request
+    thử lại (half-open) trước khi đóng mạch.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.time() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                return True
+            if self.state == self.HALF_OPEN:
+                # Chỉ cho một request thử trong trạng thái half-open
+                return False
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+
+class TranslateClient:
+    """
+    Client cho translate_service dùng session có connection pool (keep-alive),
+    timeout connect/read và circuit breaker. Khi service chậm hoặc lỗi,
+    trả về nguyên văn query để vẫn encode được.
+    """
+
+    def __init__(self, url, connect_timeout=0.5, read_timeout=2.0, max_retries=1,
+                 pool_size=10, failure_threshold=5, reset_timeout=30, slow_threshold=1.5):
+        self.url = url
+        self.timeout = (connect_timeout, read_timeout)
+        self.slow_threshold = slow_threshold
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+        self.session = requests.Session()
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=0.1,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(['POST'])
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._metrics_lock = threading.Lock()
+        self._latencies = deque(maxlen=1000)
+        self.requests = 0
+        self.failures = 0
+        self.fallbacks = 0
+
+    def _record_latency(self, latency):
+        with self._metrics_lock:
+            self.requests += 1
+            self._latencies.append(latency)
+
+    def translate(self, text):
+        """Dịch query vi -> en. Trả về text gốc nếu service không khả dụng"""
+        translated_text = self.try_translate(text)
+        return text if translated_text is None else translated_text
+
+    def try_translate(self, text):
+        """Dịch query vi -> en. Trả về None nếu service lỗi, chậm hoặc mạch đang mở"""
+        result = self._post(self.url, {'query': text})
+        return None if result is None else result['translated_text']
+
+    def try_translate_batch(self, texts):
+        """Dịch nhiều query trong một request (POST /batch). None nếu service không khả dụng"""
+        if not texts:
+            return []
+        result = self._post(urljoin(self.url, 'batch'), {'queries': list(texts)})
+        return None if result is None else result['translated_texts']
+
+    def _post(self, url, payload):
+        if not self.breaker.allow_request():
+            with self._metrics_lock:
+                self.fallbacks += 1
+            return None
+
+        start = time.perf_counter()
+        try:
+            response = self.session.post(url, json=payload, timeout=self.timeout)
+            response.raise_for_status()
+            result = response.json()
+        except Exception as e:
+            self._record_latency(time.perf_counter() - start)
+            self.breaker.record_failure()
+            with self._metrics_lock:
+                self.failures += 1
+                self.fallbacks += 1
+            print(f"Translate service unavailable, using original query: {str(e)}")
+            return None
+
+        latency = time.perf_counter() - start
+        self._record_latency(latency)
+        # Request quá chậm cũng tính là lỗi để breaker có thể mở mạch
+        if latency > self.slow_threshold:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return result
+
+    def metrics(self):
+        with self._metrics_lock:
+            latencies = sorted(self._latencies)
+            requests_count = self.requests
+            failures = self.failures
+            fallbacks = self.fallbacks
+
+        def percentile(p):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+        return {
+            'requests': requests_count,
+            'failures': failures,
+            'fallbacks': fallbacks,
+            'circuit_state': self.breaker.state,
+            'latency_avg': sum(latencies) / len(latencies) if latencies else 0.0,
+            'latency_p50': percentile(0.50),
+            'latency_p95': percentile(0.95),
+            'latency_p99': percentile(0.99)
+        }
+
+
+# Singleton instance
+translate_client = TranslateClient(
+    url=Config.TRANSLATE_SERVICE_URL,
+    connect_timeout=Config.TRANSLATE_CONNECT_TIMEOUT,
+    read_timeout=Config.TRANSLATE_READ_TIMEOUT,
+    max_retries=Config.TRANSLATE_MAX_RETRIES,
+    pool_size=Config.TRANSLATE_POOL_SIZE,
+    failure_threshold=Config.TRANSLATE_BREAKER_THRESHOLD,
+    reset_timeout=Config.TRANSLATE_BREAKER_RESET,
+    slow_threshold=Config.TRANSLATE_SLOW_THRESHOLD
+)
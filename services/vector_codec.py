@@ -0,0 +1,90 @@
+# services/vector_codec.py
+import struct
+import numpy as np
+
+# Blob trong image_embeddings.embedding_vector:
+#   - bản cũ (không header): float32 thô
+#   - bản mới: MAGIC + version + format code + payload
+MAGIC = b'VEC'
+FORMAT_VERSION = 1
+_HEADER = struct.Struct('<3sBB')
+
+FORMAT_FLOAT32 = 'float32'
+FORMAT_FLOAT16 = 'float16'
+FORMAT_INT8 = 'int8'
+
+_FORMAT_CODES = {FORMAT_FLOAT32: 0, FORMAT_FLOAT16: 1, FORMAT_INT8: 2}
+_CODE_FORMATS = {code: name for name, code in _FORMAT_CODES.items()}
+
+
+def encode_vector(vector, fmt=FORMAT_FLOAT32):
+    """
+    Encode một embedding thành blob có format tag.
+    int8: lượng tử hóa đối xứng theo từng vector, lưu kèm scale float32.
+    """
+    vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+    if fmt == FORMAT_FLOAT32:
+        payload = vector.tobytes()
+    elif fmt == FORMAT_FLOAT16:
+        payload = vector.astype('<f2').tobytes()
+    elif fmt == FORMAT_INT8:
+        max_abs = float(np.abs(vector).max()) or 1.0
+        scale = max_abs / 127.0
+        codes = np.clip(np.rint(vector / scale), -127, 127).astype(np.int8)
+        payload = struct.pack('<f', scale) + codes.tobytes()
+    else:
+        raise ValueError(f"Unknown embedding storage format: {fmt}")
+    return _HEADER.pack(MAGIC, FORMAT_VERSION, _FORMAT_CODES[fmt]) + payload
+
+
+def _blob_format(blob, dim):
+    """Trả về format của blob; None nếu là float32 thô bản cũ (đúng dim*4 byte)"""
+    if len(blob) == dim * 4:
+        return None
+    if blob[:3] != MAGIC:
+        raise ValueError(f"Unknown embedding blob of {len(blob)} bytes")
+    _, version, code = _HEADER.unpack_from(blob)
+    if version != FORMAT_VERSION or code not in _CODE_FORMATS:
+        raise ValueError(f"Unsupported embedding blob (version={version}, format={code})")
+    return _CODE_FORMATS[code]
+
+
+def _decode_matrix(raw, fmt):
+    """raw: ma trận uint8 (n, payload_bytes) cùng format -> float32 (n, dim)"""
+    if fmt in (None, FORMAT_FLOAT32):
+        return np.ascontiguousarray(raw).view('<f4').astype(np.float32, copy=False)
+    if fmt == FORMAT_FLOAT16:
+        return np.ascontiguousarray(raw).view('<f2').astype(np.float32)
+    scales = np.ascontiguousarray(raw[:, :4]).view('<f4')
+    codes = np.ascontiguousarray(raw[:, 4:]).view(np.int8)
+    return codes.astype(np.float32) * scales
+
+
+def decode_vector(blob, dim=768):
+    return decode_vectors([blob], dim)[0]
+
+
+def decode_vectors(blobs, dim=768):
+    """
+    Decode nhiều blob thành ma trận float32 (n, dim). Nếu tất cả blob cùng
+    format (trường hợp thường gặp) thì decode bằng một lần np.frombuffer.
+    """
+    if not blobs:
+        return np.empty((0, dim), dtype=np.float32)
+
+    lengths = {len(blob) for blob in blobs}
+    if len(lengths) == 1:
+        fmt = _blob_format(blobs[0], dim)
+        header = 0 if fmt is None else _HEADER.size
+        raw = np.frombuffer(b''.join(blobs), dtype=np.uint8).reshape(len(blobs), -1)
+        if fmt is None or np.all(raw[:, :header] == raw[0, :header]):
+            return _decode_matrix(raw[:, header:], fmt).reshape(len(blobs), dim)
+
+    # Trộn nhiều format (đang chuyển đổi dần) -> decode từng blob
+    rows = []
+    for blob in blobs:
+        fmt = _blob_format(blob, dim)
+        header = 0 if fmt is None else _HEADER.size
+        raw = np.frombuffer(blob, dtype=np.uint8)[header:].reshape(1, -1)
+        rows.append(_decode_matrix(raw, fmt).reshape(dim))
+    return np.vstack(rows)
@@ -0,0 +1,239 @@
+# services/vector_store.py
+import threading
+import os
+import numpy as np
+
+# image_id của dòng đã bị xóa / bị thay bằng dòng mới hơn trong file ids
+_DELETED = -1
+
+
+class MmapVectorStore:
+    """
+    Kho vector float32 chính xác theo image_id, dùng để re-rank kết quả của
+    index nén/ANN. Dữ liệu gồm 2 file append-only, thẳng hàng theo dòng:
+      <path>.f32: các dòng vector float32 (dim cột)
+      <path>.ids: image_id (int64) tương ứng từng dòng, -1 nếu dòng đã bị xóa
+    Đọc qua np.memmap nên nhiều process dùng chung page cache. Ảnh được embed
+    lại sẽ được append dòng mới và dòng cũ được đánh dấu -1 (ghi đè tại chỗ
+    trong file ids), xóa ảnh cũng vậy nên vẫn đúng sau khi restart.
+    Tra id -> dòng bằng mảng id đã sắp xếp (np.searchsorted) cho các dòng cũ
+    và quét các dòng mới append (tối đa merge_rows dòng) thay vì dict Python.
+    compact() ghi lại 2 file chỉ với các dòng còn dùng.
+    """
+
+    def __init__(self, path, dimension, merge_rows=4096):
+        self.path = path
+        self.dimension = dimension
+        self.data_path = path + '.f32'
+        self.ids_path = path + '.ids'
+        self.row_bytes = dimension * 4
+        self.merge_rows = merge_rows
+        self._lock = threading.Lock()
+        self._mmap = None
+        self._finish_compaction()
+        self._recover()
+        self._open_files()
+
+    def _open_files(self):
+        self._data_file = open(self.data_path, 'ab')
+        self._ids_file = open(self.ids_path, 'ab')
+        # Handle riêng để ghi đè id của dòng bị xóa (file 'ab' luôn ghi vào cuối)
+        self._ids_marker = open(self.ids_path, 'r+b')
+
+    def _recover(self):
+        """Đọc file ids; cắt bỏ phần ghi dở nếu 2 file lệch nhau"""
+        data_rows = os.path.getsize(self.data_path) // self.row_bytes if os.path.exists(self.data_path) else 0
+        ids = np.fromfile(self.ids_path, dtype=np.int64) if os.path.exists(self.ids_path) else np.empty(0, np.int64)
+        count = min(data_rows, len(ids))
+
+        if os.path.exists(self.data_path) and os.path.getsize(self.data_path) != count * self.row_bytes:
+            with open(self.data_path, 'r+b') as f:
+                f.truncate(count * self.row_bytes)
+        # So theo kích thước file: id ghi dở (< 8 byte) không nằm trong len(ids)
+        if os.path.exists(self.ids_path) and os.path.getsize(self.ids_path) != count * 8:
+            with open(self.ids_path, 'r+b') as f:
+                f.truncate(count * 8)
+
+        ids = ids[:count].copy()
+        # File cũ (trước khi có đánh dấu -1) có thể có nhiều dòng cùng id: giữ dòng sau cùng
+        valid = np.flatnonzero(ids != _DELETED)
+        _, last = np.unique(ids[valid][::-1], return_index=True)
+        keep = np.zeros(count, dtype=bool)
+        keep[valid[len(valid) - 1 - last]] = True
+        ids[~keep] = _DELETED
+
+        self._ids = ids
+        self.count = count
+        self._live = int(keep.sum())
+        self._rebuild_lookup()
+
+    def _rebuild_lookup(self):
+        """Sắp xếp lại toàn bộ dòng còn dùng; các dòng append sau đó nằm ở phần tail"""
+        rows = np.flatnonzero(self._ids[:self.count] != _DELETED)
+        order = np.argsort(self._ids[rows], kind='stable')
+        self._sorted_ids = self._ids[rows][order]
+        self._sorted_rows = rows[order]
+        self._indexed = self.count
+
+    def _lookup(self, image_ids):
+        """Dòng của từng image_id (-1 nếu không có). Gọi khi đang giữ _lock"""
+        image_ids = np.asarray(image_ids, dtype=np.int64).reshape(-1)
+        rows = np.full(len(image_ids), -1, dtype=np.int64)
+        if len(self._sorted_ids):
+            pos = np.minimum(np.searchsorted(self._sorted_ids, image_ids), len(self._sorted_ids) - 1)
+            hit = self._sorted_ids[pos] == image_ids
+            rows[hit] = self._sorted_rows[pos[hit]]
+
+        tail = self._ids[self._indexed:self.count]
+        if len(tail):
+            order = np.argsort(tail, kind='stable')
+            sorted_tail = tail[order]
+            pos = np.minimum(np.searchsorted(sorted_tail, image_ids), len(tail) - 1)
+            hit = sorted_tail[pos] == image_ids
+            rows[hit] = self._indexed + order[pos[hit]]
+
+        # Dòng trong mảng sắp xếp có thể đã bị xóa / thay sau lần sắp xếp
+        found = rows >= 0
+        found[found] = self._ids[rows[found]] == image_ids[found]
+        rows[~found] = -1
+        return rows
+
+    def _mark_deleted(self, rows):
+        """Đánh dấu -1 các dòng (cả trong bộ nhớ lẫn file ids). Gọi khi đang giữ _lock"""
+        rows = np.unique(rows[rows >= 0])
+        if len(rows) == 0:
+            return
+        self._ids[rows] = _DELETED
+        marker = np.int64(_DELETED).tobytes()
+        for row in rows.tolist():
+            self._ids_marker.seek(row * 8)
+            self._ids_marker.write(marker)
+        self._ids_marker.flush()
+        self._live -= len(rows)
+
+    def __len__(self):
+        return self._live
+
+    def __contains__(self, image_id):
+        return bool(self.contains([image_id])[0])
+
+    def contains(self, image_ids):
+        """Mask bool: image_id nào đang có vector trong store"""
+        with self._lock:
+            return self._lookup(image_ids) >= 0
+
+    def add(self, image_ids, vectors):
+        image_ids = np.ascontiguousarray(image_ids, dtype=np.int64).reshape(-1)
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(len(image_ids), self.dimension)
+        with self._lock:
+            # Ảnh được embed lại: bỏ dòng cũ
+            self._mark_deleted(self._lookup(image_ids))
+
+            self._data_file.write(vectors.tobytes())
+            self._data_file.flush()
+            # Ghi ids sau data: crash giữa chừng chỉ làm thừa data, được cắt khi recover
+            self._ids_file.write(image_ids.tobytes())
+            self._ids_file.flush()
+
+            if self.count + len(image_ids) > len(self._ids):
+                grown = np.full(max(2 * len(self._ids), self.count + len(image_ids)), _DELETED, dtype=np.int64)
+                grown[:self.count] = self._ids[:self.count]
+                self._ids = grown
+            self._ids[self.count:self.count + len(image_ids)] = image_ids
+            start = self.count
+            self.count += len(image_ids)
+            self._live += len(image_ids)
+
+            # Cùng id xuất hiện nhiều lần trong batch: giữ dòng sau cùng
+            _, last = np.unique(image_ids[::-1], return_index=True)
+            if len(last) < len(image_ids):
+                duplicate = np.ones(len(image_ids), dtype=bool)
+                duplicate[len(image_ids) - 1 - last] = False
+                self._mark_deleted(start + np.flatnonzero(duplicate))
+
+            if self.count - self._indexed > self.merge_rows:
+                self._rebuild_lookup()
+
+    def remove(self, image_ids):
+        with self._lock:
+            self._mark_deleted(self._lookup(image_ids))
+
+    def _matrix(self):
+        """memmap toàn bộ file data, map lại khi file đã dài thêm"""
+        if self._mmap is None or self._mmap.shape[0] < self.count:
+            self._mmap = np.memmap(self.data_path, dtype=np.float32, mode='r',
+                                   shape=(self.count, self.dimension))
+        return self._mmap
+
+    def get(self, image_ids):
+        """
+        Trả về (found, vectors): found là mask bool, vectors float32 (n, dim);
+        các dòng không tìm thấy là 0.
+        """
+        with self._lock:
+            rows = self._lookup(image_ids)
+            found = rows >= 0
+            vectors = np.zeros((len(rows), self.dimension), dtype=np.float32)
+            if found.any():
+                vectors[found] = self._matrix()[rows[found]]
+        return found, vectors
+
+    def _compaction_paths(self):
+        return self.data_path + '.compact', self.ids_path + '.compact', self.path + '.compact-ready'
+
+    def compact(self, chunk_rows=65536):
+        """
+        Ghi lại 2 file chỉ với các dòng còn dùng (gọi khi FAISS index compaction).
+        Ghi ra file tạm, tạo file đánh dấu khi cả 2 đã ghi xong rồi mới rename:
+        crash giữa 2 lần rename được hoàn tất ở lần mở sau (_finish_compaction).
+        Trả về số dòng đã bỏ.
+        """
+        data_tmp, ids_tmp, ready = self._compaction_paths()
+        with self._lock:
+            dropped = self.count - self._live
+            if dropped == 0:
+                return 0
+            rows = np.flatnonzero(self._ids[:self.count] != _DELETED)
+            matrix = self._matrix()
+            with open(data_tmp, 'wb') as data_file:
+                for start in range(0, len(rows), chunk_rows):
+                    data_file.write(np.ascontiguousarray(matrix[rows[start:start + chunk_rows]]).tobytes())
+                data_file.flush()
+                os.fsync(data_file.fileno())
+            with open(ids_tmp, 'wb') as ids_file:
+                ids_file.write(self._ids[rows].tobytes())
+                ids_file.flush()
+                os.fsync(ids_file.fileno())
+            open(ready, 'wb').close()
+
+            self._data_file.close()
+            self._ids_file.close()
+            self._ids_marker.close()
+            self._mmap = None
+            self._finish_compaction()
+            self._recover()
+            self._open_files()
+        print(f"Vector store compacted: {dropped} rows dropped")
+        return dropped
+
+    def _finish_compaction(self):
+        """Hoàn tất (hoặc bỏ) lần compact dở dang trước đó"""
+        data_tmp, ids_tmp, ready = self._compaction_paths()
+        if os.path.exists(ready):
+            if os.path.exists(data_tmp):
+                os.replace(data_tmp, self.data_path)
+            if os.path.exists(ids_tmp):
+                os.replace(ids_tmp, self.ids_path)
+            os.remove(ready)
+        else:
+            # File tạm chưa ghi xong: file cũ vẫn nguyên vẹn
+            for tmp_path in (data_tmp, ids_tmp):
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    def close(self):
+        with self._lock:
+            self._data_file.close()
+            self._ids_file.close()
+            self._ids_marker.close()
+            self._mmap = None
@@ -0,0 +1,218 @@
+# services/worker_pool.py
+from threading import Thread, Event, Lock
+import multiprocessing as mp
+import queue
+import time
+import os
+from database.db import db
+from models import Image, ImageEmbedding
+from services.ai_service import ai_service
+from services.job_queue import job_queue, default_worker_id
+from services.vector_codec import encode_vector
+from config import Config
+
+_STOP = None
+
+
+def _worker_main(task_queue, result_queue, torch_threads, inference_batch_size):
+    """
+    Process con: tự load model CLIP, giới hạn số thread torch, nhận
+    (batch_id, image_ids, paths) từ task_queue riêng của process và trả
+    (batch_id, ids, embeddings, model, lỗi) về result_queue. Web tier chuyển
+    model thì process load model mới ở batch sau.
+    """
+    import torch
+    torch.set_num_threads(torch_threads)
+    ai_service.load_model()
+
+    while True:
+        task = task_queue.get()
+        if task is _STOP:
+            break
+        batch_id, image_ids, paths = task
+        ai_service.refresh_active_model()
+        ok_ids, images, failures = [], [], []
+        for image_id, path in zip(image_ids, paths):
+            try:
+                images.append(ai_service.open_image(path))
+                ok_ids.append(image_id)
+            except Exception as e:
+                failures.append((image_id, str(e)))
+
+        embeddings = None
+        if images:
+            try:
+                embeddings = ai_service.get_image_embeddings(images, batch_size=inference_batch_size)
+            except Exception as e:
+                failures.extend((image_id, str(e)) for image_id in ok_ids)
+                ok_ids = []
+        result_queue.put((batch_id, ok_ids, embeddings, ai_service.model_tag, failures))
+
+
+class EmbeddingWorkerPool:
+    """
+    N process sinh embedding (mỗi process một model, torch.set_num_threads riêng),
+    mỗi process một task queue. Process cha là writer duy nhất:
+      - dispatcher: claim job trong embedding_jobs -> đưa (batch_id, ids, paths)
+        vào task queue của process đang ít batch nhất
+      - writer: nhận vector từ result_queue -> ghi image_embeddings, đánh dấu job
+    Process cha biết batch nào đang nằm ở process nào: process chết thì chỉ các
+    batch của nó được trả lại queue job (fail -> retry với backoff).
+    Web tier (EMBED_WORKER_MODE=pool) đọc các embedding mới từ DB vào FAISS index.
+    """
+
+    def __init__(self, app, num_workers=4, torch_threads=1, batch_size=32, queue_size=None):
+        self.app = app
+        self.num_workers = num_workers
+        self.torch_threads = torch_threads
+        self.batch_size = batch_size
+        self.worker_id = f"pool-{default_worker_id()}"
+        self._ctx = mp.get_context('spawn')  # fork + torch dễ deadlock
+        self.result_queue = self._ctx.Queue()
+        self.task_queues = [None] * num_workers
+        self.processes = [self._new_process(i) for i in range(num_workers)]
+        # Số batch đã claim nhưng chưa ghi xong (lease chỉ chạy khi sắp được xử lý)
+        self.max_pending = queue_size or num_workers * 2
+        # batch_id -> (process index, image_ids) của các batch đã gửi mà chưa ghi xong
+        self._in_flight = {}
+        self._next_batch_id = 0
+        self._pending_lock = Lock()
+        self._stopping = Event()
+        self.written = 0
+        self.failed = 0
+
+    def _new_process(self, i):
+        # Queue mới cho mỗi process: process chết khi đang đọc queue có thể làm hỏng queue cũ
+        self.task_queues[i] = self._ctx.Queue()
+        return self._ctx.Process(
+            target=_worker_main,
+            args=(self.task_queues[i], self.result_queue, self.torch_threads, self.batch_size),
+            name=f"embed-worker-{i}",
+            daemon=True
+        )
+
+    @property
+    def pending(self):
+        with self._pending_lock:
+            return len(self._in_flight)
+
+    def _reap_dead_workers(self, restart=True):
+        """
+        Trả lại queue job các batch của process đã chết (chỉ batch đã gửi cho
+        process đó), rồi khởi động lại process nếu restart.
+        """
+        for i, process in enumerate(self.processes):
+            if process.exitcode is None:
+                continue
+            with self._pending_lock:
+                lost = [batch_id for batch_id, (worker, _) in self._in_flight.items() if worker == i]
+                lost_ids = [image_id for batch_id in lost for image_id in self._in_flight.pop(batch_id)[1]]
+            if lost_ids:
+                with self.app.app_context():
+                    job_queue.fail(self.worker_id, lost_ids, f"Embedding worker exited ({process.exitcode})")
+            if restart:
+                print(f"Embedding worker {process.name} exited ({process.exitcode}), restarting")
+                self.processes[i] = self._new_process(i)
+                self.processes[i].start()
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        self.dispatcher = Thread(target=self._dispatch_loop, name="pool-dispatcher", daemon=True)
+        self.writer = Thread(target=self._write_loop, name="pool-writer", daemon=True)
+        self.dispatcher.start()
+        self.writer.start()
+        print(f"Embedding worker pool started: {self.num_workers} processes x {self.torch_threads} torch threads")
+
+    def _dispatch_loop(self):
+        while not self._stopping.is_set():
+            if self.pending >= self.max_pending:
+                self._stopping.wait(0.05)
+                continue
+            try:
+                with self.app.app_context():
+                    jobs = job_queue.claim(self.worker_id, self.batch_size)
+                    if not jobs:
+                        self._stopping.wait(Config.EMBED_JOB_POLL_INTERVAL)
+                        continue
+                    image_ids = [image_id for _, image_id, _ in jobs]
+                    rows = Image.query.with_entities(Image.image_id, Image.file_path)\
+                                      .filter(Image.image_id.in_(image_ids)).all()
+                    paths = {row.image_id: row.file_path for row in rows}
+                    # Ảnh đã bị xóa thì không cần embed nữa
+                    job_queue.complete(self.worker_id, [i for i in image_ids if i not in paths])
+
+                ids = [i for i in image_ids if i in paths]
+                if not ids:
+                    continue
+                with self._pending_lock:
+                    batch_id = self._next_batch_id
+                    self._next_batch_id += 1
+                    # Process đang giữ ít batch nhất
+                    load = [0] * len(self.processes)
+                    for worker, _ in self._in_flight.values():
+                        load[worker] += 1
+                    worker = load.index(min(load))
+                    self._in_flight[batch_id] = (worker, ids)
+                self.task_queues[worker].put((batch_id, ids, [
+                    os.path.join(self.app.config['UPLOAD_FOLDER'], paths[i]) for i in ids
+                ]))
+            except Exception as e:
+                print(f"Error dispatching embedding jobs: {str(e)}")
+                time.sleep(Config.EMBED_JOB_POLL_INTERVAL)
+
+    def _write_loop(self):
+        while not (self._stopping.is_set() and self.pending == 0):
+            try:
+                batch_id, image_ids, embeddings, model, failures = self.result_queue.get(timeout=0.5)
+            except queue.Empty:
+                # Khi đang dừng không khởi động lại, chỉ trả lại batch của process đã chết
+                # (nếu không batch đó giữ pending > 0 và stop() chờ mãi)
+                self._reap_dead_workers(restart=not self._stopping.is_set())
+                if self._stopping.is_set() and all(p.exitcode is not None for p in self.processes):
+                    break
+                continue
+            with self._pending_lock:
+                known = self._in_flight.pop(batch_id, None) is not None
+            if not known:
+                # Batch đã được trả lại queue job (process bị coi là đã chết)
+                continue
+            ai_service.refresh_active_model()
+            with self.app.app_context():
+                try:
+                    if image_ids and model != ai_service.model_tag:
+                        # Batch được embed bằng model cũ ngay trước khi chuyển -> chạy lại
+                        job_queue.fail(self.worker_id, image_ids, f"Embedding model switched from {model}")
+                    elif image_ids:
+                        # Job có thể được chạy lại -> thay embedding cũ của model này nếu có
+                        ImageEmbedding.query.filter(ImageEmbedding.image_id.in_(image_ids),
+                                                    ImageEmbedding.model == model)\
+                                            .delete(synchronize_session=False)
+                        db.session.bulk_save_objects([
+                            ImageEmbedding(
+                                image_id=image_id,
+                                embedding_vector=encode_vector(embeddings[idx], Config.EMBEDDING_STORAGE_FORMAT),
+                                model=model
+                            )
+                            for idx, image_id in enumerate(image_ids)
+                        ])
+                        db.session.commit()
+                        job_queue.complete(self.worker_id, image_ids)
+                        self.written += len(image_ids)
+                    for image_id, error in failures:
+                        job_queue.fail(self.worker_id, [image_id], error)
+                    self.failed += len(failures)
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Error writing embedding batch: {str(e)}")
+                    job_queue.fail(self.worker_id, image_ids, e)
+
+    def stop(self):
+        """Ngừng claim job mới, chờ các batch đang chạy ghi xong rồi dừng các process"""
+        self._stopping.set()
+        self.dispatcher.join()
+        for task_queue in self.task_queues:
+            task_queue.put(_STOP)
+        self.writer.join()
+        for process in self.processes:
+            process.join()
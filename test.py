@@ -1,9 +1,8 @@
-import json
 import requests
 text = "Một con hổ"
 
 _reponse = requests.post(url = "http://127.0.0.1:8080/", 
-                         json = json.dumps({'query': text},ensure_ascii= False), 
+                         json = {'query': text}, 
                          headers= {'Content-Type': 'application/json'}
 )
 
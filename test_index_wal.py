@@ -0,0 +1,110 @@
+# test_index_wal.py
+import os
+import numpy as np
+import pytest
+from services.index_wal import VectorWAL, OP_ADD, OP_DELETE
+
+DIM = 4
+
+
+@pytest.fixture
+def wal_path(tmp_path):
+    return str(tmp_path / 'index.wal')
+
+
+def _vectors(n, start=0):
+    return np.arange(start, start + n * DIM, dtype=np.float32).reshape(n, DIM)
+
+
+def _replay(wal):
+    return [(op, ids.tolist(), vectors) for op, ids, vectors in wal.replay()]
+
+
+def test_replay_groups_records_by_op(wal_path):
+    wal = VectorWAL(wal_path, DIM)
+    wal.append([1, 2], _vectors(2))
+    wal.append([3], _vectors(1, start=100))
+    wal.append_delete([2])
+    wal.append([4], _vectors(1, start=200))
+
+    records = _replay(wal)
+    wal.close()
+
+    assert [(op, ids) for op, ids, _ in records] == [
+        (OP_ADD, [1, 2, 3]),
+        (OP_DELETE, [2]),
+        (OP_ADD, [4]),
+    ]
+    np.testing.assert_array_equal(records[0][2], np.vstack([_vectors(2), _vectors(1, start=100)]))
+    np.testing.assert_array_equal(records[2][2], _vectors(1, start=200))
+
+
+def test_torn_tail_is_truncated_on_open(wal_path):
+    wal = VectorWAL(wal_path, DIM)
+    wal.append([1, 2], _vectors(2))
+    wal.close()
+    valid_size = os.path.getsize(wal_path)
+
+    # Crash giữa lúc ghi record thứ 3: chỉ một phần record nằm trên đĩa
+    with open(wal_path, 'ab') as f:
+        f.write(b'\x01' + b'\x00' * 10)
+
+    wal = VectorWAL(wal_path, DIM)
+    assert os.path.getsize(wal_path) == valid_size
+    # Record append sau khi mở lại nằm ngay sau record hợp lệ cuối cùng
+    wal.append([3], _vectors(1, start=50))
+    records = _replay(wal)
+    wal.close()
+
+    assert [(op, ids) for op, ids, _ in records] == [(OP_ADD, [1, 2, 3])]
+    np.testing.assert_array_equal(records[0][2][2], _vectors(1, start=50)[0])
+
+
+def test_replay_stops_at_corrupted_record(wal_path):
+    wal = VectorWAL(wal_path, DIM)
+    wal.append([1], _vectors(1))
+    wal.append([2], _vectors(1, start=10))
+    wal.append([3], _vectors(1, start=20))
+    record_size = wal.record_size
+    wal.close()
+
+    # Hỏng payload của record thứ 2 -> checksum sai
+    with open(wal_path, 'r+b') as f:
+        f.seek(record_size + record_size - 1)
+        f.write(b'\xff')
+
+    wal = VectorWAL(wal_path, DIM)
+    records = _replay(wal)
+    wal.close()
+
+    assert [(op, ids) for op, ids, _ in records] == [(OP_ADD, [1])]
+    assert os.path.getsize(wal_path) == record_size
+
+
+def test_truncate_keeps_records_after_offset(wal_path):
+    wal = VectorWAL(wal_path, DIM)
+    wal.append([1, 2], _vectors(2))
+    snapshot_offset = wal.size
+    # Ghi sau khi snapshot đã copy index, chưa nằm trong snapshot
+    wal.append([3], _vectors(1, start=30))
+    wal.append_delete([1])
+
+    wal.truncate(snapshot_offset)
+    wal.append([4], _vectors(1, start=40))
+    records = _replay(wal)
+    wal.close()
+
+    assert [(op, ids) for op, ids, _ in records] == [
+        (OP_ADD, [3]),
+        (OP_DELETE, [1]),
+        (OP_ADD, [4]),
+    ]
+
+
+def test_truncate_without_offset_clears_wal(wal_path):
+    wal = VectorWAL(wal_path, DIM)
+    wal.append([1], _vectors(1))
+    wal.truncate()
+    assert wal.size == 0
+    assert _replay(wal) == []
+    wal.close()
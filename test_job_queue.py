@@ -0,0 +1,158 @@
+# test_job_queue.py
+from datetime import datetime, timedelta
+import pytest
+from flask import Flask
+from database.db import db
+from models import User, Image, ImageEmbedding, EmbeddingJob
+from services import job_queue as job_queue_module
+from services.job_queue import EmbeddingJobQueue
+
+LEASE = 60
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = datetime(2024, 1, 1, 12, 0, 0)
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += timedelta(seconds=seconds)
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tmp_path / 'jobs.db'}"
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        user = User(username='u', email='u@example.com', password_hash='x')
+        db.session.add(user)
+        db.session.commit()
+        db.session.add_all([Image(image_id=i, user_id=user.user_id, file_path=f'{i}.jpg') for i in (1, 2, 3)])
+        db.session.commit()
+        yield app
+        db.session.remove()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(job_queue_module, '_utcnow', clock)
+    return clock
+
+
+@pytest.fixture
+def queue():
+    return EmbeddingJobQueue(lease_seconds=LEASE, max_attempts=3, backoff_base=5, backoff_max=600)
+
+
+def _job(image_id):
+    db.session.expire_all()
+    return EmbeddingJob.query.filter_by(image_id=image_id).one()
+
+
+def test_claim_is_exclusive_until_lease_expires(app, clock, queue):
+    queue.enqueue([1])
+    assert [image_id for _, image_id, _ in queue.claim('worker-a', 10)] == [1]
+    assert queue.claim('worker-b', 10) == []
+
+    clock.advance(LEASE - 1)
+    assert queue.claim('worker-b', 10) == []
+
+    # worker-a chết: lease hết hạn -> worker khác nhận lại, attempts tăng
+    clock.advance(2)
+    claimed = queue.claim('worker-b', 10)
+    assert [(image_id, attempts) for _, image_id, attempts in claimed] == [(1, 2)]
+    assert _job(1).lease_owner == 'worker-b'
+
+    # Kết quả của worker-a đến muộn không ghi đè job của worker-b
+    queue.complete('worker-a', [1])
+    assert _job(1).state == EmbeddingJob.STATE_RUNNING
+    queue.complete('worker-b', [1])
+    assert _job(1).state == EmbeddingJob.STATE_DONE
+
+
+def test_fail_retries_with_exponential_backoff(app, clock, queue):
+    queue.enqueue([1])
+
+    for attempt, delay in ((1, 5), (2, 10)):
+        claimed = queue.claim('worker', 10)
+        assert [(image_id, attempts) for _, image_id, attempts in claimed] == [(1, attempt)]
+        queue.fail('worker', [1], 'boom')
+        job = _job(1)
+        assert job.state == EmbeddingJob.STATE_PENDING
+        assert job.last_error == 'boom'
+        assert job.next_run_at == clock.now + timedelta(seconds=delay)
+
+        # Chưa tới hạn retry thì chưa nhận được
+        clock.advance(delay - 1)
+        assert queue.claim('worker', 10) == []
+        clock.advance(1)
+
+    # Lần thứ max_attempts lỗi -> failed, không retry nữa
+    assert len(queue.claim('worker', 10)) == 1
+    queue.fail('worker', [1], 'boom')
+    assert _job(1).state == EmbeddingJob.STATE_FAILED
+    clock.advance(3600)
+    assert queue.claim('worker', 10) == []
+
+
+def test_backoff_is_capped(app, clock):
+    queue = EmbeddingJobQueue(lease_seconds=LEASE, max_attempts=10, backoff_base=5, backoff_max=12)
+    queue.enqueue([1])
+    for _ in range(3):
+        queue.claim('worker', 10)
+        queue.fail('worker', [1], 'boom')
+        assert _job(1).next_run_at <= clock.now + timedelta(seconds=12)
+        clock.advance(12)
+
+
+def test_expired_lease_after_max_attempts_is_failed(app, clock, queue):
+    queue.enqueue([1])
+    for _ in range(queue.max_attempts):
+        assert len(queue.claim('worker', 10)) == 1
+        clock.advance(LEASE + 1)
+
+    # Job làm worker chết max_attempts lần -> failed thay vì nhận lại mãi
+    assert queue.claim('worker', 10) == []
+    job = _job(1)
+    assert job.state == EmbeddingJob.STATE_FAILED
+    assert job.lease_owner is None
+
+
+def test_enqueue_resets_existing_job_to_pending(app, clock, queue):
+    queue.enqueue([1])
+    queue.claim('worker', 10)
+    queue.fail('worker', [1], 'boom')
+
+    queue.enqueue([1])
+    job = _job(1)
+    assert job.state == EmbeddingJob.STATE_PENDING
+    assert job.attempts == 0
+    assert job.last_error is None
+    assert job.next_run_at == clock.now
+
+
+def test_sweep_re_pends_done_jobs_missing_embeddings(app, clock, queue):
+    # Ảnh 1: done và có embedding; ảnh 2: done nhưng embedding bị mất; ảnh 3: failed
+    queue.enqueue([1, 2, 3])
+    queue.claim('worker', 10)
+    queue.complete('worker', [1, 2])
+    queue.max_attempts = 1
+    queue.fail('worker', [3], 'boom')
+    db.session.add(ImageEmbedding(image_id=1, embedding_vector=b'\x00' * 16, model='m'))
+    db.session.commit()
+
+    queue.sweep_unembedded()
+    assert _job(1).state == EmbeddingJob.STATE_DONE
+    assert _job(2).state == EmbeddingJob.STATE_PENDING
+    assert _job(2).attempts == 0
+    assert _job(3).state == EmbeddingJob.STATE_FAILED
+
+    # Ảnh 1 chưa có embedding của model mới -> vào queue lại
+    queue.sweep_unembedded(model='m2')
+    assert _job(1).state == EmbeddingJob.STATE_PENDING
+    assert queue.claimable_count() == 2
@@ -0,0 +1,44 @@
+# test_lang_detect.py
+import pytest
+from services.lang_detect import is_vietnamese
+
+
+@pytest.mark.parametrize('query', [
+    'Một con hổ',
+    'con mèo đen',
+    'hoa hồng đỏ',
+    'ngã ba',
+    'bão',
+    'cơn bão trên biển',
+    'chó mèo',
+    'ha noi',
+    'ho chi minh',
+    'sai gon',
+    'vung tau',
+    'da lat',
+    'nguoi dan ong',
+    'bien xanh',
+    'hoa sen',
+    'NHÀ THỜ ĐỨC BÀ',
+])
+def test_vietnamese_queries(query):
+    assert is_vietnamese(query)
+
+
+@pytest.mark.parametrize('query', [
+    'a dog on the beach',
+    'red sports car',
+    'sunset over the mountains',
+    'cafe latte art',
+    'résumé photo',
+    'do you like to dance',
+    'long hair girl',
+    'hue and saturation',
+    'chi square test',
+    'an apple a day',
+    'iphone 15 pro',
+    'IMG_2024',
+    '',
+])
+def test_non_vietnamese_queries(query):
+    assert not is_vietnamese(query)
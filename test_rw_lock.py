@@ -0,0 +1,125 @@
+# test_rw_lock.py
+import threading
+import time
+import pytest
+from services.rw_lock import ReadWriteLock
+
+TIMEOUT = 5
+
+
+def _start(target):
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def test_readers_run_concurrently():
+    lock = ReadWriteLock()
+    inside = threading.Barrier(2, timeout=TIMEOUT)
+
+    def reader():
+        with lock.read():
+            # Cả 2 reader phải cùng ở trong lock thì barrier mới qua được
+            inside.wait()
+
+    threads = [_start(reader) for _ in range(2)]
+    for thread in threads:
+        thread.join(TIMEOUT)
+    assert not any(thread.is_alive() for thread in threads)
+
+
+def test_writer_excludes_readers():
+    lock = ReadWriteLock()
+    events = []
+    lock.acquire()
+
+    reader = _start(lambda: (lock.acquire_read(), events.append('read'), lock.release_read()))
+    time.sleep(0.1)
+    assert events == []
+
+    events.append('write-done')
+    lock.release()
+    reader.join(TIMEOUT)
+    assert events == ['write-done', 'read']
+
+
+def test_waiting_writer_blocks_new_readers():
+    lock = ReadWriteLock()
+    events = []
+    lock.acquire_read()
+
+    def writer():
+        with lock:
+            events.append('write')
+
+    writer_thread = _start(writer)
+    # Chờ writer vào hàng đợi
+    deadline = time.time() + TIMEOUT
+    while not lock._writers_waiting and time.time() < deadline:
+        time.sleep(0.01)
+    assert lock._writers_waiting == 1
+
+    # Reader mới phải đứng sau writer đang chờ
+    reader_thread = _start(lambda: (lock.acquire_read(), events.append('read'), lock.release_read()))
+    time.sleep(0.1)
+    assert events == []
+
+    lock.release_read()
+    writer_thread.join(TIMEOUT)
+    reader_thread.join(TIMEOUT)
+    assert events == ['write', 'read']
+
+
+def test_reentrant_write_and_read_under_write():
+    lock = ReadWriteLock()
+    with lock:
+        with lock:
+            with lock.read():
+                pass
+        assert lock._writer == threading.get_ident()
+    assert lock._writer is None
+
+    # Lock đã nhả hẳn: thread khác lấy quyền ghi được
+    acquired = []
+    thread = _start(lambda: (lock.acquire(), acquired.append(True), lock.release()))
+    thread.join(TIMEOUT)
+    assert acquired == [True]
+
+
+def test_reentrant_read_while_writer_waits():
+    lock = ReadWriteLock()
+    lock.acquire_read()
+    writer_thread = _start(lambda: (lock.acquire(), lock.release()))
+    deadline = time.time() + TIMEOUT
+    while not lock._writers_waiting and time.time() < deadline:
+        time.sleep(0.01)
+
+    # Thread đang giữ quyền đọc lấy lại quyền đọc không bị chặn bởi writer đang chờ
+    # (nếu bị chặn thì deadlock: writer chờ chính thread này nhả quyền đọc)
+    with lock.read():
+        assert lock._readers == 2
+
+    lock.release_read()
+    writer_thread.join(TIMEOUT)
+    assert not writer_thread.is_alive()
+
+
+def test_upgrade_and_foreign_release_are_rejected():
+    lock = ReadWriteLock()
+    with lock.read():
+        with pytest.raises(RuntimeError):
+            lock.acquire()
+
+    lock.acquire()
+    errors = []
+
+    def release_from_other_thread():
+        try:
+            lock.release()
+        except RuntimeError as e:
+            errors.append(e)
+
+    _start(release_from_other_thread).join(TIMEOUT)
+    assert len(errors) == 1
+    lock.release()
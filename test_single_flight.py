@@ -0,0 +1,123 @@
+# test_single_flight.py
+import threading
+import time
+import pytest
+from services.single_flight import SingleFlight
+
+TIMEOUT = 5
+
+
+def _run_concurrently(flight, key, func, followers):
+    """Gọi flight.do(key, func) từ followers + 1 thread cùng lúc"""
+    results, errors = [], []
+
+    def call():
+        try:
+            results.append(flight.do(key, func))
+        except Exception as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    threads = [threading.Thread(target=call) for _ in range(followers)]
+    for thread in threads:
+        thread.start()
+    return [leader] + threads, results, errors
+
+
+def _wait_for_waiters(flight, key, count):
+    # Chờ tới khi count lời gọi đã đăng ký chờ lời gọi đang chạy
+    deadline = time.time() + TIMEOUT
+    while time.time() < deadline:
+        with flight._lock:
+            call = flight._calls.get(key)
+            if call is not None and call.waiters == count:
+                return
+        time.sleep(0.01)
+    raise AssertionError(f"{count} waiters never joined")
+
+
+def test_concurrent_calls_share_one_execution():
+    flight = SingleFlight('test')
+    started, release = threading.Event(), threading.Event()
+    executions = []
+
+    def work():
+        executions.append(1)
+        started.set()
+        release.wait(TIMEOUT)
+        return 'result'
+
+    threads, results, errors = _run_concurrently(flight, 'q', work, followers=3)
+    started.wait(TIMEOUT)
+    _wait_for_waiters(flight, 'q', 3)
+    release.set()
+    for thread in threads:
+        thread.join(TIMEOUT)
+
+    assert executions == [1]
+    assert results == ['result'] * 4
+    assert errors == []
+    stats = flight.stats()
+    assert (stats['requests'], stats['executions'], stats['coalesced']) == (4, 1, 3)
+    assert stats['max_waiters'] == 3
+    assert stats['in_flight'] == 0
+
+
+def test_error_is_shared_with_waiters():
+    flight = SingleFlight('test')
+    started, release = threading.Event(), threading.Event()
+
+    def work():
+        started.set()
+        release.wait(TIMEOUT)
+        raise ValueError('boom')
+
+    threads, results, errors = _run_concurrently(flight, 'q', work, followers=2)
+    started.wait(TIMEOUT)
+    _wait_for_waiters(flight, 'q', 2)
+    release.set()
+    for thread in threads:
+        thread.join(TIMEOUT)
+
+    assert results == []
+    assert len(errors) == 3
+    assert all(isinstance(e, ValueError) for e in errors)
+
+
+def test_finished_call_is_not_cached():
+    flight = SingleFlight('test')
+    calls = []
+    assert flight.do('q', lambda: calls.append(1) or len(calls)) == 1
+    assert flight.do('q', lambda: calls.append(1) or len(calls)) == 2
+
+    # Lời gọi lỗi cũng được dọn khỏi _calls
+    with pytest.raises(KeyError):
+        flight.do('q', lambda: {}['missing'])
+    assert flight.stats()['in_flight'] == 0
+    assert flight.do('q', lambda: 'ok') == 'ok'
+
+
+def test_different_keys_do_not_coalesce():
+    flight = SingleFlight('test')
+    release = threading.Event()
+    started = threading.Barrier(3, timeout=TIMEOUT)
+
+    def work():
+        started.wait()
+        release.wait(TIMEOUT)
+        return threading.get_ident()
+
+    results = []
+    threads = [threading.Thread(target=lambda key=key: results.append(flight.do(key, work)))
+               for key in ('a', 'b')]
+    for thread in threads:
+        thread.start()
+    # Cả 2 key cùng đang chạy
+    started.wait()
+    release.set()
+    for thread in threads:
+        thread.join(TIMEOUT)
+
+    assert len(set(results)) == 2
+    assert flight.stats()['executions'] == 2
@@ -0,0 +1,71 @@
+# test_vector_codec.py
+import numpy as np
+import pytest
+from services.vector_codec import (
+    encode_vector, decode_vector, decode_vectors,
+    FORMAT_FLOAT32, FORMAT_FLOAT16, FORMAT_INT8
+)
+
+DIM = 16
+
+
+@pytest.fixture
+def vectors():
+    rng = np.random.default_rng(0)
+    matrix = rng.standard_normal((5, DIM)).astype(np.float32)
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+
+def test_float32_round_trip_is_exact(vectors):
+    blobs = [encode_vector(vector, FORMAT_FLOAT32) for vector in vectors]
+    np.testing.assert_array_equal(decode_vectors(blobs, DIM), vectors)
+    np.testing.assert_array_equal(decode_vector(blobs[0], DIM), vectors[0])
+
+
+def test_float16_round_trip(vectors):
+    blobs = [encode_vector(vector, FORMAT_FLOAT16) for vector in vectors]
+    decoded = decode_vectors(blobs, DIM)
+    assert decoded.dtype == np.float32
+    np.testing.assert_allclose(decoded, vectors, atol=1e-3)
+
+
+def test_int8_round_trip_within_quantization_step(vectors):
+    blobs = [encode_vector(vector, FORMAT_INT8) for vector in vectors]
+    decoded = decode_vectors(blobs, DIM)
+    # Lượng tử hóa đối xứng theo từng vector: sai số tối đa nửa bước scale
+    step = np.abs(vectors).max(axis=1, keepdims=True) / 127.0
+    assert np.all(np.abs(decoded - vectors) <= step / 2 + 1e-6)
+
+
+def test_int8_zero_vector():
+    blob = encode_vector(np.zeros(DIM, dtype=np.float32), FORMAT_INT8)
+    np.testing.assert_array_equal(decode_vector(blob, DIM), np.zeros(DIM, dtype=np.float32))
+
+
+def test_legacy_raw_float32_blob(vectors):
+    # Blob cũ không có header: float32 thô
+    np.testing.assert_array_equal(decode_vector(vectors[0].tobytes(), DIM), vectors[0])
+
+
+def test_mixed_formats_decode_per_blob(vectors):
+    blobs = [
+        vectors[0].tobytes(),
+        encode_vector(vectors[1], FORMAT_FLOAT32),
+        encode_vector(vectors[2], FORMAT_FLOAT16),
+        encode_vector(vectors[3], FORMAT_INT8),
+    ]
+    decoded = decode_vectors(blobs, DIM)
+    assert decoded.shape == (4, DIM)
+    np.testing.assert_array_equal(decoded[:2], vectors[:2])
+    np.testing.assert_allclose(decoded[2:], vectors[2:4], atol=1e-2)
+
+
+def test_empty_input():
+    assert decode_vectors([], DIM).shape == (0, DIM)
+
+
+def test_unknown_format_is_rejected(vectors):
+    with pytest.raises(ValueError):
+        encode_vector(vectors[0], 'bfloat16')
+    with pytest.raises(ValueError):
+        decode_vector(b'XYZ' + b'\x00' * 10, DIM)
@@ -0,0 +1,170 @@
+# test_vector_store.py
+import os
+import numpy as np
+import pytest
+from services.vector_store import MmapVectorStore
+
+DIM = 4
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    return str(tmp_path / 'vectors')
+
+
+def _vectors(n, start=0):
+    return np.arange(start, start + n * DIM, dtype=np.float32).reshape(n, DIM)
+
+
+def _get(store, image_ids):
+    found, vectors = store.get(image_ids)
+    return found.tolist(), vectors
+
+
+def test_add_get_remove_survive_reopen(store_path):
+    store = MmapVectorStore(store_path, DIM)
+    store.add([10, 20, 30], _vectors(3))
+    store.remove([20])
+    # Ảnh 30 được embed lại: dòng mới thay dòng cũ
+    store.add([30], _vectors(1, start=100))
+    assert len(store) == 2
+    store.close()
+
+    store = MmapVectorStore(store_path, DIM)
+    found, vectors = _get(store, [10, 20, 30, 40])
+    assert found == [True, False, True, False]
+    np.testing.assert_array_equal(vectors[0], _vectors(1)[0])
+    np.testing.assert_array_equal(vectors[2], _vectors(1, start=100)[0])
+    np.testing.assert_array_equal(vectors[1], np.zeros(DIM, dtype=np.float32))
+    assert len(store) == 2
+    assert 20 not in store and 30 in store
+    store.close()
+
+
+def test_lookup_across_sorted_block_and_tail(store_path):
+    store = MmapVectorStore(store_path, DIM, merge_rows=4)
+    # 6 dòng > merge_rows -> được sắp xếp vào khối searchsorted
+    store.add([50, 10, 40, 20, 60, 30], _vectors(6))
+    assert store._indexed == 6
+    # 2 dòng mới nằm ở phần tail (chưa sắp xếp lại)
+    store.add([5, 70], _vectors(2, start=100))
+    assert store._indexed == 6
+
+    found, vectors = _get(store, [70, 10, 5, 60, 99, 0])
+    assert found == [True, True, True, True, False, False]
+    np.testing.assert_array_equal(vectors[0], _vectors(2, start=100)[1])
+    np.testing.assert_array_equal(vectors[1], _vectors(6)[1])
+    np.testing.assert_array_equal(vectors[2], _vectors(2, start=100)[0])
+
+    # id trong khối đã sắp xếp được embed lại vào tail: lấy bản ở tail
+    store.add([40], _vectors(1, start=200))
+    np.testing.assert_array_equal(_get(store, [40])[1][0], _vectors(1, start=200)[0])
+    # id ở tail bị xóa: không còn tìm thấy dù khối sắp xếp chưa dựng lại
+    store.remove([5])
+    assert store.contains([5, 40]).tolist() == [False, True]
+    store.close()
+
+
+def test_duplicate_ids_in_batch_keep_last(store_path):
+    store = MmapVectorStore(store_path, DIM)
+    store.add([1, 2, 1], _vectors(3))
+    assert len(store) == 2
+    np.testing.assert_array_equal(_get(store, [1])[1][0], _vectors(3)[2])
+    store.close()
+
+
+def test_legacy_duplicate_rows_keep_last_on_open(store_path):
+    # File cũ (trước khi có đánh dấu -1): id 7 có 2 dòng, dòng sau là bản mới nhất
+    _vectors(3).tofile(store_path + '.f32')
+    np.array([7, 8, 7], dtype=np.int64).tofile(store_path + '.ids')
+
+    store = MmapVectorStore(store_path, DIM)
+    assert len(store) == 2
+    np.testing.assert_array_equal(_get(store, [7])[1][0], _vectors(3)[2])
+    store.close()
+
+
+@pytest.mark.parametrize('torn_file', ['.f32', '.ids'])
+def test_torn_write_is_truncated_on_open(store_path, torn_file):
+    store = MmapVectorStore(store_path, DIM)
+    store.add([1, 2], _vectors(2))
+    store.close()
+
+    # Crash giữa lúc append: một file dài hơn file còn lại
+    with open(store_path + torn_file, 'ab') as f:
+        f.write(b'\x01' * 5)
+
+    store = MmapVectorStore(store_path, DIM)
+    assert os.path.getsize(store_path + '.f32') == 2 * DIM * 4
+    assert os.path.getsize(store_path + '.ids') == 2 * 8
+    # Dòng append sau khi mở lại vẫn thẳng hàng giữa 2 file
+    store.add([3], _vectors(1, start=30))
+    store.close()
+
+    store = MmapVectorStore(store_path, DIM)
+    found, vectors = _get(store, [1, 2, 3])
+    assert found == [True, True, True]
+    np.testing.assert_array_equal(vectors[2], _vectors(1, start=30)[0])
+    store.close()
+
+
+def test_compact_drops_dead_rows(store_path):
+    store = MmapVectorStore(store_path, DIM)
+    store.add([1, 2, 3], _vectors(3))
+    store.remove([2])
+    store.add([3], _vectors(1, start=30))
+
+    assert store.compact() == 2
+    assert store.count == 2
+    assert os.path.getsize(store_path + '.f32') == 2 * DIM * 4
+    assert store.compact() == 0
+    store.close()
+
+    store = MmapVectorStore(store_path, DIM)
+    found, vectors = _get(store, [1, 2, 3])
+    assert found == [True, False, True]
+    np.testing.assert_array_equal(vectors[2], _vectors(1, start=30)[0])
+    store.close()
+
+
+def _write_compacted(store_path, image_ids, vectors):
+    """File tạm như compact() ghi ra trước khi rename"""
+    vectors.tofile(store_path + '.f32.compact')
+    np.asarray(image_ids, dtype=np.int64).tofile(store_path + '.ids.compact')
+
+
+def test_finish_compaction_after_crash_between_renames(store_path):
+    store = MmapVectorStore(store_path, DIM)
+    store.add([1, 2, 3], _vectors(3))
+    store.remove([2])
+    store.close()
+
+    # Crash sau khi đánh dấu ready và rename file data, trước khi rename file ids
+    _write_compacted(store_path, [1, 3], _vectors(3)[[0, 2]])
+    open(store_path + '.compact-ready', 'wb').close()
+    os.replace(store_path + '.f32.compact', store_path + '.f32')
+
+    store = MmapVectorStore(store_path, DIM)
+    assert not os.path.exists(store_path + '.compact-ready')
+    assert not os.path.exists(store_path + '.ids.compact')
+    found, vectors = _get(store, [1, 2, 3])
+    assert found == [True, False, True]
+    np.testing.assert_array_equal(vectors[2], _vectors(3)[2])
+    store.close()
+
+
+def test_unfinished_compaction_is_discarded(store_path):
+    store = MmapVectorStore(store_path, DIM)
+    store.add([1, 2, 3], _vectors(3))
+    store.remove([2])
+    store.close()
+
+    # Crash khi đang ghi file tạm (chưa có file ready): giữ nguyên file cũ
+    _write_compacted(store_path, [1], _vectors(1))
+
+    store = MmapVectorStore(store_path, DIM)
+    assert not os.path.exists(store_path + '.f32.compact')
+    assert not os.path.exists(store_path + '.ids.compact')
+    assert store.count == 3
+    assert store.contains([1, 2, 3]).tolist() == [True, False, True]
+    store.close()
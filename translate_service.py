@@ -1,21 +1,121 @@
-from googletrans import Translator
 import asyncio
+from abc import ABC, abstractmethod
+from collections import OrderedDict
 from contextlib import asynccontextmanager
 import json
+import os
 
-class TranslateEngine(object):
-    def __init__(self):
+
+class TranslateBackend(ABC):
+    """Interface cho backend dịch. Backend chỉ cần cài đặt translate()"""
+
+    @abstractmethod
+    async def translate(self, query:str):
+        """Trả về bản dịch tiếng Anh của query"""
+
+
+class GoogleTranslateBackend(TranslateBackend):
+    def __init__(self, src="vi", dest="en"):
+        from googletrans import Translator
         self._trans = Translator()
-    
+        self.src = src
+        self.dest = dest
+
     async def translate(self, query:str):
-        translated = self._trans.translate(query, src= "vi", dest= "en")
+        translated = self._trans.translate(query, src= self.src, dest= self.dest)
         result = await translated
         return result.text
 
 
+class DictionaryBackend(TranslateBackend):
+    """
+    Backend tra từ điển cục bộ, dùng cho test/benchmark thay cho Google.
+    Query không có trong từ điển được trả về nguyên văn.
+    """
+    def __init__(self, dictionary=None, path=None):
+        self.dictionary = dict(dictionary or {})
+        if path:
+            with open(path, encoding="utf-8") as f:
+                self.dictionary.update(json.load(f))
+
+    async def translate(self, query:str):
+        return self.dictionary.get(query, query)
+
+
+def create_backend(name=None):
+    name = (name or os.getenv("TRANSLATE_BACKEND", "google")).lower()
+    if name == "google":
+        return GoogleTranslateBackend()
+    if name == "dictionary":
+        return DictionaryBackend(path=os.getenv("TRANSLATE_DICTIONARY_PATH"))
+    raise ValueError(f"Unknown translate backend: {name}")
+
+
+class TranslateEngine(object):
+    """
+    Bọc backend với LRU cache và request coalescing: các request đồng thời
+    cùng query chỉ gọi backend một lần và dùng chung kết quả.
+    """
+    def __init__(self, backend=None, cache_size=10000):
+        self.backend = backend or create_backend()
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def translate(self, query:str):
+        if query in self._cache:
+            self._cache.move_to_end(query)
+            self.hits += 1
+            return self._cache[query]
+
+        # Đã có request cùng query đang chạy -> chờ kết quả của nó
+        inflight = self._inflight.get(query)
+        if inflight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(inflight)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[query] = future
+        try:
+            result = await self.backend.translate(query)
+        except Exception as e:
+            future.set_exception(e)
+            # Tránh cảnh báo "exception was never retrieved" khi không ai chờ
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(query, None)
+
+        future.set_result(result)
+        self._cache[query] = result
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return result
+
+    async def translate_batch(self, queries):
+        """Dịch nhiều query, giữ nguyên thứ tự; query trùng nhau chỉ dịch một lần"""
+        unique_queries = list(dict.fromkeys(queries))
+        results = await asyncio.gather(*(self.translate(q) for q in unique_queries))
+        translated = dict(zip(unique_queries, results))
+        return [translated[q] for q in queries]
+
+    def stats(self):
+        return {
+            "cache_size": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "inflight": len(self._inflight)
+        }
+
+
 from fastapi import FastAPI, Request, Response, Body
 from fastapi.responses import JSONResponse
-from typing import Annotated
+from typing import Annotated, Union
 import uvicorn
 
 @asynccontextmanager
@@ -28,8 +128,11 @@ async def lifespan(app: FastAPI):
 app = FastAPI(lifespan = lifespan)
 
 @app.post("/", response_class=JSONResponse)
-async def index(query: Annotated[str, Body()], request: Request):
-    query_text = json.loads(query)['query']
+async def index(payload: Annotated[Union[dict, str], Body()], request: Request):
+    # Hỗ trợ cả body JSON object và kiểu cũ (chuỗi JSON được encode 2 lần)
+    if isinstance(payload, str):
+        payload = json.loads(payload)
+    query_text = payload['query']
 
     result = await request.app.translate_engine.translate(query_text)
 
@@ -41,6 +144,30 @@ async def index(query: Annotated[str, Body()], request: Request):
     )
 
 
+@app.post("/batch", response_class=JSONResponse)
+async def batch(payload: Annotated[dict, Body()], request: Request):
+    queries = payload.get('queries')
+    if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+        return JSONResponse(
+            status_code = 400,
+            content = {"message": "'queries' must be a list of strings"}
+        )
+
+    results = await request.app.translate_engine.translate_batch(queries)
+
+    return JSONResponse(
+        status_code = 200,
+        content = {
+            "translated_texts": results
+        }
+    )
+
+
+@app.get("/stats", response_class=JSONResponse)
+async def stats(request: Request):
+    return JSONResponse(status_code = 200, content = request.app.translate_engine.stats())
+
+
 async def main_run():
     config = uvicorn.Config("translate_service:app", 
     	port=8080, 